@@ -16,11 +16,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import copy
+import hashlib
+import io
 import logging
+import os
 import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
 
+import numpy as np
 import torch.onnx
 from pytorch_lightning import Callback
 
@@ -35,9 +43,9 @@ except ModuleNotFoundError:
     tf_backend = None
 
 try:
-    import onnxruntime.backend as onnxrt_backend  # pytype: disable=import-error
+    import onnxruntime  # pytype: disable=import-error
 except ModuleNotFoundError:
-    onnxrt_backend = None
+    onnxruntime = None
 
 from ..models.factory.qat import QAT_MODULE_MAPPINGS
 
@@ -51,20 +59,243 @@ def symbolic_batch_dim(model):
         dim1.dim_param = sym_batch_dim
 
 
+def model_hash(model: torch.nn.Module) -> str:
+    """Hash of the structure and of the weights and buffers of a model"""
+    digest = hashlib.sha1()
+    for name, module in model.named_modules():
+        digest.update(f"{name}:{type(module).__name__};".encode())
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)};".encode())
+        digest.update(tensor.numpy().tobytes())
+
+    return digest.hexdigest()
+
+
+def export_onnx(model) -> bytes:
+    """Export a lightning module with its example input array to onnx in memory"""
+    buffer = io.BytesIO()
+    torch.onnx.export(model, model.example_input_array, buffer, verbose=False)
+
+    return buffer.getvalue()
+
+
+def resident_memory_mb() -> Optional[float]:
+    """Current resident set size of the process in MB, None if it is not available"""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def benchmark_latency(
+    run: Callable[[torch.Tensor], Any],
+    inputs: torch.Tensor,
+    warmup: int = 10,
+    iterations: int = 100,
+    synchronize: Optional[Callable[[], None]] = None,
+    device: Optional[torch.device] = None,
+) -> Dict[str, float]:
+    """Measure the latency of run(inputs)
+
+    Memory is measured around the warmup and timed runs only, so allocations
+    made before the benchmark, e.g. by training, are not attributed to the model.
+
+    Args:
+        run: function running a single batch
+        inputs: the batch
+        warmup (int): number of untimed runs before the measurement
+        iterations (int): number of timed runs
+        synchronize: called after each run, e.g. torch.cuda.synchronize for asynchronous devices
+        device: if this is a cuda device, the peak cuda memory allocated by the runs is measured
+
+    Returns:
+        Dict[str, float]: median, p95 and p99 latency in milliseconds, throughput in samples per second,
+                          growth of the resident memory in MB and if measured the peak cuda memory in MB
+    """
+    cuda = device is not None and torch.device(device).type == "cuda"
+    if cuda:
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        cuda_baseline = torch.cuda.memory_allocated(device)
+    resident_baseline = resident_memory_mb()
+
+    for _ in range(warmup):
+        run(inputs)
+    if synchronize is not None:
+        synchronize()
+
+    latencies = np.empty(iterations)
+    for iteration in range(iterations):
+        start = time.perf_counter()
+        run(inputs)
+        if synchronize is not None:
+            synchronize()
+        latencies[iteration] = time.perf_counter() - start
+
+    latencies *= 1000.0
+    result = {
+        "latency_median_ms": float(np.median(latencies)),
+        "latency_p95_ms": float(np.percentile(latencies, 95)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "throughput": float(inputs.shape[0] * 1000.0 / np.mean(latencies)),
+    }
+
+    resident = resident_memory_mb()
+    if resident is not None and resident_baseline is not None:
+        result["resident_memory_mb"] = max(resident - resident_baseline, 0.0)
+    if cuda:
+        peak = torch.cuda.max_memory_allocated(device) - cuda_baseline
+        result["cuda_peak_memory_mb"] = peak / 2**20
+
+    return result
+
+
 class InferenceBackendBase(Callback):
-    """Base class to run val and test on a backend inference engine"""
+    """Base class to run val and test on a backend inference engine
+
+    Backend sessions are cached by a hash of the model structure and weights,
+    so a session is only created if the model has changed since the session
+    was created. Sessions created for benchmarks with a specific thread count
+    are cached by model hash and thread count. Backend and reference model are
+    run concurrently.
+
+    If benchmarking is enabled, the latency of the backend is measured at the end
+    of each validation epoch the backend is run in and at the end of the test epoch,
+    for each combination of batch size and thread count. The results are logged as
+    <stage>_backend_<statistic>, e.g. val_backend_latency_p95_ms, for the first
+    batch size and thread count and with the suffix _b<batch size>_t<threads> for all
+    other combinations. So they can be used as monitors of the optimization callback
+    and become part of the nas metrics.
+
+    Args:
+        val_batches (int): number of validation batches run on the backend
+        test_batches (int): number of test batches run on the backend
+        val_frequency (int): run the backend every val_frequency validation epochs
+        session_cache_size (int): number of models whose backend sessions are kept for reuse
+        benchmark (Mapping): benchmark configuration with the keys iterations
+                             (number of timed runs, 0 disables benchmarking),
+                             warmup, batch_sizes and num_threads (0 keeps the default)
+    """
 
-    def __init__(self, val_batches=1, test_batches=1, val_frequency=10):
+    def __init__(
+        self,
+        val_batches=1,
+        test_batches=1,
+        val_frequency=10,
+        session_cache_size=2,
+        benchmark: Optional[Mapping[str, Any]] = None,
+    ):
         self.test_batches = test_batches
         self.val_batches = val_batches
         self.val_frequency = val_frequency
         self.validation_epoch = 0
 
+        self.session_cache_size = session_cache_size
+        self.session = None
+        self._sessions: "OrderedDict[Tuple[str, int], Any]" = OrderedDict()
+        self._model_key: Optional[str] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        benchmark = benchmark if benchmark is not None else {}
+        self.benchmark_iterations = benchmark.get("iterations", 0)
+        self.benchmark_warmup = benchmark.get("warmup", 10)
+        self.benchmark_batch_sizes = list(benchmark.get("batch_sizes", [1]))
+        self.benchmark_num_threads = list(benchmark.get("num_threads", [0]))
+        self.benchmark_results: Dict[str, float] = {}
+
     def run_batch(self, inputs=None):
         raise NotImplementedError("run_batch is an abstract method")
 
+    def create_session(self, module):
+        raise NotImplementedError("create_session is an abstract method")
+
+    def cached_session(self, num_threads: int, create: Callable[[], Any]) -> Any:
+        """Session of the prepared model for num_threads, created with create() if it is not cached"""
+        key = (self._model_key, num_threads)
+        session = self._sessions.get(key)
+        if session is None:
+            session = create()
+            self._sessions[key] = session
+            sessions_per_model = 1 + sum(n > 0 for n in self.benchmark_num_threads)
+            while len(self._sessions) > self.session_cache_size * sessions_per_model:
+                self._sessions.popitem(last=False)
+        else:
+            logging.info("Reusing backend session for unchanged model")
+            self._sessions.move_to_end(key)
+
+        return session
+
     def prepare(self, module):
-        raise NotImplementedError("prepare is an abstract method")
+        self._model_key = model_hash(module)
+        self.session = self.cached_session(0, lambda: self.create_session(module))
+
+    def benchmark_session(self, module, num_threads):
+        """Session used to benchmark with num_threads threads, 0 uses the default"""
+        return self.session
+
+    def benchmark(self, pl_module, stage):
+        """Benchmark the current session on the example input of the module"""
+        # Backends that run on the cpu move their inputs themselves
+        example = pl_module.example_input_array[:1].to(pl_module.device)
+        synchronize = None
+        if pl_module.device.type == "cuda":
+            synchronize = torch.cuda.synchronize
+
+        results = {}
+        session = self.session
+        default_num_threads = torch.get_num_threads()
+        try:
+            for thread_idx, num_threads in enumerate(self.benchmark_num_threads):
+                if num_threads > 0:
+                    torch.set_num_threads(num_threads)
+                self.session = self.benchmark_session(pl_module, num_threads)
+                for batch_idx, batch_size in enumerate(self.benchmark_batch_sizes):
+                    inputs = example.expand(batch_size, *example.shape[1:]).contiguous()
+                    with torch.no_grad():
+                        stats = benchmark_latency(
+                            self.run_batch,
+                            inputs,
+                            warmup=self.benchmark_warmup,
+                            iterations=self.benchmark_iterations,
+                            synchronize=synchronize,
+                            device=pl_module.device,
+                        )
+
+                    suffix = ""
+                    if thread_idx > 0 or batch_idx > 0:
+                        suffix = f"_b{batch_size}_t{num_threads}"
+                    for name, value in stats.items():
+                        results[f"{stage}_backend_{name}{suffix}"] = value
+        finally:
+            torch.set_num_threads(default_num_threads)
+            self.session = session
+
+        for name, value in results.items():
+            pl_module.log(name, value)
+            logging.info("%s: %f", name, value)
+        self.benchmark_results.update(results)
+
+        return results
+
+    def _compare(self, pl_module, inputs):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="inference_backend"
+            )
+
+        future = self._executor.submit(self.run_batch, inputs)
+        target = pl_module(inputs.to(pl_module.device))
+        result = future.result()
+
+        return torch.nn.functional.mse_loss(
+            result.to(pl_module.device),
+            target.to(pl_module.device),
+            reduction="mean",
+        )
 
     def on_validation_epoch_start(self, trainer, pl_module):
         if self.val_batches > 0:
@@ -76,132 +307,255 @@ class InferenceBackendBase(Callback):
     ):
         if batch_idx < self.val_batches:
             if self.validation_epoch % self.val_frequency == 0:
-                result = self.run_batch(inputs=batch[0])
-                target = pl_module.forward(batch[0].to(pl_module.device))
-
-                mse = torch.nn.functional.mse_loss(
-                    result.to(pl_module.device),
-                    target.to(pl_module.device),
-                    reduction="mean",
-                )
+                mse = self._compare(pl_module, batch[0])
                 pl_module.log("val_backend_mse", mse)
                 logging.info("val_backend_mse: %f", mse)
 
     def on_validation_epoch_end(self, trainer, pl_module):
+        if self.val_batches > 0 and self.benchmark_iterations > 0:
+            if self.validation_epoch % self.val_frequency == 0:
+                self.benchmark(pl_module, "val")
         self.validation_epoch += 1
 
     def on_test_epoch_start(self, trainer, pl_module):
         self.prepare(pl_module)
 
+    def on_test_epoch_end(self, trainer, pl_module):
+        if self.benchmark_iterations > 0:
+            self.benchmark(pl_module, "test")
+
     def on_test_batch_end(
         self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
     ):
         if batch_idx < self.test_batches:
-            result = self.run_batch(inputs=batch[0])
-            target = pl_module(batch[0].to(pl_module.device))
-
-            mse = torch.nn.functional.mse_loss(
-                result.to(pl_module.device),
-                target.to(pl_module.device),
-                reduction="mean",
-            )
+            mse = self._compare(pl_module, batch[0])
             pl_module.log("test_backend_mse", mse)
             logging.info("test_backend_mse: %f", mse)
 
+    def teardown(self, trainer, pl_module, stage=None):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class TorchEagerBackend(InferenceBackendBase):
+    """Runs the lightning module itself, used as eager mode baseline for benchmarks"""
+
+    def __init__(
+        self,
+        val_batches=1,
+        test_batches=1,
+        val_frequency=1,
+        session_cache_size=2,
+        benchmark=None,
+    ):
+        super().__init__(
+            val_batches, test_batches, val_frequency, session_cache_size, benchmark
+        )
+
+    def create_session(self, model):
+        return model
+
+    def run_batch(self, inputs=None):
+        with torch.no_grad():
+            return self.session(inputs.to(self.session.device))
+
+
+class QuantizedBackend(InferenceBackendBase):
+    """Runs the network with the quantized modules used for export
+
+    Quantization aware training modules are converted like in the model export,
+    feature extraction and normalization are run by the lightning module.
+    """
+
+    def __init__(
+        self,
+        val_batches=1,
+        test_batches=1,
+        val_frequency=1,
+        session_cache_size=2,
+        benchmark=None,
+    ):
+        super().__init__(
+            val_batches, test_batches, val_frequency, session_cache_size, benchmark
+        )
+        self.module = None
+
+    def create_session(self, model):
+        quantized_model = copy.deepcopy(model.model)
+        quantized_model.cpu()
+        if hasattr(quantized_model, "qconfig") and quantized_model.qconfig:
+            quantized_model = torch.quantization.convert(
+                quantized_model, mapping=QAT_MODULE_MAPPINGS, remove_qconfig=True
+            )
+        quantized_model.eval()
+
+        return quantized_model
+
+    def prepare(self, module):
+        super().prepare(module)
+        self.module = module
+
+    def run_batch(self, inputs=None):
+        with torch.no_grad():
+            x = self.module._extract_features(inputs.to(self.module.device))
+            x = self.module.normalizer(x)
+            return self.session(x.cpu())
+
 
 class TorchMobileBackend(InferenceBackendBase):
     """Inference backend for torch mobile"""
 
-    def __init__(self, val_batches=1, test_batches=1, val_frequency=1):
-        super().__init__(val_batches, test_batches, val_frequency)
-
-        self.script_module = None
+    def __init__(
+        self,
+        val_batches=1,
+        test_batches=1,
+        val_frequency=1,
+        session_cache_size=2,
+        benchmark=None,
+    ):
+        super().__init__(
+            val_batches, test_batches, val_frequency, session_cache_size, benchmark
+        )
 
-    def prepare(self, model):
+    def create_session(self, model):
         logging.info("Preparing model for target")
-        self.script_module = model.to_torchscript(method="trace")
+        return model.to_torchscript(method="trace")
 
     def run_batch(self, inputs=None):
         if inputs is None:
             logging.critical("Backend batch is empty")
             return None
 
-        return self.script_module(inputs)
+        return self.session(inputs)
 
 
 class OnnxTFBackend(InferenceBackendBase):
     """Inference Backend for tensorflow"""
 
-    def __init__(self, val_batches=1, test_batches=1, val_frequency=10):
+    def __init__(
+        self,
+        val_batches=1,
+        test_batches=1,
+        val_frequency=10,
+        session_cache_size=2,
+        benchmark=None,
+    ):
         super(OnnxTFBackend, self).__init__(
             val_batches=val_batches,
             test_batches=test_batches,
             val_frequency=val_frequency,
+            session_cache_size=session_cache_size,
+            benchmark=benchmark,
         )
 
-        self.tf_model = None
-        self.interpreter = None
-
         if onnx is None or tf_backend is None:
             raise Exception(
                 "Could not find required libraries for onnx-tf backend please install with poetry instell -E tf-backend"
             )
 
-    def prepare(self, model):
-        with TemporaryDirectory() as tmp_dir:
-            tmp_dir = Path(tmp_dir)
-
-            logging.info("transfering model to onnx")
-            dummy_input = model.example_input_array
-            torch.onnx.export(model, dummy_input, tmp_dir / "model.onnx", verbose=False)
-            logging.info("Creating tf-protobuf")
-            onnx_model = onnx.load(tmp_dir / "model.onnx")
-            symbolic_batch_dim(onnx_model)
-            self.tf_model = tf_backend.prepare(onnx_model)
+    def create_session(self, model):
+        logging.info("transfering model to onnx")
+        onnx_model = onnx.load_model_from_string(export_onnx(model))
+        logging.info("Creating tf-protobuf")
+        symbolic_batch_dim(onnx_model)
+        return tf_backend.prepare(onnx_model)
 
     def run_batch(self, inputs):
         logging.info("running tf backend on batch")
 
-        result = self.tf_model.run(inputs=inputs)
+        result = self.session.run(inputs=inputs.cpu().numpy())
         result = [torch.from_numpy(res) for res in result]
-        return result
+        return result[0] if len(result) == 1 else result
 
 
 class OnnxruntimeBackend(InferenceBackendBase):
-    """Inference Backend for tensorflow"""
+    """Inference Backend for onnxruntime
+
+    Args:
+        intra_op_num_threads (int): threads used to parallelize an operator, 0 uses the onnxruntime default
+        inter_op_num_threads (int): threads used to run operators in parallel, 0 uses the onnxruntime default
+        graph_optimization_level (str): one of disable, basic, extended or all
+    """
+
+    GRAPH_OPTIMIZATION_LEVELS = {
+        "disable": "ORT_DISABLE_ALL",
+        "basic": "ORT_ENABLE_BASIC",
+        "extended": "ORT_ENABLE_EXTENDED",
+        "all": "ORT_ENABLE_ALL",
+    }
 
     def __init__(
-        self, val_batches=1, test_batches=1, val_frequency=10, use_tf_lite=True
+        self,
+        val_batches=1,
+        test_batches=1,
+        val_frequency=10,
+        use_tf_lite=True,
+        session_cache_size=2,
+        intra_op_num_threads=0,
+        inter_op_num_threads=0,
+        graph_optimization_level="all",
+        benchmark=None,
     ):
         super(OnnxruntimeBackend, self).__init__(
-            val_batches=val_batches, test_batches=test_batches, val_frequency=10
+            val_batches=val_batches,
+            test_batches=test_batches,
+            val_frequency=val_frequency,
+            session_cache_size=session_cache_size,
+            benchmark=benchmark,
         )
 
-        self.onnxrt_model = None
-
-        if onnx is None or onnxrt_backend is None:
+        if onnx is None or onnxruntime is None:
             raise Exception(
                 "Could not find required libraries for onnxruntime backend please install with poetry instell -E onnxrt-backend"
             )
 
-    def prepare(self, model):
-        with TemporaryDirectory() as tmp_dir:
-            tmp_dir = Path(tmp_dir)
+        if graph_optimization_level not in self.GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(
+                f"Unknown graph optimization level: {graph_optimization_level}"
+            )
+
+        self.inter_op_num_threads = inter_op_num_threads
+        self.graph_optimization_level = graph_optimization_level
+        self.session_options = self._session_options(intra_op_num_threads)
+
+    def _session_options(self, intra_op_num_threads):
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = intra_op_num_threads
+        session_options.inter_op_num_threads = self.inter_op_num_threads
+        session_options.graph_optimization_level = getattr(
+            onnxruntime.GraphOptimizationLevel,
+            self.GRAPH_OPTIMIZATION_LEVELS[self.graph_optimization_level],
+        )
+        return session_options
+
+    def create_session(self, model, session_options=None):
+        logging.info("transfering model to onnx")
+        onnx_model = onnx.load_model_from_string(export_onnx(model))
+        logging.info("Creating onnxrt-model")
+        symbolic_batch_dim(onnx_model)
+        return onnxruntime.InferenceSession(
+            onnx_model.SerializeToString(),
+            sess_options=session_options or self.session_options,
+            providers=["CPUExecutionProvider"],
+        )
 
-            logging.info("transfering model to onnx")
-            dummy_input = model.example_input_array
-            torch.onnx.export(model, dummy_input, tmp_dir / "model.onnx", verbose=False)
-            logging.info("Creating onnxrt-model")
-            onnx_model = onnx.load(tmp_dir / "model.onnx")
-            symbolic_batch_dim(onnx_model)
-            self.onnxrt_model = onnxrt_backend.prepare(onnx_model)
+    def benchmark_session(self, module, num_threads):
+        # The thread pools of a session are fixed when the session is created
+        if num_threads <= 0:
+            return self.session
+        return self.cached_session(
+            num_threads,
+            lambda: self.create_session(module, self._session_options(num_threads)),
+        )
 
     def run_batch(self, inputs=None):
         logging.info("running onnxruntime backend on batch")
 
-        result = self.onnxrt_model.run(inputs=[input.numpy() for input in inputs])
+        input_name = self.session.get_inputs()[0].name
+        result = self.session.run(None, {input_name: inputs.cpu().numpy()})
         result = [torch.from_numpy(res) for res in result]
-        return result
+        return result[0] if len(result) == 1 else result
 
 
 class TRaxUltraTrailBackend(Callback):
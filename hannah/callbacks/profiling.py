@@ -0,0 +1,131 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import time
+from typing import Optional
+
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.utilities.distributed import rank_zero_only
+
+from ..profiling import get_profiler
+
+msglogger = logging.getLogger(__name__)
+
+
+class RegionProfilerCallback(Callback):
+    """Logs periodic summaries of the timing regions and records chrome traces
+
+    In addition to the regions instrumented in the modules, the callback records
+    the regions train_batch (from the start to the end of a training batch) and
+    data_loading (from the end of a training batch to the start of the next one,
+    which is dominated by fetching the next batch from the dataloader).
+
+    Summaries are logged to all experiment loggers as profile/<region>_mean_ms,
+    profile/<region>_max_ms and profile/<region>_total_ms.
+
+    Args:
+        log_every_n_steps (int): log the region summaries every n training batches
+        cuda_events (bool): additionally time the regions with cuda events
+        trace (bool): write a chrome trace of a window of training batches
+        trace_start_step (int): first training batch of the trace
+        trace_steps (int): number of training batches in the trace
+        trace_file (str): path of the chrome trace
+    """
+
+    def __init__(
+        self,
+        log_every_n_steps: int = 50,
+        cuda_events: bool = False,
+        trace: bool = False,
+        trace_start_step: int = 10,
+        trace_steps: int = 20,
+        trace_file: str = "trace.json",
+    ):
+        self.log_every_n_steps = log_every_n_steps
+        self.cuda_events = cuda_events
+        self.trace = trace
+        self.trace_start_step = trace_start_step
+        self.trace_steps = trace_steps
+        self.trace_file = trace_file
+
+        self.profiler = get_profiler()
+        self._batches = 0
+        self._batch_start = 0.0
+        self._batch_end: Optional[float] = None
+
+    def on_train_start(self, trainer, pl_module):
+        self.profiler.cuda_events = self.cuda_events
+        self._batch_end = None
+
+    def on_train_batch_start(
+        self, trainer, pl_module, batch, batch_idx, unused: int = 0
+    ):
+        now = time.perf_counter()
+        if self._batch_end is not None:
+            self.profiler.record("data_loading", self._batch_end, now)
+        self._batch_start = now
+
+        if self.trace and self._batches == self.trace_start_step:
+            msglogger.info("Recording chrome trace of %d steps", self.trace_steps)
+            self.profiler.start_trace()
+
+    def on_train_batch_end(
+        self, trainer, pl_module, outputs, batch, batch_idx, unused: int = 0
+    ):
+        self.profiler.record("train_batch", self._batch_start, time.perf_counter())
+        self._batches += 1
+
+        if (
+            self.profiler.tracing
+            and self._batches >= self.trace_start_step + self.trace_steps
+        ):
+            self._stop_trace()
+
+        if self.log_every_n_steps > 0 and self._batches % self.log_every_n_steps == 0:
+            self._log_summary(trainer)
+
+        self._batch_end = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        # the gap to the next epoch contains validation and is not data loading
+        self._batch_end = None
+
+    def on_train_end(self, trainer, pl_module):
+        if self.profiler.tracing:
+            self._stop_trace()
+        self._log_summary(trainer)
+
+    def _stop_trace(self):
+        self.profiler.stop_trace(self.trace_file)
+        msglogger.info("Chrome trace written to %s", self.trace_file)
+
+    @rank_zero_only
+    def _log_summary(self, trainer):
+        summary = self.profiler.summary()
+        if not summary:
+            return
+
+        metrics = {}
+        for name, stats in summary.items():
+            for key in ["mean_ms", "max_ms", "total_ms", "cuda_mean_ms"]:
+                if key in stats:
+                    metrics[f"profile/{name}_{key}"] = stats[key]
+
+        for logger in trainer.loggers:
+            logger.log_metrics(metrics, step=trainer.global_step)
@@ -16,52 +16,87 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
 import logging
 from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Sequence, Tuple, Union
 
 import pandas as pd
 import torch
+import torch.nn as nn
 from pytorch_lightning.callbacks import Callback
 from pytorch_lightning.utilities.distributed import rank_zero_only
 from tabulate import tabulate
+from torch.quantization import FakeQuantizeBase
+from torch.quantization.observer import ObserverBase
 
-from hannah.models.ofa.submodules.elasticBase import ElasticBase1d
+from hannah.models.ofa.submodules.elasticBase import ElasticBase1d, _Elastic
 
-from ..models.factory import qat
+from ..models.factory import pooling, qat
+from ..models.factory.network import ConvNet
+from ..models.factory.reduction import ReductionBlockAdd, ReductionBlockConcat
 from ..models.ofa import OFAModel
 from ..models.ofa.submodules.elastickernelconv import ConvBn1d, ConvBnReLu1d, ConvRelu1d
+from ..models.ofa.submodules.resblock import ResBlock1d, ResBlockBase
 from ..models.ofa.type_utils import elastic_conv_type, elastic_Linear_type
+from ..models.ofa.utilities import conv1d_get_padding
 from ..models.sinc import SincNet
+from ..models.tc import models as tc
+from ..profiling import region
 from ..torch_extensions.nn import SNNActivationLayer, SNNLayers
 
 msglogger = logging.getLogger(__name__)
 
+SUMMARY_COLUMNS = [
+    "Name",
+    "Type",
+    "Attrs",
+    "IFM",
+    "IFM volume",
+    "OFM",
+    "OFM volume",
+    "Weights volume",
+    "MACs",
+]
 
-def walk_model(model, dummy_input):
-    """Adapted from IntelLabs Distiller"""
 
-    data = {
-        "Name": [],
-        "Type": [],
-        "Attrs": [],
-        "IFM": [],
-        "IFM volume": [],
-        "OFM": [],
-        "OFM volume": [],
-        "Weights volume": [],
-        "MACs": [],
-    }
+def _prod(seq) -> int:
+    result = 1.0
+    for number in seq:
+        result *= number
+    return int(result)
 
-    def prod(seq):
-        result = 1.0
-        for number in seq:
-            result *= number
-        return int(result)
+
+def _conv_attrs(kernel_size, stride, groups, dilation) -> str:
+    attrs = "k=" + "(" + (", ").join(["%d" % v for v in kernel_size]) + ")"
+    attrs += ", s=" + "(" + (", ").join(["%d" % v for v in stride]) + ")"
+    attrs += ", g=(%d)" % groups
+    attrs += ", d=" + "(" + ", ".join(["%d" % v for v in dilation]) + ")"
+    return attrs
+
+
+FUSED_MODULES = (nn.modules.conv._ConvNd, nn.Linear, ElasticBase1d)
+
+
+def walk_model(model, dummy_input, collapse_fused=False):
+    """Adapted from IntelLabs Distiller
+
+    Args:
+        model: the model to summarize
+        dummy_input: input of the model
+        collapse_fused (bool): do not record the submodules of convolutions and
+            linear layers, e.g. the batch norm and fake quantization modules of
+            fused qat layers, like AnalyticSummary
+    """
+
+    data = {column: [] for column in SUMMARY_COLUMNS}
+
+    prod = _prod
+
+    module_names = {id(mod): module_name for module_name, mod in model.named_modules()}
 
     def get_name_by_module(m):
-        for module_name, mod in model.named_modules():
-            if m == mod:
-                return module_name
+        return module_names.get(id(m))
 
     def collect(module, input, output):
         # if len(list(module.children())) != 0:
@@ -105,9 +140,12 @@ def walk_model(model, dummy_input):
             qat.ConvBn2d: get_conv,
             qat.ConvBnReLU1d: get_conv,
             qat.ConvBnReLU2d: get_conv,
+            qat.ConvReLU1d: get_conv,
+            qat.ConvReLU2d: get_conv,
             SincNet: get_sinc_conv,
             torch.nn.Linear: get_fc,
             qat.Linear: get_fc,
+            qat.LinearReLU: get_fc,
             SNNActivationLayer.Spiking1DeLIFLayer: get_1DSpikeLayer,
             SNNActivationLayer.Spiking1DLIFLayer: get_1DSpikeLayer,
             SNNActivationLayer.Spiking1DeALIFLayer: get_1DSpikeLayer,
@@ -131,12 +169,9 @@ def walk_model(model, dummy_input):
             return module.channels * output.shape[1] * neuron_macs[module.type]
 
     def get_conv_attrs(module):
-        attrs = "k=" + "(" + (", ").join(["%d" % v for v in module.kernel_size]) + ")"
-        attrs += ", s=" + "(" + (", ").join(["%d" % v for v in module.stride]) + ")"
-        attrs += ", g=(%d)" % module.groups
-        # attrs += ", g=" + "(" + ", ".join(["%d" % v for v in groups]) + ")"
-        attrs += ", d=" + "(" + ", ".join(["%d" % v for v in module.dilation]) + ")"
-        return attrs
+        return _conv_attrs(
+            module.kernel_size, module.stride, module.groups, module.dilation
+        )
 
     def get_spike_attrs(module):
         attrs = ""
@@ -195,10 +230,16 @@ def walk_model(model, dummy_input):
         attrs = ""
         return weights, macs, attrs
 
+    internal = set()
+    if collapse_fused:
+        for module in model.modules():
+            if isinstance(module, FUSED_MODULES):
+                internal.update(id(m) for m in module.modules() if m is not module)
+
     hooks = list()
 
     for name, module in model.named_modules():
-        if module != model:
+        if module != model and id(module) not in internal:
             hooks += [module.register_forward_hook(collect)]
 
     with torch.no_grad():
@@ -211,8 +252,362 @@ def walk_model(model, dummy_input):
     return df
 
 
+class UnsupportedModuleError(Exception):
+    """The output shape of a module can not be derived analytically"""
+
+
+POINTWISE_MODULES = (
+    nn.BatchNorm1d,
+    nn.BatchNorm2d,
+    nn.Dropout,
+    nn.ELU,
+    nn.Hardtanh,
+    nn.Identity,
+    nn.LeakyReLU,
+    nn.ReLU,
+    nn.ReLU6,
+    nn.Sigmoid,
+    nn.Tanh,
+    FakeQuantizeBase,
+    ObserverBase,
+)
+
+GLOBAL_POOLING_MODULES = (
+    pooling.ApproximateGlobalAveragePooling1D,
+    pooling.ApproximateGlobalAveragePooling2D,
+    tc.ApproximateGlobalAveragePooling1D,
+)
+
+Shape = Tuple[int, ...]
+
+
+class LayerCost(NamedTuple):
+    shape: Shape
+    weights: float
+    macs: float
+    attrs: str
+
+
+def _pair(value, dims: int) -> Tuple[int, ...]:
+    if isinstance(value, (tuple, list)):
+        return tuple(value)
+    return (value,) * dims
+
+
+def _conv_output_shape(
+    shape: Shape, out_channels, kernel_size, stride, padding, dilation
+) -> Shape:
+    spatial = shape[2:]
+    dims = len(spatial)
+    kernel_size = _pair(kernel_size, dims)
+    stride = _pair(stride, dims)
+    dilation = _pair(dilation, dims)
+    if padding == "same":
+        return (shape[0], out_channels) + tuple(spatial)
+    padding = _pair(0 if padding == "valid" else padding, dims)
+
+    out = tuple(
+        (size + 2 * p - d * (k - 1) - 1) // s + 1
+        for size, k, s, p, d in zip(spatial, kernel_size, stride, padding, dilation)
+    )
+    return (shape[0], out_channels) + out
+
+
+class AnalyticSummary:
+    """Computes the layer summary of walk_model without executing the network
+
+    Shapes are propagated through the known container and layer types of the
+    model factory, TC-ResNet, quantization aware training and once for all
+    models. MACs and weights are computed from the layer parameters, elastic
+    layers are evaluated in their currently active configuration. Fused
+    modules are treated as a single layer, so their internal submodules do not
+    get a row of their own.
+
+    Raises:
+        UnsupportedModuleError: if the model contains modules of other types
+    """
+
+    def __init__(self, model: nn.Module):
+        self.model = model
+        self.names = {id(module): name for name, module in model.named_modules()}
+        self.data: Dict[str, List[Any]] = {column: [] for column in SUMMARY_COLUMNS}
+
+    def __call__(self, input_shape: Sequence[int]) -> pd.DataFrame:
+        self._visit(self.model, tuple(input_shape))
+        return pd.DataFrame(data=self.data)
+
+    def _record(
+        self,
+        module: nn.Module,
+        ifm: Shape,
+        ofm: Shape,
+        weights: float = 0,
+        macs: float = 0,
+        attrs: str = "",
+    ) -> None:
+        # like the forward hooks of walk_model, only registered submodules are recorded
+        if module is self.model or id(module) not in self.names:
+            return
+        self.data["Name"] += [self.names[id(module)]]
+        self.data["Type"] += [module.__class__.__name__]
+        self.data["Attrs"] += [attrs]
+        self.data["IFM"] += [ifm]
+        self.data["IFM volume"] += [_prod(ifm)]
+        self.data["OFM"] += [ofm]
+        self.data["OFM volume"] += [_prod(ofm)]
+        self.data["Weights volume"] += [int(weights)]
+        self.data["MACs"] += [int(macs)]
+
+    def _visit_all(self, modules, shape: Shape) -> Shape:
+        for module in modules:
+            shape = self._visit(module, shape)
+        return shape
+
+    def _visit(self, module: nn.Module, shape: Shape) -> Shape:
+        out = self._propagate(module, shape)
+        if isinstance(out, LayerCost):
+            self._record(module, shape, out.shape, out.weights, out.macs, out.attrs)
+            return out.shape
+
+        self._record(module, shape, out)
+        return out
+
+    def _propagate(self, module: nn.Module, shape: Shape) -> Union[Shape, LayerCost]:
+        """Returns the output shape of containers and the LayerCost of layers"""
+        if isinstance(module, OFAModel):
+            shape = self._visit_all(module.conv_layers[: module.active_depth], shape)
+            shape = self._visit_all(
+                [module.pool, module.flatten, module.dropout], shape
+            )
+            return self._visit(
+                module.get_output_linear_layer(module.active_depth), shape
+            )
+
+        if isinstance(module, ConvNet):
+            if hasattr(module, "activation_post_process"):
+                shape = self._visit(module.activation_post_process, shape)
+            return self._visit_all(
+                [
+                    module.convolutions,
+                    module.pooling,
+                    module.dropout,
+                    module.flatten,
+                    module.linear,
+                ],
+                shape,
+            )
+
+        if isinstance(module, tc.TCResNetModel):
+            shape = self._visit_all(module.layers, shape)
+            if not module.fully_convolutional:
+                shape = (shape[0], _prod(shape[1:]))
+            return self._visit_all([module.dropout, module.fc], shape)
+
+        if isinstance(module, tc.TCResidualBlock):
+            out = self._visit(module.convs, shape)
+            if module.stride > 1:
+                self._visit(module.downsample, shape)
+            return self._visit(module.act, out)
+
+        if isinstance(module, ReductionBlockAdd):
+            outputs = [self._visit(chain, shape) for chain in module.chains]
+            return self._visit(module.act, outputs[0])
+
+        if isinstance(module, ReductionBlockConcat):
+            outputs = [self._visit(chain, shape) for chain in module.chains]
+            channels = sum(out[1] for out in outputs)
+            return (outputs[0][0], channels) + outputs[0][2:]
+
+        if isinstance(module, ResBlockBase):
+            if module.skip is not None:
+                self._visit(module.skip, shape)
+            out = self._visit(module.blocks, shape)
+            if module.do_act:
+                out = self._visit(module.act, out)
+            if isinstance(module, ResBlock1d) and module.qconfig is not None:
+                out = self._visit(module.activation_post_process, out)
+            return out
+
+        if isinstance(module, nn.Sequential):
+            return self._visit_all(module, shape)
+
+        if isinstance(module, ElasticBase1d):
+            return self._elastic_conv(module, shape)
+
+        if isinstance(module, elastic_Linear_type):
+            in_features = sum(bool(f) for f in module.in_channel_filter)
+            out_features = sum(bool(f) for f in module.out_channel_filter)
+            return self._linear(shape, in_features, out_features)
+
+        if isinstance(module, nn.modules.conv._ConvNd) and not module.transposed:
+            return self._conv(
+                shape,
+                module.in_channels,
+                module.out_channels,
+                module.kernel_size,
+                module.stride,
+                module.padding,
+                module.dilation,
+                module.groups,
+            )
+
+        if isinstance(module, nn.Linear):
+            return self._linear(shape, module.in_features, module.out_features)
+
+        if isinstance(module, GLOBAL_POOLING_MODULES):
+            return shape[:2] + (1,) * len(shape[2:])
+
+        if isinstance(module, (nn.AdaptiveAvgPool1d, nn.AdaptiveAvgPool2d)):
+            size = _pair(module.output_size, len(shape[2:]))
+            size = tuple(s if o is None else o for s, o in zip(shape[2:], size))
+            return shape[:2] + size
+
+        if isinstance(
+            module, (nn.AvgPool1d, nn.AvgPool2d, nn.MaxPool1d, nn.MaxPool2d)
+        ) and not getattr(module, "ceil_mode", False):
+            stride = module.stride if module.stride is not None else module.kernel_size
+            return _conv_output_shape(
+                shape,
+                shape[1],
+                module.kernel_size,
+                stride,
+                module.padding,
+                getattr(module, "dilation", 1),
+            )
+
+        if isinstance(module, nn.Flatten):
+            dims = len(shape)
+            start = module.start_dim % dims
+            end = module.end_dim % dims
+            return shape[:start] + (_prod(shape[start : end + 1]),) + shape[end + 1 :]
+
+        if isinstance(module, POINTWISE_MODULES):
+            return shape
+
+        raise UnsupportedModuleError(
+            f"Can not derive the output shape of {type(module).__name__}"
+        )
+
+    @staticmethod
+    def _conv(
+        shape, in_channels, out_channels, kernel_size, stride, padding, dilation, groups
+    ):
+        out = _conv_output_shape(
+            shape, out_channels, kernel_size, stride, padding, dilation
+        )
+        weights = out_channels * in_channels / groups * _prod(kernel_size)
+        macs = _prod(out) * (in_channels / groups * _prod(kernel_size))
+        dims = len(shape[2:])
+        attrs = _conv_attrs(
+            _pair(kernel_size, dims), _pair(stride, dims), groups, _pair(dilation, dims)
+        )
+        return LayerCost(out, weights, macs, attrs)
+
+    def _elastic_conv(self, module: ElasticBase1d, shape: Shape):
+        kernel_size = module.kernel_sizes[module.target_kernel_index]
+        dilation = module.get_dilation_size()
+        return self._conv(
+            shape,
+            sum(bool(f) for f in module.in_channel_filter),
+            sum(bool(f) for f in module.out_channel_filter),
+            _pair(kernel_size, 1),
+            module.stride,
+            conv1d_get_padding(kernel_size, dilation),
+            _pair(dilation, 1),
+            module.get_group_size(),
+        )
+
+    @staticmethod
+    def _linear(shape, in_features, out_features):
+        weights = macs = in_features * out_features
+        return LayerCost(shape[:-1] + (out_features,), weights, macs, "")
+
+
+def architecture_fingerprint(model: nn.Module, input_shape: Sequence[int]) -> str:
+    """Hash of the layer structure and of the active configuration of elastic layers
+
+    Models with the same fingerprint have the same summary.
+    """
+    signature: List[Any] = [tuple(input_shape)]
+    for name, module in model.named_modules():
+        entry = [name, type(module).__name__]
+        for attr in (
+            "kernel_size",
+            "stride",
+            "padding",
+            "dilation",
+            "groups",
+            "output_size",
+            "fully_convolutional",
+            "do_act",
+            "active_depth",
+        ):
+            if hasattr(module, attr):
+                entry.append(getattr(module, attr))
+        for param_name, param in module.named_parameters(recurse=False):
+            entry.append((param_name, tuple(param.shape)))
+        if isinstance(module, _Elastic):
+            entry.append(sum(bool(f) for f in module.in_channel_filter))
+            entry.append(sum(bool(f) for f in module.out_channel_filter))
+        if isinstance(module, ElasticBase1d):
+            entry.append(module.kernel_sizes[module.target_kernel_index])
+            entry.append(module.get_dilation_size())
+            entry.append(module.get_group_size())
+        signature.append(tuple(entry))
+
+    return hashlib.sha1(repr(signature).encode()).hexdigest()
+
+
+_summary_cache: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+SUMMARY_CACHE_SIZE = 256
+
+
+def _hook_summary(model: nn.Module, dummy_input: torch.Tensor) -> pd.DataFrame:
+    # fused modules are collapsed, so that total_act does not depend on the
+    # summary method
+    if not isinstance(model, OFAModel):
+        return walk_model(model, dummy_input, collapse_fused=True)
+
+    if model.validation_model is None:
+        model.build_validation_model()
+    try:
+        return walk_model(model.validation_model, dummy_input, collapse_fused=True)
+    finally:
+        model.reset_validation_model()
+
+
+def summarize_model(model: nn.Module, dummy_input: torch.Tensor) -> pd.DataFrame:
+    """Layer summary of a model, memoized by the architecture fingerprint
+
+    The summary is computed analytically, models containing layers that are
+    not supported by AnalyticSummary fall back to the forward hooks of
+    walk_model. The returned data frame is shared between callers and must
+    not be modified.
+    """
+    key = architecture_fingerprint(model, dummy_input.shape)
+    if key in _summary_cache:
+        _summary_cache.move_to_end(key)
+        return _summary_cache[key]
+
+    try:
+        df = AnalyticSummary(model)(dummy_input.shape)
+    except UnsupportedModuleError as e:
+        msglogger.debug("Using forward hooks for model summary: %s", str(e))
+        df = _hook_summary(model, dummy_input)
+
+    _summary_cache[key] = df
+    if len(_summary_cache) > SUMMARY_CACHE_SIZE:
+        _summary_cache.popitem(last=False)
+
+    return df
+
+
 class MacSummaryCallback(Callback):
     def _do_summary(self, pl_module, print_log=True):
+        with region("mac_summary"):
+            return self._summary(pl_module, print_log)
+
+    def _summary(self, pl_module, print_log=True):
         dummy_input = pl_module.example_feature_array
         dummy_input = dummy_input.to(pl_module.device)
 
@@ -220,23 +615,14 @@ class MacSummaryCallback(Callback):
         total_acts = 0.0
         total_weights = 0.0
         estimated_acts = 0.0
-        model = pl_module.model
-        ofamodel = isinstance(model, OFAModel)
-        if ofamodel:
-            if model.validation_model is None:
-                model.build_validation_model()
-            model = model.validation_model
-
         try:
-            df = walk_model(model, dummy_input)
-            if ofamodel:
-                pl_module.model.reset_validation_model()
-            t = tabulate(df, headers="keys", tablefmt="psql", floatfmt=".5f")
+            df = summarize_model(pl_module.model, dummy_input)
             total_macs = df["MACs"].sum()
             total_acts = df["IFM volume"][0] + df["OFM volume"].sum()
             total_weights = df["Weights volume"].sum()
             estimated_acts = 2 * max(df["IFM volume"].max(), df["OFM volume"].max())
             if print_log:
+                t = tabulate(df, headers="keys", tablefmt="psql", floatfmt=".5f")
                 msglogger.info("\n" + str(t))
                 msglogger.info("Total MACs: " + "{:,}".format(total_macs))
                 msglogger.info("Total Weights: " + "{:,}".format(total_weights))
@@ -245,8 +631,6 @@ class MacSummaryCallback(Callback):
                     "Estimated Activations: " + "{:,}".format(estimated_acts)
                 )
         except RuntimeError as e:
-            if ofamodel:
-                pl_module.model.reset_validation_model()
             msglogger.warning("Could not create performance summary: %s", str(e))
             return OrderedDict()
 
@@ -17,10 +17,12 @@
 # limitations under the License.
 #
 import csv
+import json
 import logging
 import os
 import random
 import shutil
+from concurrent.futures import as_completed
 
 import numpy as np
 import pandas as pd
@@ -29,9 +31,58 @@ from pandas import DataFrame
 from torchvision.datasets.utils import list_dir
 
 from ..utils import extract_from_download_cache, list_all_files
-from .Downsample import Downsample
+from .Downsample import Downsample, create_prepare_pool
 from .NoiseDataset import NoiseDataset
 
+SPLIT_HEADER = [
+    "filename",
+    "original_path",
+    "downsampled_path",
+    "sr_orig",
+    "sr_down",
+    "allocation",
+]
+
+
+def _convert_file(task):
+    """Converts a single file of a split and returns its row of the split csv
+
+    Runs in the worker processes of the preparation pool.
+    """
+    key, f, old, dest_sr, noise_dir, speech_dir = task
+    torchaudio.set_audio_backend("sox_io")
+    f_info = torchaudio.backend.sox_io_backend.info(f)
+    filename = os.path.basename(f)
+
+    old_orig_sr = -1
+    old_down_sr = -1
+    if old is not None:
+        old_orig_sr = DatasetSplit.convert_number(old.get("sr_orig"))
+        old_down_sr = DatasetSplit.convert_number(old.get("sr_down"))
+
+    target_path = ""
+    downsampled_sr = ""
+
+    if (
+        old_orig_sr != dest_sr
+        and old_down_sr != dest_sr
+        and (dest_sr != f_info.sample_rate or f_info.num_channels != 1)
+    ):
+        if "noise" in key:
+            target_path = os.path.join(noise_dir, filename)
+        elif "speech" in key:
+            target_path = os.path.join(speech_dir, filename)
+        else:
+            target_path = None
+
+        target_path = Downsample.downsample_file(f, target_path, dest_sr)
+        downsampled_sr = str(dest_sr)
+    elif old is not None and old_down_sr == dest_sr:
+        target_path = old.get("downsampled_path")
+        downsampled_sr = dest_sr
+
+    return [filename, f, target_path, f_info.sample_rate, downsampled_sr, key]
+
 
 class DatasetSplit:
     def __init__(self):
@@ -192,8 +243,6 @@ class DatasetSplit:
             logging.info("split data begins current_split: %s", data_split)
             data_folder = config["data_folder"]
 
-            destination_dict = split_methods[splits.index(data_split)](config)
-
             dest_sr = config.get("samplingrate", 16000)
 
             downsample_dir = DatasetSplit.create_folder(data_folder, "downsampled")
@@ -215,69 +264,162 @@ class DatasetSplit:
             else:
                 split_filename = os.path.join(data_folder, split_filename)
 
-            output = cls.file_conversion_handling(
-                dest_sr, destination_dict, oldsplit, noise_dir, speech_dir
+            # An interrupted preparation is resumed with the allocation of
+            # files it has started with
+            destination_dict = cls.load_manifest(split_filename)
+            if destination_dict is None:
+                destination_dict = split_methods[splits.index(data_split)](config)
+                cls.write_manifest(split_filename, destination_dict)
+
+            num_workers = config.get("prepare_workers", os.cpu_count() or 1)
+            cls.file_conversion_handling(
+                dest_sr,
+                destination_dict,
+                oldsplit,
+                noise_dir,
+                speech_dir,
+                split_filename=split_filename,
+                num_workers=num_workers,
             )
 
-            DatasetSplit.write_split(split_filename, output)
             DatasetSplit.release(lockfile)
 
     @classmethod
     def file_conversion_handling(
-        cls, dest_sr, destination_dict, oldsplit, noise_dir, speech_dir
+        cls,
+        dest_sr,
+        destination_dict,
+        oldsplit,
+        noise_dir,
+        speech_dir,
+        split_filename=None,
+        num_workers=1,
     ):
-        torchaudio.set_audio_backend("sox_io")
+        """Converts the files of a split to the destination sampling rate
+
+        The conversion of the files is distributed to `num_workers` processes.
+        If `split_filename` is given, rows are appended to `<split_filename>.partial`
+        as soon as a file is converted and files already listed there are skipped,
+        so an interrupted preparation resumes where it stopped. The finished
+        partial file is then moved to `split_filename`.
+
+        Returns:
+            list: the rows of the split csv
+        """
         output = list()
+        done = set()
+        partial_file = None
+        writer = None
+        if split_filename is not None:
+            partial_filename = split_filename + ".partial"
+            output = cls.read_partial_split(partial_filename)
+            done = set((row[5], row[1]) for row in output)
+            if done:
+                logging.info("Resuming preparation of %s", split_filename)
+            # rewrite the partial file, as its last row might be truncated
+            partial_file = open(partial_filename, mode="w")
+            writer = csv.writer(partial_file, delimiter=",")
+            writer.writerow(SPLIT_HEADER)
+            writer.writerows(output)
+
+        tasks = list()
         for key, value in destination_dict.items():
             for f in value:
-                f_info = torchaudio.backend.sox_io_backend.info(f)
                 filename = os.path.basename(f)
-
                 old = oldsplit.pop(filename, None)
-                old_orig_sr = -1
-                old_down_sr = -1
-                if old is not None:
-                    old_orig_sr = DatasetSplit.convert_number(old.get("sr_orig"))
-                    old_down_sr = DatasetSplit.convert_number(old.get("sr_down"))
-
-                target_path = ""
-                downsampled_sr = ""
-
-                if (
-                    old_orig_sr != dest_sr
-                    and old_down_sr != dest_sr
-                    and (dest_sr != f_info.sample_rate or f_info.num_channels != 1)
-                ):
-                    if "noise" in key:
-                        target_path = os.path.join(noise_dir, filename)
-                    elif "speech" in key:
-                        target_path = os.path.join(speech_dir, filename)
-                    else:
-                        target_path = None
-
-                    target_path = Downsample.downsample_file(f, target_path, dest_sr)
-                    downsampled_sr = str(dest_sr)
-                elif old is not None and old_down_sr == dest_sr:
-                    target_path = old.get("downsampled_path")
-                    downsampled_sr = dest_sr
-
-                output.append(
-                    [filename, f, target_path, f_info.sample_rate, downsampled_sr, key]
+                if (key, f) in done:
+                    continue
+                tasks.append((key, f, old, dest_sr, noise_dir, speech_dir))
+
+        def append(row):
+            output.append(row)
+            if writer is not None:
+                writer.writerow(row)
+                partial_file.flush()
+
+        try:
+            if num_workers <= 1:
+                for task in tasks:
+                    append(_convert_file(task))
+            else:
+                with create_prepare_pool(num_workers) as pool:
+                    futures = [pool.submit(_convert_file, task) for task in tasks]
+                    for num, future in enumerate(as_completed(futures)):
+                        append(future.result())
+                        if num % 1000 == 0:
+                            logging.info("Converted %d/%d files", num, len(futures))
+
+            for element in oldsplit.keys():
+                tmp = oldsplit[element]
+                append(
+                    [
+                        tmp["filename"],
+                        tmp["original_path"],
+                        tmp["downsampled_path"],
+                        tmp["sr_orig"],
+                        tmp["sr_down"],
+                        "",
+                    ]
                 )
-        for element in oldsplit.keys():
-            tmp = oldsplit[element]
-            output.append(
-                [
-                    tmp["filename"],
-                    tmp["original_path"],
-                    tmp["downsampled_path"],
-                    tmp["sr_orig"],
-                    tmp["sr_down"],
-                    "",
-                ]
-            )
+        finally:
+            if partial_file is not None:
+                partial_file.close()
+
+        if split_filename is not None:
+            os.replace(split_filename + ".partial", split_filename)
+            cls.remove_manifest(split_filename)
+
         return output
 
+    @classmethod
+    def read_partial_split(cls, partial_filename):
+        """Reads the rows of an interrupted preparation"""
+        rows = list()
+        if not os.path.isfile(partial_filename):
+            return rows
+        with open(partial_filename, mode="r") as partial_file:
+            reader = csv.reader(partial_file, delimiter=",")
+            for num, row in enumerate(reader):
+                # the last row may be truncated if the preparation was killed
+                if num == 0 or len(row) != len(SPLIT_HEADER):
+                    continue
+                rows.append(row)
+        return rows
+
+    @classmethod
+    def manifest_filename(cls, split_filename):
+        return split_filename + ".manifest.json"
+
+    @classmethod
+    def load_manifest(cls, split_filename):
+        """Returns the file allocation of an interrupted preparation or None"""
+        manifest = cls.manifest_filename(split_filename)
+        if not os.path.isfile(manifest):
+            return None
+        try:
+            with open(manifest, mode="r") as f:
+                return json.load(f)
+        except ValueError:
+            logging.warning("Ignoring corrupted manifest %s", manifest)
+            return None
+
+    @classmethod
+    def write_manifest(cls, split_filename, destination_dict):
+        manifest = cls.manifest_filename(split_filename)
+        with open(manifest + ".tmp", mode="w") as f:
+            json.dump({k: list(v) for k, v in destination_dict.items()}, f)
+        os.replace(manifest + ".tmp", manifest)
+
+        # A partial split of a different allocation can not be resumed
+        if os.path.isfile(split_filename + ".partial"):
+            os.remove(split_filename + ".partial")
+
+    @classmethod
+    def remove_manifest(cls, split_filename):
+        manifest = cls.manifest_filename(split_filename)
+        if os.path.isfile(manifest):
+            os.remove(manifest)
+
     @classmethod
     def convert_number(cls, text):
         output = -1
@@ -359,18 +501,9 @@ class DatasetSplit:
 
     @classmethod
     def write_split(cls, output_path, data):
-        header = [
-            "filename",
-            "original_path",
-            "downsampled_path",
-            "sr_orig",
-            "sr_down",
-            "allocation",
-        ]
-
         with open(output_path, mode="w") as output_file:
             writer = csv.writer(output_file, delimiter=",")
-            writer.writerow(header)
+            writer.writerow(SPLIT_HEADER)
             writer.writerows(data)
 
     @classmethod
@@ -16,8 +16,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import functools
 import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import torchaudio
@@ -28,6 +31,34 @@ from ..utils import list_all_files
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=16)
+def get_resampler(orig_sr: int, target_sr: int) -> torchaudio.transforms.Resample:
+    """Returns a cached resampler for a pair of sampling rates
+
+    Building the resampling kernel is expensive, so every process keeps one
+    resampler per (orig_sr, target_sr) pair.
+    """
+    return torchaudio.transforms.Resample(orig_sr, target_sr)
+
+
+def _resample_inplace(filename: str, samplerate: int) -> None:
+    torchaudio.set_audio_backend("sox_io")
+    data, sr = torchaudio.load(filename)
+    if sr != samplerate:
+        data = get_resampler(sr, samplerate).forward(data)
+    if filename.endswith("mp3"):
+        os.remove(filename)
+        filename = filename.replace(".mp3", ".wav")
+    torchaudio.save(filename, data[0].unsqueeze(0), samplerate)
+
+
+def create_prepare_pool(num_workers: int) -> ProcessPoolExecutor:
+    """Creates the process pool used for dataset preparation"""
+    return ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
 class Downsample:
     def __init__(self):
         pass
@@ -37,12 +68,11 @@ class Downsample:
         assert targetpath is not None
         torchaudio.set_audio_backend("sox_io")
         data, sr = torchaudio.load(sourcepath)
-        f_info = torchaudio.backend.sox_io_backend.info(sourcepath)
         changed = False
         if target_sr != sr:
-            data = torchaudio.transforms.Resample(sr, target_sr).forward(data)
+            data = get_resampler(sr, target_sr).forward(data)
             changed = True
-        elif f_info.num_channels != 1:
+        elif data.shape[0] != 1:
             changed = True
 
         if targetpath.endswith("mp3"):
@@ -87,25 +117,17 @@ class Downsample:
                         files.extend(list_all_files(downsample_folder, ".MP3", True))
                         files.extend(list_all_files(downsample_folder, ".WAV", True))
 
-            stepsize = 300
-            n_splits = len(files) / stepsize
-            files_split = np.array_split(np.array(files), n_splits)
-            for parts in files_split:
-                tmp_files = list()
-                output_files = list()
-
-                for filename in parts:
-                    tmp_files.append(torchaudio.load(filename))
-
-                for (data, sr) in tmp_files:
-                    data = torchaudio.transforms.Resample(sr, samplerate).forward(data)
-                    output_files.append(data)
-
-                for data, filename in zip(output_files, parts):
-                    if filename.endswith("mp3"):
-                        os.system("rm " + filename)
-                        filename = filename.replace(".mp3", ".wav")
-                    torchaudio.save(filename, data[0].unsqueeze(0), samplerate)
-
-                del tmp_files
-                del output_files
+            num_workers = config.get("prepare_workers", os.cpu_count() or 1)
+            if num_workers <= 1:
+                for filename in files:
+                    _resample_inplace(filename, samplerate)
+                return
+
+            with create_prepare_pool(num_workers) as pool:
+                for _ in pool.map(
+                    _resample_inplace,
+                    files,
+                    [samplerate] * len(files),
+                    chunksize=16,
+                ):
+                    pass
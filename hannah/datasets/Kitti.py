@@ -20,12 +20,9 @@ import csv
 import logging
 import math
 import os
-import shutil
 import sys
+import tempfile
 
-import matplotlib.image as mpimg
-import matplotlib.patches as patches
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from torch.functional import Tensor
@@ -46,8 +43,6 @@ class Kitti(AbstractDataset):
 
     IMAGE_PATH = os.path.join("training/image_2/")
 
-    AUG_PATH_CPY = os.path.join("/augmented_2/")
-
     AUG_PATH = os.path.join("/augmented/")
 
     LABEL_PATH = os.path.join("training", "label_2/")
@@ -66,10 +61,12 @@ class Kitti(AbstractDataset):
         self.kitti_dir = config["kitti_folder"]
         self.img_path = os.path.join(self.kitti_dir, self.IMAGE_PATH)
         self.aug_path = os.getcwd() + self.AUG_PATH
-        self.aug_path_cpy = os.getcwd() + self.AUG_PATH_CPY
         self.label_path = os.path.join(self.kitti_dir, self.LABEL_PATH)
         self.img_files = list(data.keys())
-        self.aug_files = list()
+        # augmented images are published as links in this folder, see augmented_file
+        self.aug_index_path = os.path.join(
+            self.aug_path, "ready", set_type.name.lower()
+        )
         self.label_files = list(data.values())
         self.labels_ignore = (
             config["labels_ignore"] if config["labels_ignore"] is not None else [0]
@@ -117,6 +114,13 @@ class Kitti(AbstractDataset):
             self.kitti_dir,
         )
 
+        self._build_annotation_index()
+
+        self._img_cache = None
+        self._img_cache_shape = None
+        if config.get("image_cache", False):
+            self._create_image_cache()
+
     @classmethod
     def prepare(cls, config):
         pass
@@ -132,61 +136,127 @@ class Kitti(AbstractDataset):
     def __len__(self):
         return len(self.img_files)
 
-    def __getitem__(self, idx):
-        img_name = self.img_files[idx]
+    def augmented_file(self, name):
+        """Returns the path of the augmented version of an image or None
 
-        if img_name[:-4] in self.aug_files and os.path.isfile(self.aug_path + img_name):
-            path = self.aug_path
-            label_path = self.label_path
-            shutil.copy2(self.aug_path + img_name, self.aug_path_cpy + img_name)
-        elif self.set_type == DatasetType.TEST:
+        The augmentation engine publishes finished images as symbolic links to its
+        cache in `aug_index_path`. As the links live on disk, they are also seen
+        by forked dataloader workers while the augmentation is still running.
+        """
+        link = os.path.join(self.aug_index_path, name)
+        if os.path.isfile(link):
+            return link
+        return None
+
+    def _resolve_paths(self, img_name):
+        """Returns image folder, label folder and file name of an image"""
+        if self.set_type == DatasetType.TEST:
             if "rr/" in img_name:
-                path = self.realrain_imgpath
-                label_path = self.realrain_labelpath
-                img_name = img_name[3:]
+                return self.realrain_imgpath, self.realrain_labelpath, img_name[3:]
             elif "dr/" in img_name:
-                path = self.dawn_rain_imgpath
-                label_path = self.dawn_rain_labelpath
-                img_name = img_name[3:]
+                return self.dawn_rain_imgpath, self.dawn_rain_labelpath, img_name[3:]
             elif "ds/" in img_name:
-                path = self.dawn_snow_imgpath
-                label_path = self.dawn_snow_labelpath
-                img_name = img_name[3:]
+                return self.dawn_snow_imgpath, self.dawn_snow_labelpath, img_name[3:]
             elif "df/" in img_name:
-                path = self.dawn_fog_imgpath
-                label_path = self.dawn_fog_labelpath
-                img_name = img_name[3:]
-            else:
-                path = self.img_path
-                label_path = self.label_path
-        else:
-            path = self.img_path
-            label_path = self.label_path
+                return self.dawn_fog_imgpath, self.dawn_fog_labelpath, img_name[3:]
 
-        pil_img = Image.open(path + img_name).convert("RGB")
-        # pil_img = pil_img.resize(self.img_size)
-        pil_img = self.transform(pil_img)
+        return self.img_path, self.label_path, img_name
 
-        target = {}
-        label = self._parse_label(
-            idx, True if self.set_type == DatasetType.TRAIN else False, label_path
-        )
+    def _build_annotation_index(self):
+        """Parses the labels of all images once into flat arrays
 
-        labels = []
+        The annotations of image idx are
+        `self.ann_types[self.ann_offsets[idx] : self.ann_offsets[idx + 1]]` and
+        the corresponding rows of `self.ann_boxes`.
+        """
+        considerDC = self.set_type == DatasetType.TRAIN
+        types = []
         boxes = []
+        offsets = [0]
+        for idx, img_name in enumerate(self.img_files):
+            _, label_path, _ = self._resolve_paths(img_name)
+            for la in self._parse_label(idx, considerDC, label_path):
+                types.append(la["type"])
+                boxes.append(la["bbox"])
+            offsets.append(len(types))
+
+        self.ann_types = np.asarray(types, dtype=np.int64)
+        self.ann_boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.ann_offsets = np.asarray(offsets, dtype=np.int64)
+
+    def _create_image_cache(self):
+        """Creates a cache for decoded images, that is shared with forked dataloader workers
+
+        The cache is backed by a sparse file in /dev/shm if available, so memory
+        is only allocated for images that have actually been loaded.
+        """
+        height, width = self.img_size
+        cache_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+        with tempfile.NamedTemporaryFile(dir=cache_dir) as f:
+            self._img_cache = np.memmap(
+                f,
+                dtype=np.uint8,
+                mode="w+",
+                shape=(len(self.img_files), height, width, 3),
+            )
+        with tempfile.NamedTemporaryFile(dir=cache_dir) as f:
+            # height and width of the cached image, zero if not cached
+            self._img_cache_shape = np.memmap(
+                f, dtype=np.int32, mode="w+", shape=(len(self.img_files), 2)
+            )
+
+    def _load_image(self, idx, img_file, augmented):
+        if self._img_cache is None or augmented:
+            return Image.open(img_file).convert("RGB")
+
+        height, width = self._img_cache_shape[idx]
+        if height > 0:
+            return self._img_cache[idx, :height, :width]
+
+        pil_img = Image.open(img_file).convert("RGB")
+        width, height = pil_img.size
+        if height > self._img_cache.shape[1] or width > self._img_cache.shape[2]:
+            return pil_img
+
+        self._img_cache[idx, :height, :width] = np.asarray(pil_img)
+        self._img_cache_shape[idx] = (height, width)
+
+        return self._img_cache[idx, :height, :width]
+
+    def __getitem__(self, idx):
+        img_name = self.img_files[idx]
 
-        for la in label:
-            boxes.append(torch.Tensor(la.get("bbox")))
-            labels.append(torch.tensor(la.get("type"), dtype=torch.long))
-            self.cocoGt.addAnn(idx, la.get("type"), la.get("bbox"))
+        aug_file = self.augmented_file(img_name[:-4])
 
-        target["boxes"] = torch.stack(boxes)
-        target["labels"] = torch.stack(labels)
+        path, label_path, file_name = self._resolve_paths(img_name)
+        augmented = aug_file is not None
+        if augmented:
+            path = self.aug_path
+            img_file = aug_file
+        else:
+            img_file = path + file_name
+
+        img = self._load_image(idx, img_file, augmented)
+        # pil_img = pil_img.resize(self.img_size)
+        img = self.transform(img)
+
+        start, end = self.ann_offsets[idx], self.ann_offsets[idx + 1]
+        types = self.ann_types[start:end]
+        boxes = self.ann_boxes[start:end]
+
+        for cat, box in zip(types.tolist(), boxes.tolist()):
+            self.cocoGt.addAnn(idx, cat, box)
+
+        target = {}
+        target["boxes"] = torch.tensor(boxes)
+        target["labels"] = torch.tensor(types, dtype=torch.long)
         target["filename"] = self.img_files[idx]
         target["path"] = path
+        target["img_file"] = img_file
         target["label_path"] = label_path
 
-        return pil_img, target
+        return img, target
 
     def getCocoGt(self):
         return self.cocoGt
@@ -224,7 +294,6 @@ class Kitti(AbstractDataset):
         folder = config["kitti_folder"]
         folder = os.path.join(folder, "training")
         aug_folder = os.getcwd() + Kitti.AUG_PATH
-        aug_folder_cpy = os.getcwd() + Kitti.AUG_PATH_CPY
         folder = os.path.join(folder, "image_2/")
         files = sorted(
             filter(
@@ -238,22 +307,9 @@ class Kitti(AbstractDataset):
         datasets = [{}, {}, {}]
 
         if "real_rain" not in folder and "DAWN" not in folder:
-            if not os.path.exists(aug_folder_cpy) or not os.path.isdir(aug_folder_cpy):
-                os.mkdir(aug_folder_cpy)
-
             if not os.path.exists(aug_folder) or not os.path.isdir(aug_folder):
                 os.mkdir(aug_folder)
 
-            f = open(
-                config["kitti_folder"] + "/augmentation/perform_augmentation.sh", "r"
-            )
-            f = f.read()
-            f = f[: f.rfind("-x") + 3] + aug_folder + "augment.xml"
-            with open(aug_folder + "perform_augmentation.sh", "w") as s:
-                s.write(f)
-                s.close()
-            os.chmod(aug_folder + "perform_augmentation.sh", 0o777)
-
         for i in range(num_imgs):
             if i < num_dev_imgs:
                 img_name = files[i]
@@ -366,6 +422,8 @@ class KittiCOCO(COCO):
         dataset["categories"] = []
         dataset["annotations"] = []
 
+        self._img_ids = dict()
+
         i = 0
         for img in img_files:
             img_dict = dict()
@@ -374,6 +432,7 @@ class KittiCOCO(COCO):
             img_dict["height"] = img_size[0]
             img_dict["filename"] = img
             dataset["images"].append(img_dict)
+            self._img_ids[img] = i
             i += 1
 
         for label, no in zip(label_names, range(len(label_names))):
@@ -402,70 +461,7 @@ class KittiCOCO(COCO):
         self.dataset["annotations"] = []
 
     def getImgId(self, filename):
-        for img in range(len(self.imgs)):
-            if self.imgs[img]["filename"] == filename:
-                return self.imgs[img]["id"]
-
-    def saveImg(self, cocoDt, y):
-
-        for y_img in y:
-            path = y_img["path"]
-            filename = y_img["filename"]
-            cocoImg = self.getImgId(filename)
-            img = mpimg.imread(
-                path + filename if "/" not in filename else path + filename[3:]
-            )
-            fig, ax = plt.subplots()
-            ax.imshow(img)
-
-            annsGt = self.loadAnns(self.getAnnIds(imgIds=cocoImg))
-            annsDt = cocoDt.loadAnns(cocoDt.getAnnIds(imgIds=cocoImg))
-
-            if annsDt == []:
-                print("")
-
-            for ann in annsGt:
-                if self.cats[ann["category_id"]]["id"] not in KittiCOCO.labels_ignore:
-                    box = ann["bbox"]
-                    rect = patches.Rectangle(
-                        (box[0], box[1]),
-                        box[2],
-                        box[3],
-                        linewidth=1,
-                        edgecolor="b",
-                        facecolor="none",
-                    )
-                    ax.add_patch(rect)
-
-            for ann in annsDt:
-                if self.cats[ann["category_id"]]["id"] not in KittiCOCO.labels_ignore:
-                    box = ann["bbox"]
-                    rect = patches.Rectangle(
-                        (box[0], box[1]),
-                        box[2],
-                        box[3],
-                        linewidth=1,
-                        edgecolor="r",
-                        facecolor="none",
-                    )
-                    ax.text(
-                        box[0],
-                        box[1],
-                        self.cats[ann["category_id"]]["name"]
-                        if ann["category_id"] in self.cats
-                        else "undefined",
-                        color="red",
-                        fontsize=10,
-                    )
-                    ax.add_patch(rect)
-
-            if not os.path.exists("./ann"):
-                os.makedirs("./ann")
-
-            plt.savefig(
-                "./ann/" + filename if "/" not in filename else "./ann/" + filename[3:]
-            )
-            plt.close()
+        return self._img_ids.get(filename)
 
     @staticmethod
     def dontCareMatch(box: Tensor, size, img: Tensor):
@@ -531,5 +527,28 @@ class KittiCOCO(COCO):
         return False
 
 
+def pack_targets(targets):
+    """Packs the boxes and labels of a batch of targets into padded tensors
+
+    Returns:
+        dict with keys
+            boxes: (batch, max_boxes, 4) boxes in x1, y1, x2, y2 format
+            labels: (batch, max_boxes) labels, padding entries are -1
+            counts: (batch,) number of valid boxes per image
+    """
+    counts = [len(target["labels"]) for target in targets]
+    max_boxes = max(counts, default=0)
+
+    boxes = torch.zeros(len(targets), max_boxes, 4)
+    labels = torch.full((len(targets), max_boxes), -1, dtype=torch.long)
+    for i, (target, count) in enumerate(zip(targets, counts)):
+        boxes[i, :count] = target["boxes"]
+        labels[i, :count] = target["labels"]
+
+    return {"boxes": boxes, "labels": labels, "counts": torch.tensor(counts)}
+
+
 def object_collate_fn(data):
-    return tuple(zip(*data))
+    """Collates images and targets into tuples and additionally packs the targets using :func:`pack_targets`"""
+    images, targets = tuple(zip(*data))
+    return images, targets, pack_targets(targets)
@@ -228,26 +228,130 @@ class PAMAP2_DataChunk:
         return self.label
 
 
+class PAMAP2_Store:
+    """Consolidated sample store of the prepared PAMAP2 dataset
+
+    All recordings are stored back to back in a single float32 array file
+    (`data.f32`) of shape (rows, channels). `index.npz` contains for each
+    recording its name, subject, label and the offset and length of its rows.
+    """
+
+    DATA_FILE = "data.f32"
+    INDEX_FILE = "index.npz"
+
+    def __init__(self, folder):
+        self.folder = folder
+        with np.load(os.path.join(folder, self.INDEX_FILE)) as index:
+            self.names = index["names"]
+            self.subjects = index["subjects"]
+            self.labels = index["labels"]
+            self.offsets = index["offsets"]
+            self.lengths = index["lengths"]
+            self.shape = tuple(index["shape"])
+
+    @classmethod
+    def exists(cls, folder):
+        return os.path.isfile(os.path.join(folder, cls.INDEX_FILE))
+
+    @classmethod
+    def open_data(cls, folder, shape):
+        # copy on write, so that torch gets writable arrays without copying
+        return np.memmap(
+            os.path.join(folder, cls.DATA_FILE), dtype=np.float32, mode="c", shape=shape
+        )
+
+    def chunks(self, recording, input_length):
+        """Returns the start rows of the chunks of a recording"""
+        length = self.lengths[recording]
+        offset = self.offsets[recording]
+        return [
+            offset + i
+            for i in range(0, length, input_length)
+            if not i + input_length >= length - 1
+        ]
+
+
+class PAMAP2_StoreWriter:
+    """Appends recordings to a consolidated sample store"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.names = list()
+        self.subjects = list()
+        self.labels = list()
+        self.offsets = list()
+        self.lengths = list()
+        self.rows = 0
+        self.channels = 0
+        self._data_file = open(
+            os.path.join(folder, PAMAP2_Store.DATA_FILE + ".tmp"), "wb"
+        )
+
+    def append(self, name, subject, data, label):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        self.names.append(name)
+        self.subjects.append(subject)
+        self.labels.append(int(label))
+        self.offsets.append(self.rows)
+        self.lengths.append(data.shape[0])
+        self.rows += data.shape[0]
+        self.channels = data.shape[1]
+        self._data_file.write(data.tobytes())
+
+    def close(self):
+        self._data_file.close()
+        os.replace(
+            os.path.join(self.folder, PAMAP2_Store.DATA_FILE + ".tmp"),
+            os.path.join(self.folder, PAMAP2_Store.DATA_FILE),
+        )
+
+        # The index is written last, it marks the store as complete
+        index_tmp = os.path.join(self.folder, PAMAP2_Store.INDEX_FILE + ".tmp")
+        with open(index_tmp, "wb") as f:
+            np.savez(
+                f,
+                names=np.array(self.names, dtype=str),
+                subjects=np.array(self.subjects, dtype=str),
+                labels=np.array(self.labels, dtype=np.int64),
+                offsets=np.array(self.offsets, dtype=np.int64),
+                lengths=np.array(self.lengths, dtype=np.int64),
+                shape=np.array([self.rows, self.channels], dtype=np.int64),
+            )
+        os.replace(index_tmp, os.path.join(self.folder, PAMAP2_Store.INDEX_FILE))
+
+
 class PAMAP2_Dataset(AbstractDataset):
     """Class for the PAMAP2 activity dataset
     https://archive.ics.uci.edu/ml/datasets/pamap2+physical+activity+monitoring"""
 
-    def __init__(self, data_files, set_type, config):
+    def __init__(self, store, starts, labels, set_type, config):
         super().__init__()
-        self.data_files = data_files
+        self.folder = store.folder
+        self.shape = store.shape
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.int64)
         self.channels = 40
         self.input_length = config["input_length"]
         self.label_names = PAMAP2_Dataset.get_class_names()
+        self._data = None
+
+    def __getstate__(self):
+        # Each dataloader worker maps the sample store on its own
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
 
     def __getitem__(self, item):
-        path, start = self.data_files[item]
-        chunk = PAMAP2_DataChunk(path, start=start, stop=start + self.input_length)
-        data = chunk.get_tensor().transpose(1, 0)
-        label = chunk.get_label_tensor()
+        if self._data is None:
+            self._data = PAMAP2_Store.open_data(self.folder, self.shape)
+        start = self.starts[item]
+        data = torch.from_numpy(self._data[start : start + self.input_length])
+        data = data.transpose(1, 0)
+        label = torch.tensor([self.labels[item]], dtype=torch.long)
         return data, data.shape[0], label, label.shape[0]
 
     def __len__(self):
-        return len(self.data_files)
+        return len(self.starts)
 
     @classmethod
     def get_num_classes(cls):
@@ -257,6 +361,13 @@ class PAMAP2_Dataset(AbstractDataset):
     def prepare(cls, config: Dict[str, Any]) -> None:
         cls.download(config)
 
+        # Datasets prepared by previous versions only contain the hdf5 files
+        folder_prepared = os.path.join(
+            config["data_folder"], "pamap2", "pamap2_prepared"
+        )
+        if os.path.isdir(folder_prepared) and not PAMAP2_Store.exists(folder_prepared):
+            cls.consolidate_files(folder_prepared)
+
     @staticmethod
     def get_class_names():
         return [
@@ -270,12 +381,8 @@ class PAMAP2_Dataset(AbstractDataset):
 
     @property
     def class_counts(self) -> Optional[Dict[int, int]]:
-        counts = defaultdict(int)
-        for path, start in self.data_files:
-            chunk = PAMAP2_DataChunk(path, start=start, stop=start + self.input_length)
-            label = chunk.get_label()
-            counts[label] += 1
-        return counts
+        counts = np.bincount(self.labels)
+        return {label: int(count) for label, count in enumerate(counts) if count > 0}
 
     @classmethod
     def splits(cls, config):
@@ -285,36 +392,34 @@ class PAMAP2_Dataset(AbstractDataset):
         input_length = config["input_length"]
 
         folder = os.path.join(config["data_folder"], "pamap2", "pamap2_prepared")
-
-        sets = [[], [], []]
-
-        for root, dirs, files in os.walk(folder):
-            for file_name in files:
-                path = os.path.join(root, file_name)
-                with h5py.File(path, "r") as f:
-                    length = len(f["dataset"][()])
-                max_no_files = 2**27 - 1
-                start = 0
-                stop = length
-                step = input_length
-                for i in range(start, stop, step):
-                    if i + step >= stop - 1:
-                        continue
-                    chunk_hash = f"{path}{i}"
-                    bucket = int(hashlib.sha1(chunk_hash.encode()).hexdigest(), 16)
-                    bucket = (bucket % (max_no_files + 1)) * (100.0 / max_no_files)
-                    if bucket < dev_pct:
-                        tag = DatasetType.DEV
-                    elif bucket < test_pct + dev_pct:
-                        tag = DatasetType.TEST
-                    else:
-                        tag = DatasetType.TRAIN
-                    sets[tag.value] += [(path, i)]
+        store = PAMAP2_Store(folder)
+
+        sets = [([], []), ([], []), ([], [])]
+
+        max_no_files = 2**27 - 1
+        for recording, name in enumerate(store.names):
+            # chunks are assigned by the path of the recording, so the splits
+            # are identical to the ones of the previous per file hdf5 layout
+            path = os.path.join(folder, name)
+            offset = store.offsets[recording]
+            label = store.labels[recording]
+            for start in store.chunks(recording, input_length):
+                chunk_hash = f"{path}{start - offset}"
+                bucket = int(hashlib.sha1(chunk_hash.encode()).hexdigest(), 16)
+                bucket = (bucket % (max_no_files + 1)) * (100.0 / max_no_files)
+                if bucket < dev_pct:
+                    tag = DatasetType.DEV
+                elif bucket < test_pct + dev_pct:
+                    tag = DatasetType.TEST
+                else:
+                    tag = DatasetType.TRAIN
+                sets[tag.value][0].append(start)
+                sets[tag.value][1].append(label)
 
         datasets = (
-            cls(sets[DatasetType.TRAIN.value], DatasetType.TRAIN, config),
-            cls(sets[DatasetType.DEV.value], DatasetType.DEV, config),
-            cls(sets[DatasetType.TEST.value], DatasetType.TEST, config),
+            cls(store, *sets[DatasetType.TRAIN.value], DatasetType.TRAIN, config),
+            cls(store, *sets[DatasetType.DEV.value], DatasetType.DEV, config),
+            cls(store, *sets[DatasetType.TEST.value], DatasetType.TEST, config),
         )
         return datasets
 
@@ -324,28 +429,20 @@ class PAMAP2_Dataset(AbstractDataset):
         input_length = config["input_length"]
 
         folder = os.path.join(config["data_folder"], "pamap2", "pamap2_prepared")
+        store = PAMAP2_Store(folder)
 
-        sets_by_subject = defaultdict(list)
-
-        for root, dirs, files in os.walk(folder):
-            subject_folder, _ = os.path.split(root)
-            _, subject_id = os.path.split(subject_folder)
-            for file_name in files:
-                path = os.path.join(root, file_name)
-                with h5py.File(path, "r") as f:
-                    length = len(f["dataset"][()])
-                start = 0
-                stop = length
-                step = input_length
-                for i in range(start, stop, step):
-                    if i + step >= stop - 1:
-                        continue
+        sets_by_subject = defaultdict(lambda: ([], []))
 
-                    sets_by_subject[subject_id] += [(path, i)]
+        for recording, subject_id in enumerate(store.subjects):
+            starts = store.chunks(recording, input_length)
+            sets_by_subject[subject_id][0].extend(starts)
+            sets_by_subject[subject_id][1].extend(
+                [store.labels[recording]] * len(starts)
+            )
 
         return [
-            cls(files, DatasetType.TRAIN.value, config)
-            for files in sets_by_subject.values()
+            cls(store, starts, labels, DatasetType.TRAIN.value, config)
+            for starts, labels in sets_by_subject.values()
         ]
 
     @classmethod
@@ -393,6 +490,7 @@ class PAMAP2_Dataset(AbstractDataset):
     def prepare_files(cls, config, folder_prepared, folder_source):
         os.makedirs(folder_prepared)
 
+        writer = PAMAP2_StoreWriter(folder_prepared)
         folder_conf = ["Protocol", "Optional"]
         for conf in folder_conf:
             folder_samples = os.path.join(folder_source, "PAMAP2_Dataset", conf)
@@ -415,9 +513,6 @@ class PAMAP2_Dataset(AbstractDataset):
                     old_activityID = datapoint.activityID
                 msglogger.info("Now writing...")
                 subject_id = file.split(".")[0]
-                subject_folder = os.path.join(folder_prepared, subject_id)
-                if not os.path.isdir(subject_folder):
-                    os.mkdir(subject_folder)
                 for nr, group in enumerate(groups):
 
                     subfolder = (
@@ -426,11 +521,35 @@ class PAMAP2_Dataset(AbstractDataset):
                         f"_{PAMAP2_DataPoint.ACTIVITY_MAPPING[group[0].activityID]}"
                     )
 
-                    subfolder_path = os.path.join(subject_folder, subfolder)
-                    if not os.path.isdir(subfolder_path):
-                        os.mkdir(subfolder_path)
-
                     data_chunk = PAMAP2_DataChunk(group)
-                    data_chunk.to_file(
-                        os.path.join(subfolder_path, f"{conf}_{file}_{nr}.hdf5")
+                    writer.append(
+                        os.path.join(subject_id, subfolder, f"{conf}_{file}_{nr}.hdf5"),
+                        subject_id,
+                        data_chunk.data,
+                        data_chunk.get_label(),
+                    )
+        writer.close()
+
+    @classmethod
+    def consolidate_files(cls, folder_prepared):
+        """Converts the hdf5 files of a previous preparation to a sample store"""
+        msglogger.info("Consolidating %s", folder_prepared)
+        writer = PAMAP2_StoreWriter(folder_prepared)
+        for subject_id in sorted(os.listdir(folder_prepared)):
+            subject_folder = os.path.join(folder_prepared, subject_id)
+            if not os.path.isdir(subject_folder):
+                continue
+            for root, dirs, files in os.walk(subject_folder):
+                dirs.sort()
+                for file_name in sorted(files):
+                    if not file_name.endswith(".hdf5"):
+                        continue
+                    path = os.path.join(root, file_name)
+                    data_chunk = PAMAP2_DataChunk(path)
+                    writer.append(
+                        os.path.relpath(path, folder_prepared),
+                        subject_id,
+                        data_chunk.data,
+                        data_chunk.get_label(),
                     )
+        writer.close()
@@ -17,12 +17,14 @@
 # limitations under the License.
 #
 import logging
+import random
 from abc import ABC, abstractclassmethod, abstractmethod, abstractproperty
 from enum import Enum
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 logger = logging.getLogger(__name__)
 
@@ -113,6 +115,70 @@ class AbstractDataset(Dataset, ABC):
 
         return [self.channels, self.input_length]
 
+    def sequence_lengths(self) -> Optional[np.ndarray]:
+        """Returns the sequence length of each data item
+
+        Used to group items of similar length into batches, datasets should only
+        implement this if the lengths are known without loading the items.
+        """
+        return None
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler grouping items of similar sequence length
+
+    In each epoch the items are shuffled and split into pools of
+    `batch_size * bucket_size` items. Each pool is sorted by sequence length
+    and split into batches, the order of the batches is then shuffled again.
+
+    Args:
+        lengths (Sequence[int]): sequence length of each item of the dataset
+        batch_size (int): number of items per batch
+        drop_last (bool): drop the last batch of each pool if it is incomplete
+        bucket_size (int): number of batches per pool
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        drop_last: bool = False,
+        bucket_size: int = 100,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+
+    def _batches(self) -> List[List[int]]:
+        indices = np.random.permutation(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start : start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            for batch_start in range(0, len(pool), self.batch_size):
+                batch = pool[batch_start : batch_start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+
+        random.shuffle(batches)
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self._batches())
+
+    def __len__(self) -> int:
+        pool_size = self.batch_size * self.bucket_size
+        full_pools, remainder = divmod(len(self.lengths), pool_size)
+        if self.drop_last:
+            remaining_batches = remainder // self.batch_size
+        else:
+            remaining_batches = (remainder + self.batch_size - 1) // self.batch_size
+        return full_pools * self.bucket_size + remaining_batches
+
 
 def ctc_collate_fn(data):
     """Creates mini-batch tensors from the list of tuples (src_seq, trg_seq).
@@ -136,16 +202,13 @@ def ctc_collate_fn(data):
         lengths = [seq.shape[-1] for seq in sequences]
         max_length = max(lengths)
 
-        padded_seqs = []
-
-        for item in sequences:
-            padded = torch.nn.functional.pad(
-                input=item,
-                pad=(0, max_length - item.shape[-1]),
-                mode="constant",
-                value=0,
-            )
-            padded_seqs.append(padded)
+        # allocate the padded batch once and copy the sequences into it
+        first = sequences[0]
+        padded_seqs = first.new_zeros(
+            (len(sequences),) + tuple(first.shape[:-1]) + (max_length,)
+        )
+        for num, (item, length) in enumerate(zip(sequences, lengths)):
+            padded_seqs[num, ..., :length] = item
 
         return padded_seqs, lengths
 
@@ -157,8 +220,8 @@ def ctc_collate_fn(data):
     trg_seqs, trg_lengths = merge(trg_seqs)
 
     return (
-        torch.stack(src_seqs),
+        src_seqs,
         torch.Tensor(src_lengths),
-        torch.stack(trg_seqs),
+        trg_seqs,
         torch.Tensor(trg_lengths),
     )
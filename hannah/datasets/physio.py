@@ -33,12 +33,136 @@ from .base import AbstractDataset, DatasetType
 logger = logging.getLogger(__name__)
 
 
+class PhysioStore:
+    """Contiguous sample store of a prepared physiological dataset
+
+    All samples have the same shape and are stored with all transformations
+    already applied in a single float32 array file (`samples.f32`). `index.npz`
+    contains the name (`<label>/<sample>`) and the label of each sample.
+    """
+
+    DATA_FILE = "samples.f32"
+    INDEX_FILE = "index.npz"
+
+    def __init__(self, folder):
+        self.folder = folder
+        with np.load(os.path.join(folder, self.INDEX_FILE)) as index:
+            self.names = index["names"]
+            self.labels = index["labels"]
+            self.shape = tuple(index["shape"])
+
+    @classmethod
+    def exists(cls, folder):
+        return os.path.isfile(os.path.join(folder, cls.INDEX_FILE))
+
+    @classmethod
+    def open_data(cls, folder, shape):
+        # copy on write, so that torch gets writable arrays without copying
+        return np.memmap(
+            os.path.join(folder, cls.DATA_FILE), dtype=np.float32, mode="c", shape=shape
+        )
+
+    def split(self, dev_pct, test_pct):
+        """Assigns the samples to the train, dev and test split by hashing their path
+
+        Returns:
+            list of the sample indices of the train, dev and test split
+        """
+        sets = [[], [], []]
+        max_no_files = 2**27 - 1
+        for index, name in enumerate(self.names):
+            path = os.path.join(self.folder, name)
+            bucket = int(hashlib.sha1(path.encode()).hexdigest(), 16)
+            bucket = (bucket % (max_no_files + 1)) * (100.0 / max_no_files)
+            if bucket < dev_pct:
+                tag = DatasetType.DEV
+            elif bucket < test_pct + dev_pct:
+                tag = DatasetType.TEST
+            else:
+                tag = DatasetType.TRAIN
+            sets[tag.value].append(index)
+        return sets
+
+
+class PhysioStoreWriter:
+    """Appends samples to a physiological sample store
+
+    Args:
+        folder (str): folder of the sample store
+        input_length (int): if given, samples are zero padded or cropped to this
+                            length along their last axis
+    """
+
+    def __init__(self, folder, input_length=None):
+        self.folder = folder
+        self.input_length = input_length
+        self.names = list()
+        self.labels = list()
+        self.sample_shape = None
+        self._data_file = open(
+            os.path.join(folder, PhysioStore.DATA_FILE + ".tmp"), "wb"
+        )
+
+    def _fit_length(self, sample):
+        length = sample.shape[-1]
+        if length > self.input_length:
+            return sample[..., : self.input_length]
+        if length < self.input_length:
+            padding = [(0, 0)] * (sample.ndim - 1) + [(0, self.input_length - length)]
+            return np.pad(sample, padding)
+        return sample
+
+    def append(self, name, label, sample):
+        sample = np.asarray(sample, dtype=np.float32)
+        if self.input_length is not None and sample.ndim > 0:
+            sample = self._fit_length(sample)
+        sample = np.ascontiguousarray(sample)
+
+        if self.sample_shape is None:
+            self.sample_shape = sample.shape
+        if sample.shape != self.sample_shape:
+            raise ValueError(
+                f"Sample {name} has shape {sample.shape}, "
+                f"but the samples of the store have shape {self.sample_shape}"
+            )
+        self.names.append(name)
+        self.labels.append(label)
+        self._data_file.write(sample.tobytes())
+
+    def close(self):
+        self._data_file.close()
+        os.replace(
+            os.path.join(self.folder, PhysioStore.DATA_FILE + ".tmp"),
+            os.path.join(self.folder, PhysioStore.DATA_FILE),
+        )
+
+        sample_shape = self.sample_shape if self.sample_shape is not None else (0,)
+        index_tmp = os.path.join(self.folder, PhysioStore.INDEX_FILE + ".tmp")
+        with open(index_tmp, "wb") as f:
+            np.savez(
+                f,
+                names=np.array(self.names, dtype=str),
+                labels=np.array(self.labels, dtype=np.int64),
+                shape=np.array(
+                    (len(self.names),) + tuple(sample_shape), dtype=np.int64
+                ),
+            )
+        # The index is written last, it marks the store as complete
+        os.replace(index_tmp, os.path.join(self.folder, PhysioStore.INDEX_FILE))
+
+
 class PhysioDataset(AbstractDataset):
-    def __init__(self, data, set_type, config, dataset_name=None):
+    def __init__(self, store, indices, set_type, config, dataset_name=None):
         super().__init__()
-        self.physio_files = list(data.keys())
+        indices = np.asarray(indices, dtype=np.int64)
+        self.folder = store.folder
+        self.shape = store.shape
+        self.indices = indices
+        self.physio_files = [
+            os.path.join(store.folder, name) for name in store.names[indices]
+        ]
         self.set_type = set_type
-        self.physio_labels = list(data.values())
+        self.physio_labels = store.labels[indices]
 
         self.samplingrate = config["samplingrate"]
 
@@ -48,6 +172,14 @@ class PhysioDataset(AbstractDataset):
 
         self.dataset_name = dataset_name
 
+        self._data = None
+
+    def __getstate__(self):
+        # Each dataloader worker maps the sample store on its own
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
     @property
     def class_names(self):
         return self.label_names.values()
@@ -57,16 +189,12 @@ class PhysioDataset(AbstractDataset):
         return self.get_categories_distribution()
 
     def __getitem__(self, index):
-        label = torch.Tensor([self.physio_labels[index]]).long()
-        with open(self.physio_files[index], "rb") as f:
-            data = pickle.load(f)
-        data = torch.from_numpy(data).float()
-        if self.dataset_name == "PhysioCinc":
-            data = data - 0.01
-        if self.dataset_name == "AtrialFibrillation":
-            data = data.transpose(1, 0).float()
-            if self.channels == 1:
-                data = data[0]
+        if self._data is None:
+            self._data = PhysioStore.open_data(self.folder, self.shape)
+        label = torch.tensor([self.physio_labels[index]], dtype=torch.long)
+        data = torch.from_numpy(self._data[self.indices[index]])
+        if self.dataset_name == "AtrialFibrillation" and self.channels == 1:
+            data = data[0]
         return data, data.shape[0], label, label.shape[0]
 
     def get_label_list(self):
@@ -74,12 +202,47 @@ class PhysioDataset(AbstractDataset):
 
     def get_categories_distribution(self):
         distribution = defaultdict(int)
-        for label in self.get_label_list():
-            distribution[label] += 1
+        for label, count in enumerate(np.bincount(self.physio_labels)):
+            if count > 0:
+                distribution[label] = int(count)
         return distribution
 
     def __len__(self):
-        return len(self.physio_files)
+        return len(self.indices)
+
+    @classmethod
+    def consolidate_files(cls, folder, transform, input_length=None):
+        """Converts the pickled samples of a previous preparation to a sample store"""
+        logger.info("Consolidating %s", folder)
+        writer = PhysioStoreWriter(folder, input_length)
+        for subfolder in sorted(os.listdir(folder)):
+            subpath = os.path.join(folder, subfolder)
+            if not os.path.isdir(subpath):
+                continue
+            for filename in sorted(os.listdir(subpath)):
+                with open(os.path.join(subpath, filename), "rb") as f:
+                    sample = pickle.load(f)
+                writer.append(
+                    os.path.join(subfolder, filename),
+                    cls.get_label_mapping()[subfolder],
+                    transform(sample),
+                )
+        writer.close()
+
+    @classmethod
+    def splits(cls, config):
+        dev_pct = config["dev_pct"]
+        test_pct = config["test_pct"]
+
+        store = PhysioStore(cls.prepared_folder(config))
+        train, dev, test = store.split(dev_pct, test_pct)
+
+        datasets = (
+            cls(store, train, DatasetType.TRAIN, config),
+            cls(store, dev, DatasetType.DEV, config),
+            cls(store, test, DatasetType.TEST, config),
+        )
+        return datasets
 
 
 class PhysioCincDataset(PhysioDataset):
@@ -89,8 +252,8 @@ class PhysioCincDataset(PhysioDataset):
     LABEL_OTHER_RYTHM = "O"
     LABEL_NOISY = "~"
 
-    def __init__(self, data, set_type, config):
-        super().__init__(data, set_type, config, "PhysioCinc")
+    def __init__(self, store, indices, set_type, config):
+        super().__init__(store, indices, set_type, config, "PhysioCinc")
         self.samplingrate = config["samplingrate"]
 
         self.input_length = config["input_length"]
@@ -164,21 +327,30 @@ class PhysioCincDataset(PhysioDataset):
                 clear_download=clear_download,
             )
 
+    @classmethod
+    def prepared_folder(cls, config):
+        return os.path.join(config["data_folder"], "cinc_2017_prepared")
+
+    @staticmethod
+    def transform_sample(sample):
+        return sample.astype(np.float32) - np.float32(0.01)
+
     @classmethod
     def prepare_files(cls, config):
         logger.info("Preparing files...")
         files_list = list()
         data_folder = config["data_folder"]
         raw_folder = os.path.join(data_folder, "cinc_2017", "training2017")
-        output_folder = os.path.join(data_folder, "cinc_2017_prepared")
+        output_folder = cls.prepared_folder(config)
         if os.path.isdir(output_folder):
+            if not PhysioStore.exists(output_folder):
+                cls.consolidate_files(
+                    output_folder, cls.transform_sample, config["input_length"]
+                )
             logger.info("Preparation folder already exists, skipping...")
             return
         os.makedirs(output_folder)
 
-        for label in cls.get_label_mapping().keys():
-            os.makedirs(os.path.join(output_folder, label))
-
         for filename in os.listdir(raw_folder):
             file_path = os.path.join(raw_folder, filename)
             if os.path.isfile(file_path) and ".mat" in filename:
@@ -192,12 +364,11 @@ class PhysioCincDataset(PhysioDataset):
             for line in csv.reader(data):
                 labels.update({(line[0]): (line[1])})
 
-        raw_data = list()
-
         sample_length = config["input_length"]
         zero_pad_len = sample_length
 
-        for name in files_list:
+        writer = PhysioStoreWriter(output_folder, sample_length)
+        for name in sorted(files_list):
 
             sample_path = os.path.join(raw_folder, name)
             samples, _ = wfdb.rdsamp(sample_path)
@@ -205,51 +376,13 @@ class PhysioCincDataset(PhysioDataset):
             samples = np.append(samples, zero_pad)
             samples = samples[0:zero_pad_len]
 
-            raw_data += [{"name": name, "sample": samples, "label": labels[name]}]
-
-        for _, element in enumerate(raw_data):
-            name = element["name"]
-            sample = element["sample"]
-            label = element["label"]
-            out_path = os.path.join(output_folder, label)
-            if not os.path.isdir(out_path):
-                os.makedirs(out_path)
-            path = os.path.join(output_folder, label, name)
-            with open(path, "wb") as f:
-                pickle.dump(sample, f)
-
-    @classmethod
-    def splits(cls, config):
-
-        dev_pct = config["dev_pct"]
-        test_pct = config["test_pct"]
-
-        folder = os.path.join(config["data_folder"], "cinc_2017_prepared")
-
-        train_files = dict()
-        test_files = dict()
-        dev_files = dict()
-
-        for subfolder in os.listdir(folder):
-            subpath = os.path.join(folder, subfolder)
-            for filename in os.listdir(subpath):
-                path = os.path.join(folder, subfolder, filename)
-                max_no_files = 2**27 - 1
-                bucket = int(hashlib.sha1(path.encode()).hexdigest(), 16)
-                bucket = (bucket % (max_no_files + 1)) * (100.0 / max_no_files)
-                if bucket < dev_pct:
-                    dev_files[path] = cls.get_label_mapping()[subfolder]
-                elif bucket < test_pct + dev_pct:
-                    test_files[path] = cls.get_label_mapping()[subfolder]
-                else:
-                    train_files[path] = cls.get_label_mapping()[subfolder]
-
-        datasets = (
-            cls(train_files, DatasetType.TRAIN, config),
-            cls(dev_files, DatasetType.DEV, config),
-            cls(test_files, DatasetType.TEST, config),
-        )
-        return datasets
+            label = labels[name]
+            writer.append(
+                os.path.join(label, name),
+                cls.get_label_mapping()[label],
+                cls.transform_sample(samples),
+            )
+        writer.close()
 
 
 class AtrialFibrillationDataset(PhysioDataset):
@@ -265,11 +398,11 @@ class AtrialFibrillationDataset(PhysioDataset):
     ANN_JUNCTIONAL_RYTHM = "(J"
     ANN_OTHER_RYTHM = "(N"
 
-    def __init__(self, data, set_type, config):
+    def __init__(self, store, indices, set_type, config):
         self.label_names = self.get_label_names()
 
         self.annotation_names = self.get_annotation_names()
-        super().__init__(data, set_type, config, "AtrialFibrillation")
+        super().__init__(store, indices, set_type, config, "AtrialFibrillation")
 
         self.channels = config["num_channels"]
 
@@ -346,19 +479,30 @@ class AtrialFibrillationDataset(PhysioDataset):
                 clear_download=clear_download,
             )
 
+    @classmethod
+    def prepared_folder(cls, config):
+        return os.path.join(config["data_folder"], "atrial_fibrillation_prepared")
+
+    @staticmethod
+    def transform_sample(sample):
+        # samples are stored channels first
+        return np.ascontiguousarray(sample.transpose(1, 0), dtype=np.float32)
+
     @classmethod
     def prepare_files(cls, config):
         logger.info("Preparing files...")
         files_list = list()
         data_folder = config["data_folder"]
         raw_folder = os.path.join(data_folder, "atrial_fibrillation", "files")
-        output_folder = os.path.join(data_folder, "atrial_fibrillation_prepared")
+        output_folder = cls.prepared_folder(config)
         if os.path.isdir(output_folder):
+            if not PhysioStore.exists(output_folder):
+                cls.consolidate_files(
+                    output_folder, cls.transform_sample, config["input_length"]
+                )
             logger.info("Preparation folder already exists, skipping...")
             return
         os.makedirs(output_folder)
-        for label in cls.get_label_mapping().keys():
-            os.makedirs(os.path.join(output_folder, label))
 
         for filename in os.listdir(raw_folder):
             file_path = os.path.join(raw_folder, filename)
@@ -382,6 +526,7 @@ class AtrialFibrillationDataset(PhysioDataset):
 
         sample_length = config["input_length"]
 
+        writer = PhysioStoreWriter(output_folder, sample_length)
         for experiment_nr, element in enumerate(raw_data):
             samples = element["samples"]
             annotations = element["annotations"]
@@ -401,47 +546,17 @@ class AtrialFibrillationDataset(PhysioDataset):
                     if start_sample + sample_length < stop_sample:
                         chunk = samples[start_sample : start_sample + sample_length]
                     else:
+                        # chunks at the end of a record can be shorter than
+                        # sample_length and are zero padded by the writer
                         chunk = samples[
-                            stop_sample - sample_length - 1 : stop_sample - 1
+                            max(stop_sample - sample_length - 1, 0) : stop_sample - 1
                         ]
-                    path = os.path.join(
-                        output_folder,
-                        cls.get_label_names()[label_number],
-                        f"ex{experiment_nr}_{i}",
+                    writer.append(
+                        os.path.join(
+                            cls.get_label_names()[label_number],
+                            f"ex{experiment_nr}_{i}",
+                        ),
+                        label_number,
+                        cls.transform_sample(chunk),
                     )
-
-                    with open(path, "wb") as f:
-                        pickle.dump(chunk, f)
-
-    @classmethod
-    def splits(cls, config):
-
-        dev_pct = config["dev_pct"]
-        test_pct = config["test_pct"]
-
-        folder = os.path.join(config["data_folder"], "atrial_fibrillation_prepared")
-
-        train_files = dict()
-        test_files = dict()
-        dev_files = dict()
-
-        for subfolder in os.listdir(folder):
-            subpath = os.path.join(folder, subfolder)
-            for filename in os.listdir(subpath):
-                path = os.path.join(folder, subfolder, filename)
-                max_no_files = 2**27 - 1
-                bucket = int(hashlib.sha1(path.encode()).hexdigest(), 16)
-                bucket = (bucket % (max_no_files + 1)) * (100.0 / max_no_files)
-                if bucket < dev_pct:
-                    dev_files[path] = cls.get_label_mapping()[subfolder]
-                elif bucket < test_pct + dev_pct:
-                    test_files[path] = cls.get_label_mapping()[subfolder]
-                else:
-                    train_files[path] = cls.get_label_mapping()[subfolder]
-
-        datasets = (
-            cls(train_files, DatasetType.TRAIN, config),
-            cls(dev_files, DatasetType.DEV, config),
-            cls(test_files, DatasetType.TEST, config),
-        )
-        return datasets
+        writer.close()
@@ -17,12 +17,13 @@
 # limitations under the License.
 #
 import math
-from typing import Any, Callable, List, Optional, TypeVar, Union
+from typing import Any, Callable, List, Optional, Tuple, TypeVar, Union
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torchaudio
 from torch import Tensor
 from torch.nn.modules.utils import _single
 from torchaudio import functional as Ftorchaudio
@@ -244,24 +245,52 @@ class SincConvFFT(nn.Module):
         self.low_freq_ = nn.Parameter(torch.Tensor(hz[:-1]).view(-1, 1))
         self.band_freq_ = nn.Parameter(torch.Tensor(np.diff(hz)).view(-1, 1))
 
+        self._band_mask = None
+        self._band_mask_key = None
+
+    def band_mask(self, n_bins: int, dtype: torch.dtype) -> torch.Tensor:
+        """Returns the (out_channels x n_bins) mask of the stft bins of each band
+
+        The mask is only recomputed if the band edges have changed, e.g. after
+        an optimizer step, which is detected by the version counters of the
+        parameters.
+        """
+        key = (
+            self.low_freq_._version,
+            self.band_freq_._version,
+            n_bins,
+            dtype,
+            self.low_freq_.device,
+        )
+        if self._band_mask is not None and key == self._band_mask_key:
+            return self._band_mask
+
+        with torch.no_grad():
+            f_low = torch.abs(self.low_freq_) + self.min_low_hz
+            f_high = torch.clamp(
+                f_low + self.min_band_hz + torch.abs(self.band_freq_),
+                self.min_low_hz,
+                self.sample_rate / 2,
+            )
+            band_width = self.sample_rate / (2 * n_bins)
+            f_low_idx = f_low.div(band_width).floor()
+            f_high_idx = f_high.div(band_width).ceil()
+
+            bins = torch.arange(n_bins, device=f_low.device, dtype=f_low.dtype)
+            mask = (bins >= f_low_idx) & (bins < f_high_idx)
+
+        self._band_mask = mask.to(dtype)
+        self._band_mask_key = key
+
+        return self._band_mask
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         spectrogram = torch.stft(x.squeeze(1), n_fft=160, hop_length=160)
         spectrogram = spectrogram[:, :, :, 0]
 
-        f_low = torch.abs(self.low_freq_) + self.min_low_hz
-        f_high = torch.clamp(
-            f_low + self.min_band_hz + torch.abs(self.band_freq_),
-            self.min_low_hz,
-            self.sample_rate / 2,
-        )
-        band_width = self.sample_rate / (2 * spectrogram.shape[1])
-        f_low_idx = f_low.div(band_width).floor()
-        f_high_idx = f_high.div(band_width).ceil()
-        channels = [
-            spectrogram[:, f_low_idx.int()[i] : f_high_idx.int()[i], :].sum(dim=1)
-            for i in range(self.out_channels)
-        ]
-        sinc_test_features = torch.stack(channels, dim=1)
+        # Sum the stft bins of all bands in a single batched matmul
+        mask = self.band_mask(spectrogram.shape[1], spectrogram.dtype)
+        sinc_test_features = torch.matmul(mask, spectrogram)
         sinc_test_features = sinc_test_features.div(sinc_test_features.max())
 
         return sinc_test_features
@@ -367,3 +396,162 @@ class LogSpectrogram(torch.nn.Module):
         log_specgram = torch.log(specgram + log_offset)
         # mel_specgram = self.mel_scale(specgram)
         return log_specgram
+
+
+class StreamingFeatures(nn.Module):
+    """Incremental feature extraction for continuous audio streams
+
+    Wraps a frame based feature extractor and keeps the samples that are still
+    needed by future frames between calls. Each call with a new chunk of audio
+    only returns the frames that have become complete, so a sliding window over a
+    stream does not need to recompute the features of the whole window.
+
+    The returned frames are identical to the frames of offline feature
+    extraction that do not touch the padding at the start of a recording.
+
+    The only exception is the decibel conversion of torchaudio MFCC transforms
+    with top_db set. Offline, it clamps against the maximum of the whole input,
+    which is not known while streaming. Here it clamps against the running
+    maximum of the stream, so frames preceding the loudest part of a stream can
+    be clamped less than offline, e.g. silence followed by speech.
+
+    Args:
+        features (nn.Module): LogSpectrogram, SincConv, SincConvBlock, RawFeatures
+            or torchaudio Spectrogram / MelSpectrogram / MFCC transform
+    """
+
+    def __init__(self, features: nn.Module) -> None:
+        super().__init__()
+        self.features = features
+        self.span, self.hop, self.padding = self.frame_parameters(features)
+        self.running_db_clamp = (
+            isinstance(features, torchaudio.transforms.MFCC)
+            and not features.log_mels
+            and features.amplitude_to_DB.top_db is not None
+        )
+        # number of frames whose windows start in the padding
+        self.context_frames = -(-self.padding // self.hop)
+        self.reset()
+
+    @classmethod
+    def frame_parameters(cls, features: nn.Module) -> Tuple[int, int, int]:
+        """Returns (window length, hop length, left padding) in samples
+
+        Output frame t of the features depends on the input samples
+        [t * hop - padding, t * hop - padding + window length).
+        """
+        if isinstance(features, torchaudio.transforms.MFCC):
+            features = features.MelSpectrogram
+        if isinstance(features, torchaudio.transforms.MelSpectrogram):
+            features = features.spectrogram
+
+        if isinstance(features, (LogSpectrogram, torchaudio.transforms.Spectrogram)):
+            padding = features.pad
+            if getattr(features, "center", True):
+                padding += features.n_fft // 2
+            return features.n_fft, features.hop_length, padding
+        if isinstance(features, (SincConv, nn.Conv1d)):
+            span = features.dilation[0] * (features.kernel_size[0] - 1) + 1
+            return span, features.stride[0], features.padding[0]
+        if isinstance(features, (nn.AvgPool1d, nn.MaxPool1d)):
+            kernel_size = _single(features.kernel_size)[0]
+            stride = _single(features.stride)[0]
+            return kernel_size, stride, _single(features.padding)[0]
+        if isinstance(features, torchaudio.transforms.AmplitudeToDB):
+            if features.top_db is not None:
+                raise ValueError(
+                    "Streaming AmplitudeToDB clamps against the maximum of each chunk, "
+                    "use top_db=None"
+                )
+            return 1, 1, 0
+        if isinstance(
+            features,
+            (RawFeatures, Sinc_Act, nn.Identity, nn.BatchNorm1d, nn.ReLU),
+        ):
+            return 1, 1, 0
+        if isinstance(features, SincConvBlock):
+            features = features.layer
+        if isinstance(features, nn.Sequential):
+            span, hop, padding = 1, 1, 0
+            for layer in features:
+                layer_span, layer_hop, layer_padding = cls.frame_parameters(layer)
+                span += (layer_span - 1) * hop
+                padding += layer_padding * hop
+                hop *= layer_hop
+            return span, hop, padding
+
+        raise ValueError(
+            f"Streaming is not supported for features of type {type(features).__name__}"
+        )
+
+    def reset(self) -> None:
+        """Starts a new stream"""
+        self.buffer: Optional[Tensor] = None
+        # stream position of the first buffered sample
+        self.buffer_start = 0
+        # index of the next frame that is returned
+        self.next_frame = self.context_frames
+        # maximum decibel value of the stream, see running_db_clamp
+        self.db_max: Optional[Tensor] = None
+
+    def _extract(self, segment: Tensor) -> Tensor:
+        if not self.running_db_clamp:
+            return self.features(segment)
+
+        # MFCC without the clamp, it is applied to the new frames in _clamp_db
+        to_db = self.features.amplitude_to_DB
+        mel_specgram = self.features.MelSpectrogram(segment)
+        return Ftorchaudio.amplitude_to_DB(
+            mel_specgram, to_db.multiplier, to_db.amin, to_db.db_multiplier, None
+        )
+
+    def _clamp_db(self, mel_db: Tensor) -> Tensor:
+        frames_max = mel_db.amax(dim=(-2, -1), keepdim=True)
+        if self.db_max is None:
+            self.db_max = frames_max
+        else:
+            self.db_max = torch.maximum(self.db_max, frames_max)
+
+        top_db = self.features.amplitude_to_DB.top_db
+        mel_db = torch.max(mel_db, self.db_max - top_db)
+        return torch.matmul(mel_db.transpose(-1, -2), self.features.dct_mat).transpose(
+            -1, -2
+        )
+
+    def forward(self, chunk: Tensor) -> Optional[Tensor]:
+        """Appends a chunk of audio (..., time) to the stream
+
+        Returns:
+            the features of the new complete frames (..., frames) or None if no
+            frame has been completed by this chunk
+        """
+        if self.buffer is None:
+            self.buffer = chunk
+        else:
+            self.buffer = torch.cat((self.buffer, chunk), dim=-1)
+
+        stream_end = self.buffer_start + self.buffer.shape[-1]
+        last_frame = (stream_end + self.padding - self.span) // self.hop
+        if last_frame < self.next_frame:
+            return None
+
+        # The segment starts early enough that the new frames do not depend on
+        # the padding added by the feature extractor
+        segment_start = (self.next_frame - self.context_frames) * self.hop
+        segment_end = last_frame * self.hop - self.padding + self.span
+        segment = self.buffer[
+            ..., segment_start - self.buffer_start : segment_end - self.buffer_start
+        ]
+
+        frames = self._extract(segment)
+        num_frames = last_frame - self.next_frame + 1
+        frames = frames[..., self.context_frames : self.context_frames + num_frames]
+        if self.running_db_clamp:
+            frames = self._clamp_db(frames)
+
+        self.next_frame = last_frame + 1
+        keep_start = (self.next_frame - self.context_frames) * self.hop
+        self.buffer = self.buffer[..., keep_start - self.buffer_start :]
+        self.buffer_start = keep_start
+
+        return frames
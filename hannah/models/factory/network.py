@@ -35,6 +35,9 @@ class ConvNet(nn.Module):
         if hasattr(self, "activation_post_process"):
             x = self.activation_post_process(x)
         x = self.convolutions(x)
+        return self._forward_head(x)
+
+    def _forward_head(self, x):
         x = self.pooling(x)
         x = self.dropout(x)
         x = self.flatten(x)
@@ -273,15 +273,20 @@ class ComputeLoss:
 
     def build_targets(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
-        na, nt = self.na, targets.shape[0]  # number of anchors, targets
-        tcls, tbox, indices, anch = [], [], [], []
-        gain = torch.ones(7, device=targets.device)  # normalized to gridspace gain
-        ai = (
-            torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)
-        )  # same as .repeat_interleave(nt)
-        targets = torch.cat(
-            (targets.repeat(na, 1, 1), ai[:, :, None]), 2
-        )  # append anchor indices
+        #
+        # Anchor matching is done for all detection layers in one pass, the
+        # results are ordered like the layer by layer implementation and
+        # split into per layer tensors at the end.
+        device = targets.device
+        nl, na, nt = self.nl, self.na, targets.shape[0]
+        anchors = self.anchors.to(device)  # (nl, na, 2) in grid units
+
+        # grid width and height of each detection layer
+        grid = torch.tensor(
+            [[pi.shape[3], pi.shape[2]] for pi in p[:nl]],
+            device=device,
+            dtype=targets.dtype,
+        )  # (nl, 2)
 
         g = 0.5  # bias
         off = (
@@ -294,50 +299,50 @@ class ComputeLoss:
                     [0, -1],  # j,k,l,m
                     # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
                 ],
-                device=targets.device,
+                device=device,
             ).float()
             * g
         )  # offsets
 
-        for i in range(self.nl):
-            anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain
-            if nt:
-                # Matches
-                r = t[:, :, 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1.0 / r).max(2)[0] < self.hyp["anchor_t"]  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1.0 < g) & (gxy > 1.0)).T
-                l, m = ((gxi % 1.0 < g) & (gxi > 1.0)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            b, c = t[:, :2].long().T  # image, class
-            gxy = t[:, 2:4]  # grid xy
-            gwh = t[:, 4:6]  # grid wh
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid xy indices
-
-            # Append
-            a = t[:, 6].long()  # anchor indices
-            indices.append(
-                (b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1))
-            )  # image, anchor, grid indices
-            tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
-            anch.append(anchors[a])  # anchors
-            tcls.append(c)  # class
-
-        return tcls, tbox, indices, anch
+        gxy = targets[None, :, 2:4] * grid[:, None]  # (nl, nt, 2) grid xy
+        gwh = targets[None, :, 4:6] * grid[:, None]  # (nl, nt, 2) grid wh
+
+        # Matches
+        r = gwh[:, None] / anchors[:, :, None]  # (nl, na, nt, 2) wh ratio
+        match = torch.max(r, 1.0 / r).max(3)[0] < self.hyp["anchor_t"]  # compare
+
+        # Offsets
+        gxi = grid[:, None] - gxy  # inverse
+        j, k = ((gxy % 1.0 < g) & (gxy > 1.0)).unbind(-1)
+        l, m = ((gxi % 1.0 < g) & (gxi > 1.0)).unbind(-1)
+        sel = torch.stack((torch.ones_like(j), j, k, l, m), 1)  # (nl, 5, nt)
+
+        mask = match[:, None] & sel[:, :, None, :]  # (nl, 5, na, nt)
+        layer, o, a, ti = mask.nonzero(as_tuple=True)
+
+        # Define
+        t = targets[ti]
+        b, c = t[:, :2].long().T  # image, class
+        gxy = gxy[layer, ti]
+        gwh = gwh[layer, ti]
+        gij = (gxy - off[o]).long()
+        gi, gj = gij.T  # grid xy indices
+        grid_max = grid[layer].long() - 1
+        gi = torch.minimum(gi.clamp(min=0), grid_max[:, 0])
+        gj = torch.minimum(gj.clamp(min=0), grid_max[:, 1])
+        gij = torch.stack((gi, gj), 1)
+
+        tbox = torch.cat((gxy - gij, gwh), 1)  # box
+        anch = anchors[layer, a]  # anchors
+
+        # Split into per layer results, this is the only host synchronization
+        counts = torch.bincount(layer, minlength=nl).tolist()
+
+        tcls = list(c.split(counts))
+        tboxes = list(tbox.split(counts))
+        anchs = list(anch.split(counts))
+        indices = list(
+            zip(b.split(counts), a.split(counts), gj.split(counts), gi.split(counts))
+        )  # image, anchor, grid indices
+
+        return tcls, tboxes, indices, anchs
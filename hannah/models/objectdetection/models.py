@@ -23,7 +23,7 @@ import torchvision
 from pycocotools.coco import COCO
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 
-from hannah.datasets.Kitti import KittiCOCO
+from hannah.datasets.Kitti import KittiCOCO, pack_targets
 
 from .loss import ComputeLoss
 
@@ -80,6 +80,9 @@ class FasterRCNN(torch.nn.Module):
 
 
 class UltralyticsYolo(torch.nn.Module):
+    # The forward pass accepts the packed targets of object_collate_fn
+    packed_targets = True
+
     def __init__(
         self,
         name="yolov5s",
@@ -106,69 +109,85 @@ class UltralyticsYolo(torch.nn.Module):
         )
         self.model.hyp = hyp
         self.model.gr = gr
+        self._loss = None
         for name, param in self.model.named_parameters():
             param.requires_grad = True
 
+    def _pad(self, x_elem):
+        return (
+            (0, 1248 - x_elem.size()[-1], 0, 384 - x_elem.size()[-2])
+            if "6" not in self.model.yaml_file
+            else (0, 1280 - x_elem.size()[-1], 0, 1280 - x_elem.size()[-2])
+        )
+
     def _transformAnns(self, x, y):
-        retval = []
+        """Converts targets to yolo format (image, class, x, y, w, h) normalized to the image size
+
+        Args:
+            x: list of images
+            y: packed targets as returned by hannah.datasets.Kitti.pack_targets or
+               list of target dicts
+
+        Returns:
+            torch.Tensor: (number of boxes, 6) targets of all images in the batch
+        """
+        if not isinstance(y, dict):
+            y = pack_targets(y)
+
+        boxes = y["boxes"]
+        labels = y["labels"]
+        batch_size = labels.shape[0]
+
+        # image width and height
+        sizes = torch.tensor(
+            [[x_elem.shape[2], x_elem.shape[1]] for x_elem in x],
+            dtype=boxes.dtype,
+            device=boxes.device,
+        )[:, None, :]
+        img_idx = torch.arange(batch_size, device=boxes.device, dtype=boxes.dtype)
+
+        box_wh = boxes[..., 2:4] - boxes[..., 0:2]
+        box_center = boxes[..., 0:2] + box_wh / 2
+        targets = torch.cat(
+            (
+                img_idx.view(batch_size, 1, 1).expand(-1, labels.shape[1], 1),
+                labels[..., None].to(boxes.dtype),
+                box_center / sizes,
+                box_wh / sizes,
+            ),
+            2,
+        )
 
-        for x_elem, y_elem in zip(x, y):
-            img_ann = []
-            img_widh = x_elem.shape[2]
-            img_height = x_elem.shape[1]
-
-            for box, label in zip(
-                (boxes for boxes in y_elem["boxes"]),
-                (labels for labels in y_elem["labels"]),
-            ):
-                box_width = box[2] - box[0]
-                box_height = box[3] - box[1]
-                img_ann.append(
-                    torch.tensor(
-                        [
-                            0,
-                            label,
-                            (box[0] + (box_width / 2)) / img_widh,
-                            (box[1] + (box_height / 2)) / img_height,
-                            box_width / img_widh,
-                            box_height / img_height,
-                        ]
-                    )
-                )
-            retval.append(torch.stack(img_ann))
-        return retval
+        return targets[labels >= 0]
+
+    def _compute_loss(self, output, targets):
+        if self._loss is None:
+            self._loss = ComputeLoss(self.model)
+        return self._loss(output, targets)
 
     def forward(self, x, y=None):
         if isinstance(x, (tuple, list)):
-            retval = list()
-            for x_elem in x:
-                pad = (
-                    (0, 1248 - x_elem.size()[2], 0, 384 - x_elem.size()[1])
-                    if "6" not in self.model.yaml_file
-                    else (0, 1280 - x_elem.size()[2], 0, 1280 - x_elem.size()[1])
+            if self.training:
+                batch = torch.stack(
+                    [F.pad(x_elem, self._pad(x_elem), "constant") for x_elem in x]
                 )
-                retval.append(self.model(F.pad(x_elem.unsqueeze(0), pad, "constant")))
+                output = self.model(batch)
 
-            if self.training:
-                ret_loss = []
+                targets = self._transformAnns(x, y).to(output[0].device)
+                loss, _ = self._compute_loss(output, targets)
 
-                loss = ComputeLoss(self.model)
-                y = self._transformAnns(x, y)
+                return {"loss": loss}
 
-                for x_elem, y_elem in zip(retval, y):
-                    ret_loss.append(loss(x_elem, y_elem.to(x_elem[0].device))[0])
-                retval = dict(
-                    zip((i for i in range(len(ret_loss))), (ret for ret in ret_loss))
+            retval = list()
+            for x_elem in x:
+                retval.append(
+                    self.model(
+                        F.pad(x_elem.unsqueeze(0), self._pad(x_elem), "constant")
+                    )
                 )
-
             return retval
         else:
-            pad = (
-                (0, 1248 - x.size()[3], 0, 384 - x.size()[2])
-                if "6" not in self.model.yaml_file
-                else (0, 1280 - x.size()[3], 0, 1280 - x.size()[2])
-            )
-            x = F.pad(x, pad, "constant")
+            x = F.pad(x, self._pad(x), "constant")
             return self.model(x)
 
     def train(self, mode=True):
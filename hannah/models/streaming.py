@@ -0,0 +1,284 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from .factory.network import ConvNet
+from .factory.reduction import ReductionBlockAdd, ReductionBlockConcat
+from .tc.models import TCResidualBlock, TCResNetModel
+
+msglogger = logging.getLogger(__name__)
+
+POINTWISE_MODULES = (
+    nn.BatchNorm1d,
+    nn.Dropout,
+    nn.ELU,
+    nn.Hardtanh,
+    nn.Identity,
+    nn.LeakyReLU,
+    nn.ReLU,
+    nn.ReLU6,
+    nn.Sigmoid,
+    nn.Tanh,
+)
+
+try:
+    from torch.quantization import FakeQuantizeBase
+
+    POINTWISE_MODULES = POINTWISE_MODULES + (FakeQuantizeBase,)
+except ImportError:
+    pass
+
+
+# Output of a layer and the range of its positions that are unchanged since the
+# previous window, shifted by the given number of positions
+_State = Tuple[Tensor, Tuple[int, int], int]
+
+
+class StreamingConvNet(nn.Module):
+    """Incremental sliding window inference for 1D convolutional networks
+
+    Wraps a TCResNetModel or a factory built ConvNet. The first call gets a
+    complete input window of shape (batch, channels, time), each further call
+    only the new time steps of the stream. The outputs of all layers over the
+    current window are cached. When the window moves, only the positions of each
+    layer whose receptive field contains new inputs or reaches the zero padding
+    at the window borders are recomputed, all others are shifted copies of the
+    previous window. The results are identical to full window inference.
+
+    Hops that are not a multiple of the stride of a layer fall back to
+    recomputing this and all following layers. The wrapped model must be in
+    eval mode.
+    """
+
+    def __init__(self, model: nn.Module) -> None:
+        super().__init__()
+        self.model = model
+        self.layers, self.head = self._split_model(model)
+        for layer in self.layers:
+            self._check_supported(layer)
+        self.reset()
+
+    @staticmethod
+    def _split_model(model: nn.Module) -> Tuple[List[nn.Module], Callable]:
+        if isinstance(model, TCResNetModel):
+            return list(model.layers)[:-1], model._forward_head
+        if isinstance(model, ConvNet):
+            layers = []
+            if hasattr(model, "activation_post_process"):
+                layers.append(model.activation_post_process)
+            layers.append(model.convolutions)
+            return layers, model._forward_head
+        raise ValueError(
+            f"Streaming inference is not supported for {type(model).__name__}"
+        )
+
+    @classmethod
+    def _check_supported(cls, module: nn.Module) -> None:
+        if isinstance(module, (nn.Sequential, ReductionBlockAdd, ReductionBlockConcat)):
+            children = (
+                module.chains if not isinstance(module, nn.Sequential) else module
+            )
+            for child in children:
+                cls._check_supported(child)
+        elif isinstance(module, TCResidualBlock):
+            cls._check_supported(module.convs)
+            if module.stride > 1:
+                cls._check_supported(module.downsample)
+        elif not (cls._is_conv(module) or isinstance(module, POINTWISE_MODULES)):
+            raise ValueError(
+                "Streaming inference is not supported for layers of type "
+                f"{type(module).__name__}"
+            )
+
+    @staticmethod
+    def _is_conv(module: nn.Module) -> bool:
+        return (
+            isinstance(module, nn.modules.conv._ConvNd)
+            and len(module.kernel_size) == 1
+            and not module.transposed
+        )
+
+    def reset(self) -> None:
+        """Starts a new stream"""
+        self.window: Optional[Tensor] = None
+        self.cache: Dict[Tuple, Tensor] = {}
+
+    def forward(self, x: Tensor) -> Tensor:
+        """Moves the window by the time steps of x and classifies the new window"""
+        if self.window is None:
+            self.window = x
+            clean = (0, 0)
+            shift = 0
+        else:
+            shift = x.shape[-1]
+            window_length = self.window.shape[-1]
+            if shift >= window_length:
+                self.window = x[..., -window_length:]
+                clean = (0, 0)
+            else:
+                self.window = torch.cat((self.window[..., shift:], x), dim=-1)
+                clean = (0, window_length - shift)
+
+        state = (self.window, clean, shift)
+        for num, layer in enumerate(self.layers):
+            state = self._run(layer, state, (num,))
+
+        return self.head(state[0])
+
+    def _run(self, module: nn.Module, state: _State, key: Tuple) -> _State:
+        if isinstance(module, nn.Sequential):
+            for num, child in enumerate(module):
+                state = self._run(child, state, key + (num,))
+            return state
+
+        if isinstance(module, TCResidualBlock):
+            y = self._run(module.convs, state, key + ("convs",))
+            if module.stride > 1:
+                x = self._run(module.downsample, state, key + ("downsample",))
+            else:
+                x = state
+            return self._pointwise(
+                lambda y, x: module.act(y + x), [y, x], key + ("add",)
+            )
+
+        if isinstance(module, ReductionBlockAdd):
+            outputs = [
+                self._run(chain, state, key + (num,))
+                for num, chain in enumerate(module.chains)
+            ]
+
+            def add(*inputs):
+                result = inputs[0]
+                for y in inputs[1:]:
+                    result = result + y
+                return module.act(result)
+
+            return self._pointwise(add, outputs, key + ("add",))
+
+        if isinstance(module, ReductionBlockConcat):
+            outputs = [
+                self._run(chain, state, key + (num,))
+                for num, chain in enumerate(module.chains)
+            ]
+            return self._pointwise(
+                lambda *inputs: torch.cat(inputs, 1), outputs, key + ("cat",)
+            )
+
+        if self._is_conv(module):
+            return self._conv(module, state, key)
+
+        return self._pointwise(module, [state], key)
+
+    def _pointwise(self, fn: Callable, inputs: Sequence[_State], key: Tuple) -> _State:
+        """Runs an elementwise operation on the changed positions of its inputs"""
+        tensors = [x for x, _, _ in inputs]
+        shift = inputs[0][2]
+        a = max(clean[0] for _, clean, _ in inputs)
+        b = min(clean[1] for _, clean, _ in inputs)
+        length = tensors[0].shape[-1]
+
+        old = self.cache.get(key)
+        if (
+            old is None
+            or old.shape[-1] != length
+            or any(s != shift for _, _, s in inputs)
+            or b <= a
+        ):
+            y = fn(*tensors)
+            self.cache[key] = y
+            return y, (0, 0), 0
+
+        parts = []
+        if a > 0:
+            parts.append(fn(*[x[..., :a] for x in tensors]))
+        parts.append(old[..., a + shift : b + shift])
+        if b < length:
+            parts.append(fn(*[x[..., b:] for x in tensors]))
+        y = torch.cat(parts, dim=-1)
+
+        self.cache[key] = y
+        return y, (a, b), shift
+
+    def _conv(self, module: nn.Module, state: _State, key: Tuple) -> _State:
+        x, (a, b), shift = state
+        stride = module.stride[0]
+        padding = module.padding[0]
+        span = module.dilation[0] * (module.kernel_size[0] - 1) + 1
+        length = x.shape[-1]
+        out_length = (length + 2 * padding - span) // stride + 1
+
+        old = self.cache.get(key)
+        if old is None or old.shape[-1] != out_length or shift % stride != 0:
+            y = module(x)
+            self.cache[key] = y
+            return y, (0, 0), 0
+
+        out_shift = shift // stride
+        # outputs whose receptive field lies completely in the unchanged inputs
+        out_a = -(-(a + padding) // stride)
+        out_b = min((b + padding - span) // stride + 1, out_length - out_shift)
+        if out_b <= out_a:
+            y = module(x)
+            self.cache[key] = y
+            return y, (0, 0), 0
+
+        y = torch.cat(
+            (
+                self._conv_range(module, x, 0, out_a),
+                old[..., out_a + out_shift : out_b + out_shift],
+                self._conv_range(module, x, out_b, out_length),
+            ),
+            dim=-1,
+        )
+
+        self.cache[key] = y
+        return y, (out_a, out_b), out_shift
+
+    @staticmethod
+    def _conv_range(module: nn.Module, x: Tensor, start: int, stop: int) -> Tensor:
+        """Computes the outputs [start, stop) of a convolution"""
+        stride = module.stride[0]
+        padding = module.padding[0]
+        span = module.dilation[0] * (module.kernel_size[0] - 1) + 1
+        length = x.shape[-1]
+
+        if stop <= start:
+            return x.new_zeros(x.shape[0], module.out_channels, 0)
+
+        lo = start * stride - padding
+        hi = (stop - 1) * stride - padding + span
+        segment = x[..., max(lo, 0) : min(hi, length)]
+        segment = F.pad(segment, (max(0, -lo), max(0, hi - length)))
+
+        # the padding is added explicitly, so that only the borders of the
+        # window are zero padded
+        module_padding = module.padding
+        module.padding = (0,)
+        try:
+            y = module(segment)
+        finally:
+            module.padding = module_padding
+
+        return y
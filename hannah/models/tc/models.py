@@ -355,8 +355,14 @@ class TCResNetModel(nn.Module):
             self.fc = nn.Linear(shape[1], n_labels, bias=False)
 
     def forward(self, x):
-        for layer in self.layers:
+        for layer in self.layers[:-1]:
             x = layer(x)
+
+        return self._forward_head(x)
+
+    def _forward_head(self, x):
+        """Applies the global average pooling and the classifier"""
+        x = self.layers[-1](x)
         self.feat = x
         if not self.fully_convolutional:
             self.feat = x = x.view(x.size(0), -1)
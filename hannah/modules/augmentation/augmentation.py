@@ -17,11 +17,8 @@
 # limitations under the License.
 #
 import logging
-import os
 import random
-import subprocess
 import sys
-import threading
 import xml.etree.ElementTree as ET
 
 import numpy as np
@@ -42,6 +39,7 @@ except ModuleNotFoundError:
 from hannah.datasets.base import DatasetType
 from hannah.datasets.Kitti import Kitti
 from hannah.modules.augmentation.bordersearch import Parameter, ParameterRange
+from hannah.modules.augmentation.engine import AugmentationEngine
 
 
 class XmlAugmentationParser:
@@ -288,106 +286,35 @@ class XmlAugmentationParser:
         Image.fromarray(pil_img).save(kitti.aug_path + img)
 
 
-class AugmentationThread:
-    def __init__(self):
-        self.stop = True
-        self.running = False
-
-    def call_augment(self, conf, img, kitti, out):
-        if XmlAugmentationParser.parse(conf, img, kitti):
-            subprocess.call(
-                kitti.aug_path + "perform_augmentation.sh", stdout=subprocess.DEVNULL
-            )
-            if conf["double_augment"]:
-                XmlAugmentationParser.albumentations(
-                    dict((key, a[key]) for a in conf["albumentations"] for key in a),
-                    img,
-                    kitti,
-                    True,
-                )
-
-        if out is True:
-            print("Image augmented")
-
-    def augment_img(self, kitti, img, conf, reaugment, out):
-        if reaugment is True:
-            txt = open(kitti.aug_path + "/to_augment.txt", "w")
-            txt.write(img[:-4] + "\n")
-            txt.close()
-            self.call_augment(conf, img, kitti, out)
-        kitti.aug_files.append(img[:-4])
-
-    def augment(self, conf, kitti, pct, aug_new, out):
-        self.running = True
-        self.stop = False
-        reaugment = conf["reaugment_per_epoch_pct"]
-        num_augment = len(kitti.img_files) * (pct / 100)
-
-        for img in kitti.aug_files:
-            # Remove reaugment_per_epoch_pct images from augmentation list
-            if self.stop:
-                break
-
-            random.seed()
-            rand = random.randrange(0, 100)
-
-            if rand < reaugment:
-                kitti.aug_files.remove(img[:-4])
-
-        for img in kitti.img_files:
-            # Add images to augmentation list to reach augmented_pct and restart augmentation if necessary
-            if self.stop:
-                break
-            random.seed()
-            rand = random.randrange(0, 100)
-
-            if img[:-4] in kitti.aug_files and not os.path.isfile(kitti.aug_path + img):
-                self.augment_img(kitti, img, conf, True, out)
-            elif (
-                rand < pct
-                and len(kitti.aug_files) <= num_augment
-                and img[:-4] not in kitti.aug_files
-            ):
-                self.augment_img(kitti, img, conf, aug_new, out)
-        self.stop = True
-        self.running = False
-
-    def clear(self):
-        self.stop = True
-
-        while self.running:
-            continue
-
-
 class Augmentation:
     def __init__(self, augmentation: list()):
-        self.aug_thread = AugmentationThread()
         self.conf = dict((key, a[key]) for a in augmentation for key in a)
+        self.engine = AugmentationEngine(
+            num_workers=self.conf.get("augmentation_workers", 4),
+            batch_size=self.conf.get("augmentation_batch_size", 4),
+        )
         self.pct = self.conf["augmented_pct"] if "augmented_pct" in self.conf else 0
         self.bordersearch_epochs = self.conf["bordersearch_epoch_duration"]
+        self.bordersearch_runs = self.conf.get("bordersearch_runs", 1)
+        self.bordersearch_workers = self.conf.get("bordersearch_workers", 1)
+        self.bordersearch_async = self.conf.get("bordersearch_async", False)
         self.waterlevel = self.conf["bordersearch_waterlevel"]
         self.setEvalAttribs()
 
     def augment(self, kitti: Kitti):
-        kitti.aug_files = list()
+        self.engine.cancel(kitti)
         if self.pct != 0 and self.val_pct != 0:
-            self.aug_thread.clear()
-            th = threading.Thread(
-                target=self.aug_thread.augment,
-                args=(
-                    self.conf,
-                    kitti,
-                    self.pct if kitti.set_type == DatasetType.TRAIN else self.val_pct,
-                    self.reaugment,
-                    self.out,
-                ),
-                daemon=True,
+            self.engine.augment(
+                self.conf,
+                kitti,
+                self.pct if kitti.set_type == DatasetType.TRAIN else self.val_pct,
+                self.reaugment,
+                self.out,
             )
-            th.start()
 
             if self.wait is True:
                 print("######### WAIT FOR AUGMENTATION #########")
-                th.join()
+                self.engine.join(kitti)
 
     def fillParams(self):
         ignore = self.conf["bordersearch_ignore_params"]
@@ -16,15 +16,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import copy
+import functools
+import logging
 import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from dataclasses import dataclass
-from typing import Any, Callable, List, MutableMapping, Tuple
+from typing import Any, Callable, List, MutableMapping, Optional, Tuple
 
 import libsvm.svmutil as svmutil
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy import random
 
+msglogger = logging.getLogger(__name__)
+
 
 @dataclass
 class ParameterRange:
@@ -60,14 +71,16 @@ class Opts:
     active: bool
     augmentation_conf: MutableMapping[str, Any]
     best_path: str
+    gpus: List[int]
     sample_fun: Callable[[Any, int], List[List[float]]]
     dut_fun: Callable[[List[float]], float]
 
-    def __init__(self, parameters, runs, augmentation_conf, best_path):
+    def __init__(self, parameters, runs, augmentation_conf, best_path, gpus=None):
         self.parameters = parameters
         self.runs = runs
         self.augmentation_conf = augmentation_conf
         self.best_path = best_path
+        self.gpus = gpus if gpus is not None else []
         self.waterlevel = 1
         self.samples = 1000
         self.svm_params = "-s 4"
@@ -206,23 +219,173 @@ class Bordersearch:
         return conf
 
 
+class ConcurrentBordersearch(Bordersearch):
+    """Border search evaluating several candidates in parallel worker processes
+
+    Whenever an evaluation finishes, the svm boundary model is retrained with
+    all known results and new candidates are submitted, so that the workers are
+    kept busy. The search can run in a background thread using :meth:`start`,
+    while the caller continues and collects the result with :meth:`poll`.
+
+    Args:
+        num_workers (int): number of candidates evaluated concurrently
+    """
+
+    def __init__(self, num_workers: int = 2):
+        self.num_workers = max(1, num_workers)
+        self._thread: Optional[threading.Thread] = None
+        self._result = None
+        self._error: Optional[Exception] = None
+
+    def select_candidates(
+        self, opts: Opts, known: List[Tuple[List[float], float]], waterlevel, n: int
+    ) -> List[List[float]]:
+        """Select n new candidates, preferring candidates close to the svm decision boundary"""
+        candidates = opts.sample_fun(opts, max(opts.samples, n))
+        if len(known) == 0:
+            return candidates[:n]
+
+        above_wl = self.calc_above_wl(known, waterlevel)
+        parameter = svmutil.svm_parameter(
+            "-s 0 -t 2 -d 3 -g 0.5 -r 0 -c 100 -b 1 -m 20 -e 0.1 -q"
+        )
+        normalized_known = self.normalize(opts, [i[0] for i in known])
+        normalized_known = [
+            (param, z) for param, z in zip(normalized_known, [i[1] for i in known])
+        ]
+        model = self.svm_train(opts, above_wl, normalized_known, parameter)
+
+        if model.get_nr_class() < 2:
+            idx = random.choice(len(candidates), size=n, replace=False)
+        else:
+            weight_lambda = 20
+            _, _, probs = svmutil.svm_predict(
+                list(), self.normalize(opts, candidates), model, "-b 1 -q"
+            )
+            weights = np.array(
+                [math.exp(-weight_lambda * pow((prob[0] - 0.5), 2)) for prob in probs]
+            )
+            weights = weights / weights.sum()
+            idx = random.choice(len(candidates), size=n, replace=False, p=weights)
+
+        return [candidates[i] for i in idx]
+
+    def find_waterlevel(
+        self, opts: Opts, waterlevel: float
+    ) -> List[Tuple[List[float], float]]:
+        conf = list()
+        pending = dict()
+        submitted = 0
+
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            while len(conf) < opts.runs:
+                n = min(self.num_workers - len(pending), opts.runs - submitted)
+                if n > 0:
+                    for point in self.select_candidates(opts, conf, waterlevel, n):
+                        pending[pool.submit(opts.dut_fun, opts, point)] = point
+                        submitted += 1
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    point = pending.pop(future)
+                    z = future.result()
+                    msglogger.info("Bordersearch: %s -> %f", str(point), z)
+                    conf.append((point, z))
+
+        return conf
+
+    def _run(self, opts: Opts, waterlevel: float) -> None:
+        try:
+            self._result = self.find_waterlevel(opts, waterlevel)
+        except Exception as e:
+            self._error = e
+
+    def start(self, opts: Opts, waterlevel: float) -> None:
+        """Start the search in a background thread"""
+        if self.running:
+            raise RuntimeError("Bordersearch is already running")
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, args=(opts, waterlevel), daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def poll(self) -> Optional[List[Tuple[List[float], float]]]:
+        """Returns the result of a finished search started with :meth:`start` or None"""
+        if self._thread is None or self._thread.is_alive():
+            return None
+
+        self._thread = None
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+        return self._result
+
+
 def test_dut_fun(opts, params):
     return math.pow(params[0], 2) + math.pow(params[1], 2)
 
 
+def apply_params(augmentation_conf, parameters, point):
+    """Returns a copy of the augmentation config with the ranges of parameters fixed to the values of point"""
+    augmentation_conf = copy.deepcopy(dict(augmentation_conf))
+    for param, value in zip(parameters, point):
+        for c in augmentation_conf[param.catuuid]:
+            if param.uuid in c and c[param.uuid] is not None:
+                c[param.uuid] = [value, value]
+                break
+    return augmentation_conf
+
+
+def isolated_workdir(fun):
+    """Run each call of fun in its own temporary working directory
+
+    Datasets keep their augmented images below the working directory
+    (e.g. `Kitti.aug_path`), so candidates that are evaluated concurrently, and
+    the training the search is started from, would otherwise read and delete
+    each others augmentations. The directory is removed after the call.
+    """
+
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        cwd = os.getcwd()
+        workdir = tempfile.mkdtemp(prefix="bordersearch_", dir=cwd)
+        os.chdir(workdir)
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return wrapper
+
+
+@isolated_workdir
 def dut_fun(opts, params):
+    from hannah.tools.objectdetection_eval import eval as eval_detection
+
+    augmentation_conf = apply_params(opts.augmentation_conf, opts.parameters, params)
     augmentation = [
         {key: value}
-        for key, value in zip(
-            opts.augmentation_conf.keys(), opts.augmentation_conf.values()
-        )
+        for key, value in zip(augmentation_conf.keys(), augmentation_conf.values())
     ]
     conf = {
         "checkpoints": opts.best_path,
         "augmentation": augmentation,
-        "methods": "bordersearch",
+        "methods": ["bordersearch"],
+        "gpus": opts.gpus,
     }
-    result = eval(conf)
+    result = eval_detection(conf)
     return result[0]["bordersearch"][0]["val_ap"]
 
 
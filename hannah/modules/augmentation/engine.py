@@ -0,0 +1,344 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import hashlib
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Any, Dict, List, MutableMapping, Optional, Set, Tuple
+
+import numpy as np
+
+msglogger = logging.getLogger(__name__)
+
+
+class _AugmentationTarget:
+    """Minimal stand in for the kitti dataset used by the augmentation parsers
+
+    The parsers only need the location of the kitti folder and of the folder
+    the augmentations are written to, so only these are sent to the workers.
+    """
+
+    def __init__(self, kitti_dir: str, aug_path: str):
+        self.kitti_dir = kitti_dir
+        self.aug_path = aug_path
+
+
+def _write_augmentation_script(kitti_dir: str, work_dir: str) -> None:
+    script = os.path.join(work_dir, "perform_augmentation.sh")
+    if os.path.exists(script):
+        return
+
+    with open(os.path.join(kitti_dir, "augmentation", "perform_augmentation.sh")) as f:
+        content = f.read()
+    content = content[: content.rfind("-x") + 3] + work_dir + "augment.xml"
+    with open(script, "w") as f:
+        f.write(content)
+    os.chmod(script, 0o777)
+
+
+def _init_worker():
+    # Forked or spawned workers must not share the random state
+    random.seed()
+    np.random.seed()
+
+
+def _cache_file(work_dir: str, cache_dir: str, img: str) -> Optional[str]:
+    """Move an augmented image into the content addressed cache"""
+    augmented = work_dir + img
+    if not os.path.isfile(augmented):
+        return None
+
+    with open(augmented, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+
+    _, ext = os.path.splitext(img)
+    cached = os.path.join(cache_dir, digest + ext)
+    if os.path.exists(cached):
+        os.remove(augmented)
+    else:
+        os.replace(augmented, cached)
+
+    return cached
+
+
+def augment_batch(
+    conf: MutableMapping[str, Any],
+    kitti_dir: str,
+    work_root: str,
+    cache_dir: str,
+    imgs: List[str],
+) -> List[Tuple[str, Optional[str]]]:
+    """Augments a batch of images in a worker process
+
+    Each worker uses its own working directory, so that the configuration files
+    of the external weather simulation do not collide between workers.
+
+    Returns:
+        list of (image name, path of the augmented image in the cache or None if augmentation failed)
+    """
+    from .augmentation import XmlAugmentationParser
+
+    work_dir = os.path.join(work_root, f"worker_{os.getpid()}") + "/"
+    os.makedirs(work_dir, exist_ok=True)
+    target = _AugmentationTarget(kitti_dir, work_dir)
+
+    results = []
+    for img in imgs:
+        try:
+            if XmlAugmentationParser.parse(conf, img, target):
+                _write_augmentation_script(kitti_dir, work_dir)
+                with open(work_dir + "to_augment.txt", "w") as txt:
+                    txt.write(img[:-4] + "\n")
+                subprocess.call(
+                    work_dir + "perform_augmentation.sh", stdout=subprocess.DEVNULL
+                )
+                if conf["double_augment"]:
+                    XmlAugmentationParser.albumentations(
+                        dict(
+                            (key, a[key]) for a in conf["albumentations"] for key in a
+                        ),
+                        img,
+                        target,
+                        True,
+                    )
+            results.append((img, _cache_file(work_dir, cache_dir, img)))
+        except Exception as e:
+            msglogger.error("Augmentation of %s failed: %s", img, str(e))
+            results.append((img, None))
+
+    return results
+
+
+class AugmentationEngine:
+    """Augments kitti images in a process pool
+
+    Augmented images are written to a content addressed cache and published as
+    symbolic links in the readiness folder of the dataset (`kitti.aug_index_path`)
+    as soon as a batch is finished. So the dataset, including forked dataloader
+    workers, can pick them up while the remaining batches are still being processed.
+
+    Cached files are never overwritten, instead the engine tracks which splits
+    and which entries of its cache index reference a file and deletes it once
+    it is no longer referenced. So datasets can read them without copying.
+
+    Args:
+        num_workers (int): number of worker processes
+        batch_size (int): number of images per task submitted to the pool
+    """
+
+    def __init__(self, num_workers: int = 4, batch_size: int = 4):
+        self.num_workers = max(1, num_workers)
+        self.batch_size = max(1, batch_size)
+
+        self.cache_index: Dict[str, str] = {}
+
+        self._refs: Dict[str, Set[Any]] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._futures: Dict[Any, List[Any]] = {}
+        self._generation: Dict[Any, int] = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return self._pool
+
+    def _acquire(self, holder: Any, path: str) -> None:
+        self._refs.setdefault(path, set()).add(holder)
+
+    def _release(self, holder: Any, path: str) -> None:
+        holders = self._refs.get(path)
+        if holders is None:
+            return
+        holders.discard(holder)
+        if not holders:
+            del self._refs[path]
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _announce(self, kitti, name: str, path: str) -> None:
+        self._acquire(kitti.set_type, path)
+
+        os.makedirs(kitti.aug_index_path, exist_ok=True)
+        link = os.path.join(kitti.aug_index_path, name)
+        tmp_link = link + ".tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        # replacing the link is atomic, so readers never see a missing image
+        os.symlink(os.path.abspath(path), tmp_link)
+        os.replace(tmp_link, link)
+
+    @staticmethod
+    def cache_dir(kitti) -> str:
+        return os.path.join(kitti.aug_path, "cache")
+
+    @staticmethod
+    def work_dir(kitti) -> str:
+        return os.path.join(kitti.aug_path, "work")
+
+    def select(
+        self, conf: MutableMapping[str, Any], kitti, pct: float, reaugment: bool
+    ) -> Tuple[List[str], List[str]]:
+        """Select the images augmented in this epoch
+
+        If `reaugment` is set, reaugment_per_epoch_pct percent of the selected
+        images that already have a cached augmentation are augmented again.
+
+        Returns:
+            (images whose cached augmentation is reused, images that need to be augmented)
+        """
+        reaugment_pct = conf["reaugment_per_epoch_pct"]
+        num_augment = len(kitti.img_files) * (pct / 100)
+
+        reuse = []
+        todo = []
+        for img in kitti.img_files:
+            if len(reuse) + len(todo) > num_augment:
+                break
+            if random.randrange(0, 100) >= pct:
+                continue
+
+            cached = self.cache_index.get(img[:-4])
+            if cached is not None and os.path.isfile(cached):
+                if not reaugment or random.randrange(0, 100) >= reaugment_pct:
+                    reuse.append(img)
+                    continue
+            todo.append(img)
+
+        return reuse, todo
+
+    def augment(
+        self,
+        conf: MutableMapping[str, Any],
+        kitti,
+        pct: float,
+        reaugment: bool,
+        out: bool = False,
+    ) -> None:
+        """Schedule augmentation of the images of a kitti split
+
+        Cancels augmentations of the same split scheduled by a previous call.
+        """
+        self.cancel(kitti)
+
+        random.seed()
+        reuse, todo = self.select(conf, kitti, pct, reaugment)
+
+        with self._lock:
+            for img in reuse:
+                self._announce(kitti, img[:-4], self.cache_index[img[:-4]])
+
+        if not todo:
+            return
+
+        cache_dir = self.cache_dir(kitti)
+        work_root = self.work_dir(kitti)
+        os.makedirs(cache_dir, exist_ok=True)
+        os.makedirs(work_root, exist_ok=True)
+
+        pool = self._get_pool()
+        key = kitti.set_type
+        generation = self._generation.get(key, 0)
+        conf = dict(conf)
+
+        futures = []
+        for start in range(0, len(todo), self.batch_size):
+            batch = todo[start : start + self.batch_size]
+            future = pool.submit(
+                augment_batch, conf, kitti.kitti_dir, work_root, cache_dir, batch
+            )
+            future.add_done_callback(
+                lambda f, generation=generation: self._collect(
+                    f, kitti, generation, out
+                )
+            )
+            futures.append(future)
+
+        with self._lock:
+            self._futures[key] = futures
+
+    def _collect(self, future, kitti, generation: int, out: bool) -> None:
+        if future.cancelled():
+            return
+        try:
+            results = future.result()
+        except Exception as e:
+            msglogger.error("Augmentation worker failed: %s", str(e))
+            return
+
+        with self._lock:
+            if generation != self._generation.get(kitti.set_type, 0):
+                return
+            for img, cached in results:
+                if cached is None:
+                    continue
+                name = img[:-4]
+                previous = self.cache_index.get(name)
+                self._acquire(("index", name), cached)
+                if previous is not None:
+                    self._release(("index", name), previous)
+                self.cache_index[name] = cached
+                self._announce(kitti, name, cached)
+                if out is True:
+                    print("Image augmented")
+
+    def join(self, kitti) -> None:
+        """Block until all scheduled augmentations of a split are finished"""
+        with self._lock:
+            futures = list(self._futures.get(kitti.set_type, []))
+        wait(futures)
+
+    def cancel(self, kitti) -> None:
+        """Cancel scheduled augmentations of a split and drop results of running ones
+
+        Also releases all cached files referenced by the split and removes its
+        published images.
+        """
+        key = kitti.set_type
+        with self._lock:
+            self._generation[key] = self._generation.get(key, 0) + 1
+            for future in self._futures.get(key, []):
+                future.cancel()
+            self._futures[key] = []
+
+            for path in [p for p, holders in self._refs.items() if key in holders]:
+                self._release(key, path)
+
+            shutil.rmtree(kitti.aug_index_path, ignore_errors=True)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for futures in self._futures.values():
+                for future in futures:
+                    future.cancel()
+            self._futures = {}
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -41,6 +41,7 @@ from pytorch_lightning.utilities.distributed import rank_zero_only
 from torchmetrics import MetricCollection
 
 from ..models.factory.qat import QAT_MODULE_MAPPINGS
+from ..profiling import region
 from ..utils import fullname
 from .metrics import plot_confusion_matrix
 
@@ -135,6 +136,10 @@ class ClassifierModule(LightningModule, ABC):
 
     @rank_zero_only
     def _log_weight_distribution(self):
+        with region("log_weight_distribution"):
+            self._log_histograms()
+
+    def _log_histograms(self):
         for name, params in self.named_parameters():
             loggers = self._logger_iterator()
 
@@ -18,8 +18,9 @@
 #
 import logging
 import platform
+import time
 from abc import abstractmethod
-from typing import Dict, Optional, Union
+from typing import Dict, Optional, Tuple, Union
 
 import numpy as np
 import tabulate
@@ -43,10 +44,12 @@ from torchmetrics import (
     Recall,
 )
 
-from hannah.datasets.base import ctc_collate_fn
+from hannah.datasets.base import BucketBatchSampler, ctc_collate_fn
 
 from ..datasets import SpeechDataset
+from ..features import StreamingFeatures
 from ..models.factory.qat import QAT_MODULE_MAPPINGS
+from ..profiling import region
 from ..utils import set_deterministic
 from .base import ClassifierModule
 from .config_utils import get_loss_function, get_model
@@ -176,20 +179,23 @@ class BaseStreamClassifierModule(ClassifierModule):
         pass
 
     def calculate_batch_metrics(self, output, y, loss, metrics, prefix):
-        if isinstance(output, list):
-            for idx, out in enumerate(output):
-                out = torch.nn.functional.softmax(out, dim=1)
-                metrics(out, y)
-                self.log_dict(metrics)
-        else:
-            try:
-                output = torch.nn.functional.softmax(output, dim=1)
-                metrics(output, y)
-                self.log_dict(metrics)
-            except ValueError as e:
-                logging.critical(f"Could not calculate batch metrics: output={output}")
-
-        self.log(f"{prefix}_loss", loss)
+        with region("metrics"):
+            if isinstance(output, list):
+                for idx, out in enumerate(output):
+                    out = torch.nn.functional.softmax(out, dim=1)
+                    metrics(out, y)
+                    self.log_dict(metrics)
+            else:
+                try:
+                    output = torch.nn.functional.softmax(output, dim=1)
+                    metrics(output, y)
+                    self.log_dict(metrics)
+                except ValueError as e:
+                    logging.critical(
+                        f"Could not calculate batch metrics: output={output}"
+                    )
+
+            self.log(f"{prefix}_loss", loss)
 
     # TRAINING CODE
     def training_step(self, batch, batch_idx):
@@ -208,25 +214,64 @@ class BaseStreamClassifierModule(ClassifierModule):
     def train_dataloader(self):
         pass
 
-    def get_train_dataloader_by_set(self, train_set):
+    def get_train_dataloader_by_set(self, train_set, collate_fn=ctc_collate_fn):
         train_batch_size = self.hparams["batch_size"]
         dataset_conf = self.hparams.dataset
-        sampler = data.RandomSampler(train_set)
 
-        train_loader = data.DataLoader(
-            train_set,
-            batch_size=train_batch_size,
-            drop_last=True,
-            num_workers=self.hparams["num_workers"],
-            collate_fn=ctc_collate_fn,
-            sampler=sampler,
-            multiprocessing_context="fork" if self.hparams["num_workers"] > 0 else None,
-        )
+        lengths = None
+        if dataset_conf.get("sampler", "random") == "bucket":
+            lengths = self._get_sequence_lengths(train_set)
+            if lengths is None:
+                msglogger.warning(
+                    "Dataset does not provide sequence lengths, using random sampler"
+                )
+
+        if lengths is not None:
+            batch_sampler = BucketBatchSampler(
+                lengths,
+                train_batch_size,
+                drop_last=True,
+                bucket_size=dataset_conf.get("bucket_size", 100),
+            )
+            train_loader = data.DataLoader(
+                train_set,
+                batch_sampler=batch_sampler,
+                num_workers=self.hparams["num_workers"],
+                collate_fn=collate_fn,
+                multiprocessing_context="fork"
+                if self.hparams["num_workers"] > 0
+                else None,
+            )
+        else:
+            sampler = data.RandomSampler(train_set)
+            train_loader = data.DataLoader(
+                train_set,
+                batch_size=train_batch_size,
+                drop_last=True,
+                num_workers=self.hparams["num_workers"],
+                collate_fn=collate_fn,
+                sampler=sampler,
+                multiprocessing_context="fork"
+                if self.hparams["num_workers"] > 0
+                else None,
+            )
 
         self.batches_per_epoch = len(train_loader)
 
         return train_loader
 
+    @classmethod
+    def _get_sequence_lengths(cls, dataset):
+        if isinstance(dataset, data.ConcatDataset):
+            lengths = [cls._get_sequence_lengths(d) for d in dataset.datasets]
+            if any(length is None for length in lengths):
+                return None
+            return np.concatenate(lengths)
+
+        if not hasattr(dataset, "sequence_lengths"):
+            return None
+        return dataset.sequence_lengths()
+
     def on_train_epoch_end(self):
         self.eval()
         self._log_weight_distribution()
@@ -305,22 +350,112 @@ class BaseStreamClassifierModule(ClassifierModule):
 
     def _extract_features(self, x):
         x = self.features(x)
+        return self._flatten_features(x)
 
+    def _flatten_features(self, x):
         if x.dim() == 4 and self.example_input_array.dim() == 3:
             new_channels = x.size(1) * x.size(2)
             x = torch.reshape(x, (x.size(0), new_channels, x.size(3)))
 
         return x
 
+    @torch.no_grad()
+    def streaming_inference(
+        self, waveform: torch.Tensor, hop_ms: Optional[float] = None
+    ) -> Tuple[torch.Tensor, float]:
+        """Classifies a continuous recording with a sliding window
+
+        Features are extracted incrementally and kept in a ring buffer with the
+        length of the model input, so each hop only computes the features of
+        the new frames before the model is run on the current window.
+
+        Args:
+            waveform (torch.Tensor): recording of shape (time) or (channels, time)
+            hop_ms (float): hop between two windows in ms,
+                defaults to hparams.stream_hop_ms or 100 ms
+
+        Returns:
+            (model outputs of shape (windows, classes), real time factor)
+        """
+        if hop_ms is None:
+            hop_ms = self.hparams.get("stream_hop_ms", 100)
+
+        samplingrate = self.hparams.dataset.get("samplingrate", 16000)
+        hop = max(1, int(samplingrate * hop_ms / 1000))
+        window_frames = self.example_feature_array.shape[-1]
+
+        if waveform.dim() == 1:
+            waveform = waveform.unsqueeze(0)
+        waveform = waveform.unsqueeze(0).to(self.device)
+
+        was_training = self.training
+        self.eval()
+
+        features = StreamingFeatures(self.features)
+        ring = None
+        ring_pos = 0
+        filled = 0
+        outputs = []
+
+        start = time.perf_counter()
+        for chunk_start in range(0, waveform.shape[-1], hop):
+            frames = features(waveform[..., chunk_start : chunk_start + hop])
+            if frames is None:
+                continue
+            frames = self._flatten_features(frames)[..., -window_frames:]
+
+            if ring is None:
+                ring = frames.new_zeros(frames.shape[:-1] + (window_frames,))
+            num_frames = frames.shape[-1]
+            index = (ring_pos + torch.arange(num_frames)) % window_frames
+            ring[..., index.to(ring.device)] = frames
+            ring_pos = (ring_pos + num_frames) % window_frames
+            filled = min(window_frames, filled + num_frames)
+            if filled < window_frames:
+                continue
+
+            window = torch.cat((ring[..., ring_pos:], ring[..., :ring_pos]), dim=-1)
+            output = self.model(self.normalizer(window))
+            if isinstance(output, list):
+                output = output[-1]
+            outputs.append(output)
+
+        if waveform.device.type == "cuda":
+            torch.cuda.synchronize(waveform.device)
+        elapsed = time.perf_counter() - start
+
+        self.train(was_training)
+
+        duration = waveform.shape[-1] / samplingrate
+        rtf = elapsed / duration if duration > 0 else 0.0
+        msglogger.info(
+            "Streaming inference: %d windows of %.1f s audio in %.3f s (RTF %.4f)",
+            len(outputs),
+            duration,
+            elapsed,
+            rtf,
+        )
+
+        if outputs:
+            outputs = torch.cat(outputs)
+        else:
+            outputs = torch.zeros(0, self.num_classes, device=self.device)
+
+        return outputs, rtf
+
     def forward(self, x):
-        x = self._extract_features(x)
+        with region("features"):
+            x = self._extract_features(x)
 
         if self.training:
-            x = self.augmentation(x)
+            with region("augmentation"):
+                x = self.augmentation(x)
 
-        x = self.normalizer(x)
+        with region("normalizer"):
+            x = self.normalizer(x)
 
-        x = self.model(x)
+        with region("model"):
+            x = self.model(x)
         return x
 
     def _log_audio(self, x, logits, y):
@@ -369,6 +504,7 @@ class CrossValidationStreamClassifierModule(BaseStreamClassifierModule):
         super().__init__(*args, **kwargs)
         self.trainer_fold_callback = None
         self.sets_by_criteria = None
+        self.fold_splits = None
         self.k_fold = self.hparams.dataset.k_fold
         self.test_end_callback_function = None
 
@@ -379,9 +515,12 @@ class CrossValidationStreamClassifierModule(BaseStreamClassifierModule):
         return get_class(self.hparams.dataset.cls).get_num_classes()
 
     def get_split(self):
-        self.sets_by_criteria = get_class(self.hparams.dataset.cls).splits_cv(
-            self.hparams.dataset
-        )
+        # sets_by_criteria and fold_splits may be set by the trainer, so that the
+        # folds of all copies of the module share the same index
+        if self.sets_by_criteria is None:
+            self.sets_by_criteria = get_class(self.hparams.dataset.cls).splits_cv(
+                self.hparams.dataset
+            )
         return self.prepare_dataloaders(self.sets_by_criteria)
 
     def get_example_input_array(self):
@@ -392,10 +531,12 @@ class CrossValidationStreamClassifierModule(BaseStreamClassifierModule):
     def prepare_dataloaders(self, sets_by_criteria):
         assert self.k_fold >= len(["train", "val", "test"])
 
-        rng = np.random.default_rng()
-        subsets = np.arange(len(sets_by_criteria))
-        rng.shuffle(subsets)
-        splits = np.array_split(subsets, self.k_fold)
+        if self.fold_splits is None:
+            rng = np.random.default_rng()
+            subsets = np.arange(len(sets_by_criteria))
+            rng.shuffle(subsets)
+            self.fold_splits = np.array_split(subsets, self.k_fold)
+        splits = list(self.fold_splits)
 
         train_sets, dev_sets, test_sets = [], [], []
 
@@ -0,0 +1,203 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Tuple
+
+import matplotlib.image as mpimg
+import matplotlib.patches as patches
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+msglogger = logging.getLogger(__name__)
+
+
+def _render_detections(
+    image_file: str,
+    gt_boxes: List[Tuple[List[float], str]],
+    dt_boxes: List[Tuple[List[float], str]],
+) -> np.ndarray:
+    """Render ground truth (blue) and detected (red) boxes onto an image
+
+    Uses the object oriented matplotlib api, so that it can safely be called
+    from a background thread.
+
+    Returns:
+        np.ndarray: rendered image in HWC layout with dtype uint8
+    """
+    img = mpimg.imread(image_file)
+
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.imshow(img)
+    ax.set_axis_off()
+
+    for box, _name in gt_boxes:
+        rect = patches.Rectangle(
+            (box[0], box[1]),
+            box[2],
+            box[3],
+            linewidth=1,
+            edgecolor="b",
+            facecolor="none",
+        )
+        ax.add_patch(rect)
+
+    for box, name in dt_boxes:
+        rect = patches.Rectangle(
+            (box[0], box[1]),
+            box[2],
+            box[3],
+            linewidth=1,
+            edgecolor="r",
+            facecolor="none",
+        )
+        ax.text(box[0], box[1], name, color="red", fontsize=10)
+        ax.add_patch(rect)
+
+    canvas.draw()
+    rendered = np.asarray(canvas.buffer_rgba())[..., :3].copy()
+
+    return rendered
+
+
+class DetectionVisualizer:
+    """Samples a bounded number of detection results per epoch and renders them in a background thread
+
+    Rendering does not touch the validation / test hot path, the only work done
+    on the calling thread is collecting the bounding boxes of the sampled images.
+    Finished renderings are written to the experiment loggers by :meth:`flush`.
+
+    Args:
+        enabled (bool): enable visualization, if disabled all methods are no-ops
+        images_per_epoch (int): maximum number of images rendered per epoch and stage
+        save_dir (str): if not empty, rendered images are additionally saved to this folder
+    """
+
+    def __init__(
+        self, enabled: bool = False, images_per_epoch: int = 8, save_dir: str = ""
+    ):
+        self.enabled = enabled
+        self.images_per_epoch = images_per_epoch
+        self.save_dir = save_dir
+
+        self._executor = None
+        self._pending: List[Tuple[str, Any]] = []
+        self._sampled: Dict[str, int] = {}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="detection_visualizer"
+            )
+        return self._executor
+
+    def reset(self, stage: str) -> None:
+        """Reset the sample budget of a stage, should be called at the start of each epoch"""
+        self._sampled[stage] = 0
+
+    def sample(self, stage: str, cocoGt, cocoDt, y: Iterable[Dict[str, Any]]) -> None:
+        """Schedule rendering of the images of a batch until the epoch budget is exhausted
+
+        Args:
+            stage (str): name of the stage e.g. 'val' or 'test'
+            cocoGt: ground truth coco object, the index must be up to date
+            cocoDt: detection coco object for this batch
+            y: targets of the batch as returned by the dataset
+        """
+        if not self.enabled:
+            return
+
+        for y_img in y:
+            if self._sampled.get(stage, 0) >= self.images_per_epoch:
+                return
+
+            filename = y_img["filename"]
+            image_file = y_img["img_file"]
+            img_id = cocoGt.getImgId(filename)
+
+            gt_boxes = self._collect_boxes(cocoGt, cocoGt, img_id)
+            dt_boxes = self._collect_boxes(cocoGt, cocoDt, img_id)
+
+            future = self._get_executor().submit(
+                _render_detections, image_file, gt_boxes, dt_boxes
+            )
+            tag = f"{stage}_detections/{os.path.basename(filename)}"
+            self._pending.append((tag, future))
+            self._sampled[stage] = self._sampled.get(stage, 0) + 1
+
+    @staticmethod
+    def _collect_boxes(cocoGt, coco, img_id) -> List[Tuple[List[float], str]]:
+        boxes = []
+        for ann in coco.loadAnns(coco.getAnnIds(imgIds=img_id)):
+            category_id = ann["category_id"]
+            if category_id in cocoGt.labels_ignore:
+                continue
+            name = (
+                cocoGt.cats[category_id]["name"]
+                if category_id in cocoGt.cats
+                else "undefined"
+            )
+            boxes.append((list(ann["bbox"]), name))
+        return boxes
+
+    def flush(self, loggers: Iterable[Any], global_step: int, wait: bool = False):
+        """Write finished renderings to the loggers
+
+        Args:
+            loggers: lightning loggers, images are written to all loggers supporting add_image
+            global_step (int): step used for logging
+            wait (bool): block until all scheduled renderings are finished
+        """
+        if not self._pending:
+            return
+
+        pending = []
+        for tag, future in self._pending:
+            if not wait and not future.done():
+                pending.append((tag, future))
+                continue
+
+            try:
+                image = future.result()
+            except Exception as e:
+                msglogger.warning("Could not render detections for %s: %s", tag, str(e))
+                continue
+
+            for logger in loggers:
+                if hasattr(logger.experiment, "add_image"):
+                    logger.experiment.add_image(
+                        tag, image, global_step=global_step, dataformats="HWC"
+                    )
+
+            if self.save_dir:
+                os.makedirs(self.save_dir, exist_ok=True)
+                mpimg.imsave(
+                    os.path.join(self.save_dir, tag.replace("/", "_") + ".png"), image
+                )
+
+        self._pending = pending
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
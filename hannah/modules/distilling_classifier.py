@@ -16,8 +16,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
+import json
 import logging
 import math
+import os
 import random
 from copy import deepcopy
 from typing import List, Optional, Union
@@ -25,11 +28,26 @@ from typing import List, Optional, Union
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from omegaconf import DictConfig
+import torch.utils.data as data
+from omegaconf import DictConfig, OmegaConf
 from torch.autograd import grad
 from torchmetrics import Accuracy
 
 from .classifier import StreamClassifierModule
+from .teacher_cache import (
+    AugmentationViewDataset,
+    TeacherCache,
+    TeacherCacheWriter,
+    indexed_collate_fn,
+)
+
+msglogger = logging.getLogger(__name__)
+
+# losses using teacher feature maps instead of logits
+FEATURE_LOSSES = ["RKD", "PKT", "AT", "CC", "Hint", "NST", "SP"]
+
+# losses that need gradients through the teachers or do not use teachers
+UNCACHEABLE_LOSSES = ["Sobolev", "LwM", "TFVirtual", "TFself", "TFself_Loss"]
 
 
 class SpeechKDClassifierModule(StreamClassifierModule):
@@ -54,6 +72,7 @@ class SpeechKDClassifierModule(StreamClassifierModule):
         noise_variance: float = 0.1,
         correct_prob: float = 0.9,
         export_onnx: bool = True,
+        teacher_cache: Optional[DictConfig] = None,
         gpus=None,
     ):
         super().__init__(
@@ -119,6 +138,19 @@ class SpeechKDClassifierModule(StreamClassifierModule):
         self.teacher_checkpoints = teacher_checkpoint
         self.freeze_teachers = freeze_teachers
 
+        self.teacher_cache_conf = teacher_cache if teacher_cache is not None else {}
+        self.teacher_cache = None
+        self.use_teacher_cache = self.teacher_cache_conf.get("enabled", False)
+        if self.use_teacher_cache and (
+            self.distillation_loss in UNCACHEABLE_LOSSES or not teacher_checkpoint
+        ):
+            msglogger.warning(
+                "Teacher cache is not supported for distillation loss %s, "
+                "running the teachers on each batch",
+                self.distillation_loss,
+            )
+            self.use_teacher_cache = False
+
     def setup(self, stage):
         super().setup(stage)
         super().prepare_data()
@@ -133,6 +165,7 @@ class SpeechKDClassifierModule(StreamClassifierModule):
             params.pop("alpha")
             params.pop("noise_variance")
             params.pop("correct_prob")
+            params.pop("teacher_cache", None)
             teacher_module = StreamClassifierModule(**params)
             teacher_module.trainer = deepcopy(self.trainer)
             teacher_module.model = deepcopy(self.model)
@@ -173,6 +206,112 @@ class SpeechKDClassifierModule(StreamClassifierModule):
         self.teacher_accuracies = nn.ModuleList([Accuracy() for t in self.teachers])
         self.teacher_loaded = True
 
+    def on_train_start(self):
+        super().on_train_start()
+        if self.use_teacher_cache and self.teacher_cache is None:
+            self.teacher_cache = self._load_teacher_cache()
+
+    def train_dataloader(self):
+        if not self.use_teacher_cache:
+            return super().train_dataloader()
+
+        # Each sample is drawn in one of a fixed number of augmentation views, so
+        # that the cached teacher outputs match the augmented student inputs
+        train_set = AugmentationViewDataset(
+            self.train_set,
+            num_views=self.teacher_cache_conf.get("views", 1),
+            seed=self.teacher_cache_conf.get("seed", 1234),
+        )
+        return self.get_train_dataloader_by_set(
+            train_set, collate_fn=indexed_collate_fn
+        )
+
+    def _teacher_cache_key(self, num_views, seed, store_features):
+        checkpoints = []
+        for checkpoint_file in self.teacher_checkpoints:
+            stat = os.stat(checkpoint_file)
+            checkpoints.append(
+                [os.path.abspath(checkpoint_file), stat.st_size, stat.st_mtime]
+            )
+
+        dataset = self.hparams.dataset
+        if isinstance(dataset, DictConfig):
+            dataset = OmegaConf.to_container(dataset, resolve=True)
+
+        description = {
+            "checkpoints": checkpoints,
+            "dataset": dataset,
+            "num_samples": len(self.train_set),
+            "num_views": num_views,
+            "seed": seed,
+            "features": store_features,
+        }
+        description = json.dumps(description, sort_keys=True, default=str)
+
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def _load_teacher_cache(self) -> TeacherCache:
+        """Opens the teacher cache of the current configuration or precomputes it"""
+        num_views = self.teacher_cache_conf.get("views", 1)
+        seed = self.teacher_cache_conf.get("seed", 1234)
+        store_features = (
+            self.teacher_cache_conf.get("features", False)
+            or self.distillation_loss in FEATURE_LOSSES
+        )
+
+        key = self._teacher_cache_key(num_views, seed, store_features)
+        folder = os.path.join(
+            self.teacher_cache_conf.get("folder", "teacher_cache"), key[:16]
+        )
+
+        cache = TeacherCache.open(folder, key)
+        if cache is not None:
+            msglogger.info("Using cached teacher outputs from %s", folder)
+            return cache
+
+        msglogger.info(
+            "Precomputing teacher outputs for %d augmentation views in %s",
+            num_views,
+            folder,
+        )
+        writer = TeacherCacheWriter(
+            folder,
+            key,
+            num_views=num_views,
+            num_samples=len(self.train_set),
+            num_teachers=len(self.teachers),
+            store_features=store_features,
+        )
+
+        for teacher in self.teachers:
+            teacher.eval()
+
+        num_workers = self.hparams["num_workers"]
+        for view in range(num_views):
+            loader = data.DataLoader(
+                AugmentationViewDataset(
+                    self.train_set, num_views=num_views, seed=seed, view=view
+                ),
+                batch_size=self.teacher_cache_conf.get(
+                    "batch_size", self.hparams["batch_size"]
+                ),
+                shuffle=False,
+                num_workers=num_workers,
+                collate_fn=indexed_collate_fn,
+                multiprocessing_context="fork" if num_workers > 0 else None,
+            )
+            with torch.no_grad():
+                for x, _, _, _, indices, _ in loader:
+                    x = x.to(self.device)
+                    teacher_logits = []
+                    teacher_feat = []
+                    for teacher in self.teachers:
+                        teacher_logits.append(teacher(x))
+                        teacher_feat.append(teacher.model.feat)
+                    writer.write(indices, view, teacher_logits, teacher_feat)
+
+        return writer.close()
+
     """
     Code taken from Paper: "KD-Lib: A PyTorch library for Knowledge Distillation, Pruning and Quantization"
     arxiv: 2011.14691
@@ -684,17 +823,30 @@ class SpeechKDClassifierModule(StreamClassifierModule):
 
     def training_step(self, batch, batch_idx):
         # x inputs, y labels
-        x, x_len, y, y_len = batch
+        if len(batch) == 6:
+            # sample indices and augmentation views of the teacher cache
+            x, x_len, y, y_len, indices, views = batch
+        else:
+            x, x_len, y, y_len = batch
+            indices = None
 
         student_logits = self.forward(x)
         student_feat = self.model.feat
-        teacher_logits = []
-        teacher_feat = []
-        for teacher in self.teachers:
-            teacher.eval()
-            with torch.no_grad():
-                teacher_logits.append(teacher(x))
-                teacher_feat.append(teacher.model.feat)
+        if indices is not None and self.teacher_cache is not None:
+            teacher_logits, teacher_feat = self.teacher_cache.lookup(
+                indices,
+                views,
+                device=student_logits.device,
+                dtype=student_logits.dtype,
+            )
+        else:
+            teacher_logits = []
+            teacher_feat = []
+            for teacher in self.teachers:
+                teacher.eval()
+                with torch.no_grad():
+                    teacher_logits.append(teacher(x))
+                    teacher_feat.append(teacher.model.feat)
 
         y = y.view(-1)
 
@@ -17,6 +17,9 @@
 # limitations under the License.
 #
 import logging
+import os
+import shutil
+from typing import Optional
 
 from .classifier import ClassifierModule
 from .config_utils import get_loss_function, get_model
@@ -34,22 +37,35 @@ from hydra.utils import get_class, instantiate
 from hannah.datasets.Kitti import object_collate_fn
 from hannah.modules.augmentation.augmentation import Augmentation
 from hannah.modules.augmentation.bordersearch import (
-    Bordersearch,
+    ConcurrentBordersearch,
     Opts,
     dut_fun,
     random_sample,
 )
+from hannah.modules.detection_visualization import DetectionVisualizer
 
 msglogger = logging.getLogger(__name__)
 
 
 class ObjectDetectionModule(ClassifierModule):
-    def __init__(self, augmentation: list(), *args, **kwargs):
+    def __init__(
+        self,
+        augmentation: list(),
+        *args,
+        visualization: Optional[dict] = None,
+        **kwargs,
+    ):
         self.augmentation = Augmentation(augmentation)
         self.borderparams = self.augmentation.fillParams()
+        self.bordersearch_runner = ConcurrentBordersearch(
+            self.augmentation.bordersearch_workers
+        )
         self.first_step = True
         super().__init__(*args, **kwargs)
 
+        visualization = visualization if visualization is not None else {}
+        self.visualizer = DetectionVisualizer(**visualization)
+
         if COCOeval is None:
             msglogger.error("Could not find cocotools")
             msglogger.error("please install with poetry install -E object-detection")
@@ -107,27 +123,55 @@ class ObjectDetectionModule(ClassifierModule):
         return x
 
     def bordersearch(self):
-        print("################# Bordersearch starts #################")
-        brs = Bordersearch()
+        best_path = self.trainer.checkpoint_callback.best_model_path
+        if not best_path:
+            msglogger.warning("No checkpoint available, skipping bordersearch")
+            return
+
+        # The search evaluates a frozen snapshot of the model, so training
+        # can continue while it is running
+        snapshot_path = os.path.abspath("bordersearch_snapshot.ckpt")
+        shutil.copy2(best_path, snapshot_path)
+
+        # evaluate the candidates on the devices used for training
+        gpus = list(self.trainer.device_ids) if self.device.type == "cuda" else None
         opts = Opts(
             parameters=self.borderparams,
-            runs=1,
+            runs=self.augmentation.bordersearch_runs,
             augmentation_conf=self.augmentation.conf,
-            best_path=self.trainer.checkpoint_callback.best_model_path,
+            best_path=snapshot_path,
+            gpus=gpus,
         )
         opts.dut_fun = dut_fun
         opts.sample_fun = random_sample
-        conf = brs.find_waterlevel(opts, self.augmentation.waterlevel)
-        self.augmentation.changeParams(self.borderparams, conf)
-        print("################# Bordersearch ends #################")
+
+        if self.augmentation.bordersearch_async:
+            print("################# Bordersearch started #################")
+            self.bordersearch_runner.start(opts, self.augmentation.waterlevel)
+        else:
+            print("################# Bordersearch starts #################")
+            conf = self.bordersearch_runner.find_waterlevel(
+                opts, self.augmentation.waterlevel
+            )
+            self.augmentation.changeParams(self.borderparams, conf)
+            print("################# Bordersearch ends #################")
+
+    def _update_bordersearch(self):
+        """Applies the result of a finished asynchronous bordersearch"""
+        conf = self.bordersearch_runner.poll()
+        if conf is not None:
+            self.augmentation.changeParams(self.borderparams, conf)
+            print("################# Bordersearch finished #################")
 
     def train_dataloader(self):
+        self._update_bordersearch()
 
         if (
             self.trainer.current_epoch != 0
             and self.augmentation.pct != 0
             and (self.trainer.current_epoch % self.augmentation.bordersearch_epochs)
             == 0
+            and not self.bordersearch_runner.running
         ):
             self.bordersearch()
 
@@ -200,14 +244,30 @@ class ObjectDetectionModule(ClassifierModule):
 
         return test_loader
 
+    def on_validation_epoch_start(self):
+        self.visualizer.reset("val")
+
+    def on_validation_epoch_end(self):
+        super().on_validation_epoch_end()
+        self.visualizer.flush(self._logger_iterator(), self.current_epoch)
+
+    def on_test_epoch_start(self):
+        self.visualizer.reset("test")
+
+    def on_test_epoch_end(self):
+        self.visualizer.flush(self._logger_iterator(), self.current_epoch, wait=True)
+
+    def on_fit_end(self):
+        self.visualizer.flush(self._logger_iterator(), self.current_epoch, wait=True)
+
     def validation_step(self, batch, batch_idx):
-        x, y = batch
+        x, y, _ = batch
         cocoGt = self.dev_set.getCocoGt()
         cocoGt.createIndex()
 
         output = self(x)
         cocoDt = self.model.transformOutput(cocoGt, output, x, y)
-        cocoGt.saveImg(cocoDt, y)
+        self.visualizer.sample("val", cocoGt, cocoDt, y)
         cocoEval = COCOeval(cocoGt, cocoDt, "bbox")
         cocoEval.evaluate()
         cocoEval.accumulate()
@@ -224,9 +284,12 @@ class ObjectDetectionModule(ClassifierModule):
 
     # TRAINING CODE
     def training_step(self, batch, batch_idx):
-        x, y = batch
+        x, y, packed = batch
 
-        output = self.model(x, y)
+        if getattr(self.model, "packed_targets", False):
+            output = self.model(x, packed)
+        else:
+            output = self.model(x, y)
         loss = sum(output.values())
 
         metric = dict()
@@ -244,14 +307,13 @@ class ObjectDetectionModule(ClassifierModule):
 
     def test_step(self, batch, batch_idx):
 
-        # dataloader provides these four entries per batch
-        x, y = batch
+        x, y, _ = batch
         cocoGt = self.test_set.getCocoGt()
         cocoGt.createIndex()
 
         output = self(x)
         cocoDt = self.model.transformOutput(cocoGt, output, x, y)
-        cocoGt.saveImg(cocoDt, y)
+        self.visualizer.sample("test", cocoGt, cocoDt, y)
         cocoEval = COCOeval(cocoGt, cocoDt, "bbox")
         cocoEval.evaluate()
         cocoEval.accumulate()
@@ -0,0 +1,289 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import contextlib
+import json
+import logging
+import os
+import random
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from hannah.datasets.base import ctc_collate_fn
+
+msglogger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def _seeded(seed: int):
+    """Seeds python, numpy and the torch cpu random number generators and restores their state afterwards
+
+    The cuda generators are neither seeded nor touched, torch.manual_seed would
+    reseed them as well.
+    """
+    py_state = random.getstate()
+    np_state = np.random.get_state()
+
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        with torch.random.fork_rng(devices=[]):
+            torch.random.default_generator.manual_seed(seed)
+            yield
+    finally:
+        random.setstate(py_state)
+        np.random.set_state(np_state)
+
+
+class AugmentationViewDataset(data.Dataset):
+    """Makes the data augmentation of a dataset reproducible
+
+    Each sample is drawn as one of `num_views` augmentation views, each view of
+    a sample uses a fixed random seed. So the augmented sample can be generated
+    again for a given (index, view) pair. Items are the items of the wrapped
+    dataset extended by the sample index and the view.
+
+    Args:
+        dataset: the wrapped dataset
+        num_views (int): number of augmentation views per sample
+        seed (int): base seed of the views
+        view (int): if not None always returns this view, otherwise a random view is drawn per item
+    """
+
+    def __init__(
+        self,
+        dataset: data.Dataset,
+        num_views: int = 1,
+        seed: int = 1234,
+        view: Optional[int] = None,
+    ):
+        self.dataset = dataset
+        self.num_views = num_views
+        self.seed = seed
+        self.view = view
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def view_seed(self, index: int, view: int) -> int:
+        return (self.seed * 1000003 + view * len(self.dataset) + index) % 2**32
+
+    def __getitem__(self, index):
+        view = self.view if self.view is not None else random.randrange(self.num_views)
+        with _seeded(self.view_seed(index, view)):
+            item = self.dataset[index]
+        return tuple(item) + (index, view)
+
+    def sequence_lengths(self):
+        if not hasattr(self.dataset, "sequence_lengths"):
+            return None
+        return self.dataset.sequence_lengths()
+
+
+def indexed_collate_fn(batch):
+    """Collates the items of an AugmentationViewDataset
+
+    Returns the four tensors of ctc_collate_fn followed by the sample indices and views
+    """
+    x, x_len, y, y_len = ctc_collate_fn([item[:4] for item in batch])
+    indices = torch.tensor([item[4] for item in batch], dtype=torch.long)
+    views = torch.tensor([item[5] for item in batch], dtype=torch.long)
+    return x, x_len, y, y_len, indices, views
+
+
+class TeacherCache:
+    """Half precision memory mapped store of precomputed teacher outputs
+
+    The logits of all teachers are stored in `logits.f16` with shape
+    (views, samples, teachers, classes), feature maps of teacher `num` in
+    `feat_<num>.f16` with shape (views, samples, *feature shape). Shapes and the
+    key of the cache are stored in `meta.json`, which is written last, so an
+    interrupted cache generation is not picked up.
+    """
+
+    META = "meta.json"
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        with open(os.path.join(folder, self.META)) as f:
+            self.meta = json.load(f)
+
+        self.key = self.meta["key"]
+        self.num_views = self.meta["num_views"]
+        self.num_samples = self.meta["num_samples"]
+        self.num_teachers = self.meta["num_teachers"]
+        self.logits_shape = tuple(self.meta["logits_shape"])
+        self.feat_shapes = [tuple(shape) for shape in self.meta["feat_shapes"]]
+
+        self._logits = None
+        self._feats = None
+
+    @classmethod
+    def open(cls, folder: str, key: str) -> Optional["TeacherCache"]:
+        """Opens a cache, returns None if it does not exist or was created for a different key"""
+        if not os.path.exists(os.path.join(folder, cls.META)):
+            return None
+        cache = cls(folder)
+        if cache.key != key:
+            msglogger.info("Teacher cache in %s is outdated", folder)
+            return None
+        return cache
+
+    @property
+    def has_features(self) -> bool:
+        return len(self.feat_shapes) > 0
+
+    def _open(self):
+        # opened lazily so that the cache can be sent to dataloader workers
+        if self._logits is None:
+            self._logits = np.memmap(
+                os.path.join(self.folder, "logits.f16"),
+                dtype=np.float16,
+                mode="r",
+                shape=(self.num_views, self.num_samples) + self.logits_shape,
+            )
+            self._feats = [
+                np.memmap(
+                    os.path.join(self.folder, f"feat_{num}.f16"),
+                    dtype=np.float16,
+                    mode="r",
+                    shape=(self.num_views, self.num_samples) + shape,
+                )
+                for num, shape in enumerate(self.feat_shapes)
+            ]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_logits"] = None
+        state["_feats"] = None
+        return state
+
+    def lookup(
+        self,
+        indices: torch.Tensor,
+        views: torch.Tensor,
+        device: Optional[torch.device] = None,
+        dtype: torch.dtype = torch.float32,
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Returns the cached teacher logits and feature maps of a batch
+
+        Returns:
+            (list of logits per teacher, list of feature maps per teacher or empty list)
+        """
+        self._open()
+        indices = indices.cpu().numpy()
+        views = views.cpu().numpy()
+
+        # fancy indexing copies, so the tensors are writable
+        logits = torch.from_numpy(self._logits[views, indices]).to(
+            device=device, dtype=dtype
+        )
+        teacher_logits = [logits[:, num] for num in range(self.num_teachers)]
+
+        teacher_feat = [
+            torch.from_numpy(feat[views, indices]).to(device=device, dtype=dtype)
+            for feat in self._feats
+        ]
+
+        return teacher_logits, teacher_feat
+
+
+class TeacherCacheWriter:
+    """Writes a TeacherCache
+
+    Shapes of the stored tensors are taken from the first written batch.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        key: str,
+        num_views: int,
+        num_samples: int,
+        num_teachers: int,
+        store_features: bool = False,
+    ):
+        self.folder = folder
+        self.key = key
+        self.num_views = num_views
+        self.num_samples = num_samples
+        self.num_teachers = num_teachers
+        self.store_features = store_features
+
+        self.logits = None
+        self.feats: List[np.memmap] = []
+
+        os.makedirs(folder, exist_ok=True)
+        meta = os.path.join(folder, TeacherCache.META)
+        if os.path.exists(meta):
+            os.remove(meta)
+
+    def _create(self, file_name: str, shape: Sequence[int]) -> np.memmap:
+        return np.memmap(
+            os.path.join(self.folder, file_name),
+            dtype=np.float16,
+            mode="w+",
+            shape=(self.num_views, self.num_samples) + tuple(shape),
+        )
+
+    def write(
+        self,
+        indices: torch.Tensor,
+        view: int,
+        teacher_logits: Sequence[torch.Tensor],
+        teacher_feat: Sequence[Any] = (),
+    ) -> None:
+        logits = torch.stack(teacher_logits, dim=1).detach().cpu().numpy()
+        if self.logits is None:
+            self.logits = self._create("logits.f16", logits.shape[1:])
+            if self.store_features:
+                self.feats = [
+                    self._create(f"feat_{num}.f16", feat.shape[1:])
+                    for num, feat in enumerate(teacher_feat)
+                ]
+
+        indices = indices.cpu().numpy()
+        self.logits[view, indices] = logits
+        for store, feat in zip(self.feats, teacher_feat):
+            store[view, indices] = feat.detach().cpu().numpy()
+
+    def close(self) -> TeacherCache:
+        if self.logits is None:
+            raise ValueError("Teacher cache is empty")
+
+        self.logits.flush()
+        for feat in self.feats:
+            feat.flush()
+
+        meta = {
+            "key": self.key,
+            "num_views": self.num_views,
+            "num_samples": self.num_samples,
+            "num_teachers": self.num_teachers,
+            "logits_shape": list(self.logits.shape[2:]),
+            "feat_shapes": [list(feat.shape[2:]) for feat in self.feats],
+        }
+        tmp_file = os.path.join(self.folder, TeacherCache.META + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, os.path.join(self.folder, TeacherCache.META))
+
+        return TeacherCache(self.folder)
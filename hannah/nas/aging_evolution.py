@@ -20,7 +20,7 @@ import logging
 import shutil
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
 import yaml
@@ -34,6 +34,8 @@ class EvolutionResult:
     index: int
     parameters: Dict[str, Any]
     result: Dict[str, float]
+    # number of training epochs for multi fidelity evaluations, None for full training
+    fidelity: Optional[int] = None
 
     def costs(self):
         return np.asarray(
@@ -86,6 +88,8 @@ class AgingEvolution:
 
         self.history = []
         self.population = []
+        # parent of the last candidate returned by next_parameters (None if random)
+        self.last_parent = None
         self._pareto_points = []
         self.output_folder = Path(output_folder)
         if (self.output_folder / "history.yml").exists():
@@ -103,6 +107,7 @@ class AgingEvolution:
         "Returns a list of current tasks"
 
         parametrization = {}
+        self.last_parent = None
 
         if len(self.history) < self.population_size:
             parametrization = self.parametrization.get_random()
@@ -117,16 +122,28 @@ class AgingEvolution:
             parent = sample[np.argmin(fitness)]
 
             parametrization = self.parametrization.mutate(parent.parameters)
+            self.last_parent = parent
 
         return parametrization
 
-    def tell(self, parameters, metrics):
-        return self.tell_result(parameters, metrics)
+    def tell(self, parameters, metrics, fidelity=None):
+        return self.tell_result(parameters, metrics, fidelity=fidelity)
 
-    def tell_result(self, parameters, metrics):
-        "Tell the result of a task"
+    def tell_result(self, parameters, metrics, fidelity=None):
+        """Tell the result of a task
 
-        result = EvolutionResult(len(self.history), parameters, metrics)
+        Results of multi fidelity evaluations replace the population entry
+        of the same candidate at a lower fidelity, all results are kept in the history.
+        """
+
+        result = EvolutionResult(len(self.history), parameters, metrics, fidelity)
+
+        if fidelity is not None:
+            self.population = [
+                x
+                for x in self.population
+                if x.fidelity is None or x.parameters != parameters
+            ]
 
         self.history.append(result)
         self.population.append(result)
@@ -20,12 +20,15 @@ import copy
 import logging
 import math
 from dataclasses import dataclass
-from typing import Any, Dict, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import networkx as nx
 import numpy as np
 import torch.fx
 
+from hannah.callbacks.summaries import architecture_fingerprint
 from hannah.models.factory import pooling, qat, qconfig
 
 
@@ -77,7 +80,8 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
     def __init__(self, module, garbage_collect_values=True):
         super().__init__(module, garbage_collect_values)
 
-        self.nx_graph = nx.DiGraph()
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+        self.edges: List[Tuple[str, str]] = []
 
         self.conversions = {
             qat.ConvBnReLU1d: self.add_nodes_conv,
@@ -106,6 +110,21 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         self.func_num = 0
 
+    def add_node(self, name, **attrs):
+        self.nodes.setdefault(name, {}).update(attrs)
+
+    def add_edge(self, src, dst):
+        self.nodes.setdefault(src, {})
+        self.nodes.setdefault(dst, {})
+        self.edges.append((src, dst))
+
+    @property
+    def nx_graph(self):
+        graph = nx.DiGraph()
+        graph.add_nodes_from(self.nodes.items())
+        graph.add_edges_from(self.edges)
+        return graph
+
     def extract_quant_attrs(self, quantizer):
 
         if quantizer:
@@ -132,7 +151,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
         quant_attrs = self.extract_quant_attrs(mod)
 
         input_attrs = self.extract_input_attrs(args)
-        self.nx_graph.add_node(
+        self.add_node(
             target,
             attrs=quant_attrs,
             output={"quant": quant_attrs, "shape": output.shape},
@@ -142,14 +161,14 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         input_names = [arg.name for arg in args]
         for input_name in input_names:
-            self.nx_graph.add_edge(input_name, target)
+            self.add_edge(input_name, target)
 
         return NamedTensor(target, output, quantization=quant_attrs)
 
     def add_nodes_relu(self, target, mod, args, output):
         quant_attrs = args[0].quantization
         input_attrs = self.extract_input_attrs(args)
-        self.nx_graph.add_node(
+        self.add_node(
             target,
             attrs={},
             output={"quant": quant_attrs, "shape": output.shape},
@@ -159,7 +178,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         input_names = [arg.name for arg in args]
         for input_name in input_names:
-            self.nx_graph.add_edge(input_name, target)
+            self.add_edge(input_name, target)
 
         return NamedTensor(target, output, quantization=quant_attrs)
 
@@ -216,7 +235,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
                 "method": input_attrs[0]["quant"]["method"],
             }
         output_attr = {"name": name, "quant": output_quant, "shape": output.shape}
-        self.nx_graph.add_node(
+        self.add_node(
             name,
             attrs=attrs,
             type="conv",
@@ -228,7 +247,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         input_names = [arg.name for arg in args]
         for input_name in input_names:
-            self.nx_graph.add_edge(input_name, name)
+            self.add_edge(input_name, name)
 
         if type(mod) in [qat.ConvReLU1d, qat.ConvBnReLU1d]:
             relu_name = target + "_relu"
@@ -296,7 +315,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
                 "method": input_attrs[0]["quant"]["method"],
             }
         output_attr = {"name": name, "quant": output_quant, "shape": output.shape}
-        self.nx_graph.add_node(
+        self.add_node(
             name,
             attrs=attrs,
             type="linear",
@@ -308,7 +327,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         input_names = [arg.name for arg in args]
         for input_name in input_names:
-            self.nx_graph.add_edge(input_name, name)
+            self.add_edge(input_name, name)
 
         if type(mod) in [qat.LinearReLU]:
             relu_name = target + "_relu"
@@ -339,7 +358,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
     def add_nodes_pooling(self, target, mod, args, output):
         quant_attrs = args[0].quantization
         input_attrs = self.extract_input_attrs(args)
-        self.nx_graph.add_node(
+        self.add_node(
             target,
             attrs={},  # TODO: Pool size?
             output={"quant": quant_attrs, "shape": output.shape},
@@ -349,7 +368,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         input_names = [arg.name for arg in args]
         for input_name in input_names:
-            self.nx_graph.add_edge(input_name, target)
+            self.add_edge(input_name, target)
 
         return NamedTensor(target, output, quantization=quant_attrs)
 
@@ -357,7 +376,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
         quant_attrs = args[0].quantization
         input_attrs = self.extract_input_attrs(args)
 
-        self.nx_graph.add_node(
+        self.add_node(
             target,
             attrs={},  # TODO: Other add attributes?
             output={"quant": quant_attrs, "shape": output.shape},
@@ -367,7 +386,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         input_names = [arg.name for arg in args]
         for input_name in input_names:
-            self.nx_graph.add_edge(input_name, target)
+            self.add_edge(input_name, target)
 
         return NamedTensor(target, output, quantization=quant_attrs)
 
@@ -375,7 +394,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
         quant_attrs = args[0].quantization
         input_attrs = self.extract_input_attrs(args)
 
-        self.nx_graph.add_node(
+        self.add_node(
             target,
             attrs={},  # TODO: Other dropout attributes?
             output={"quant": quant_attrs, "shape": output.shape},
@@ -385,7 +404,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         input_names = [arg.name for arg in args]
         for input_name in input_names:
-            self.nx_graph.add_edge(input_name, target)
+            self.add_edge(input_name, target)
 
         return NamedTensor(target, output, quantization=quant_attrs)
 
@@ -393,7 +412,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
         quant_attrs = args[0].quantization
         input_attrs = self.extract_input_attrs(args)
 
-        self.nx_graph.add_node(
+        self.add_node(
             target,
             attrs={},
             output={"quant": quant_attrs, "shape": output.shape},
@@ -403,7 +422,7 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
 
         input_names = [arg.name for arg in args]
         for input_name in input_names:
-            self.nx_graph.add_edge(input_name, target)
+            self.add_edge(input_name, target)
 
         return NamedTensor(target, output, quantization=quant_attrs)
 
@@ -448,22 +467,204 @@ class GraphConversionInterpreter(torch.fx.Interpreter):
         quantizer = getattr(self.module, "activation_post_process", None)
         quant_attr = self.extract_quant_attrs(quantizer)
 
-        self.nx_graph.add_node(
+        self.add_node(
             target, output={"quant": quant_attr, "shape": dimension}, type="placeholder"
         )
         return NamedTensor(target, tensor, quantization=quant_attr)
 
 
-def model_to_graph(model, input):
-    tracer = GraphConversionTracer()
+_trace_cache: "OrderedDict[str, torch.fx.Graph]" = OrderedDict()
+TRACE_CACHE_SIZE = 64
+
+
+def _trace(model: torch.nn.Module, input: torch.Tensor) -> torch.fx.GraphModule:
+    """Trace a model, reusing the traced graph of models with the same architecture
+
+    The returned graph module references the submodules of the model instead
+    of copies, so no weights are copied.
+    """
+    model_cls = type(model)
+    key = (
+        model_cls.__module__
+        + "."
+        + model_cls.__qualname__
+        + ":"
+        + architecture_fingerprint(model, input.shape)
+    )
+
+    graph = _trace_cache.get(key)
+    if graph is None:
+        graph = GraphConversionTracer().trace(model)
+        _trace_cache[key] = graph
+        if len(_trace_cache) > TRACE_CACHE_SIZE:
+            _trace_cache.popitem(last=False)
+    else:
+        _trace_cache.move_to_end(key)
+
+    return torch.fx.GraphModule(model, copy.deepcopy(graph))
 
-    model = copy.deepcopy(model)
 
-    model.cpu()
+@contextmanager
+def _evaluation(model: torch.nn.Module):
+    """Run a model in eval mode without gradients and restore the training flags afterwards"""
+    training = [(module, module.training) for module in model.modules()]
     model.eval()
-    traced_graph = tracer.trace(model)
+    try:
+        with torch.no_grad():
+            yield
+    finally:
+        for module, mode in training:
+            module.training = mode
+
+
+def _convert(model: torch.nn.Module, input: torch.Tensor) -> GraphConversionInterpreter:
+    with _evaluation(model):
+        parameter = next(model.parameters(), None)
+        if parameter is not None:
+            input = input.to(parameter.device)
+
+        interpreter = GraphConversionInterpreter(_trace(model, input))
+        interpreter.run(input)
+
+    return interpreter
+
+
+def model_to_graph(model, input):
+    """Convert a model to a networkx graph
+
+    The conversion runs on the original model in eval mode, the training
+    flags of all modules are restored afterwards.
+    """
+    return _convert(model, input).nx_graph
+
+
+NODE_TYPES = [
+    "placeholder",
+    "conv",
+    "linear",
+    "relu",
+    "quantize",
+    "pooling",
+    "add",
+    "dropout",
+    "flatten",
+]
+
+NUMERIC_FEATURES = [
+    "in_channels",
+    "out_channels",
+    "kernel_size",
+    "stride",
+    "dilation",
+    "groups",
+    "padding",
+    "weight_bits",
+    "weight_size",
+    "output_bits",
+    "output_channels",
+    "output_size",
+]
+
+FEATURE_NAMES = ["type_" + node_type for node_type in NODE_TYPES] + NUMERIC_FEATURES
+
+
+def _prod(value) -> float:
+    if isinstance(value, (tuple, list, torch.Size)):
+        return float(np.prod(value)) if len(value) > 0 else 1.0
+    return float(value)
+
+
+def _node_features(node: Dict[str, Any]) -> np.ndarray:
+    features = np.zeros(len(FEATURE_NAMES), dtype=np.float32)
+    if node.get("type") in NODE_TYPES:
+        features[NODE_TYPES.index(node["type"])] = 1.0
+
+    numeric = {}
+    attrs = node.get("attrs") or {}
+    numeric["in_channels"] = attrs.get("in_channels", attrs.get("in_features", 0))
+    numeric["out_channels"] = attrs.get("out_channels", attrs.get("out_features", 0))
+    for key in ["kernel_size", "stride", "dilation", "groups"]:
+        numeric[key] = _prod(attrs.get(key, 0))
+    padding = attrs.get("padding", 0)
+    if isinstance(padding, (tuple, list)):
+        numeric["padding"] = padding[0]
+    elif not isinstance(padding, str):
+        # string paddings ("same", "valid") are not encoded
+        numeric["padding"] = padding
+
+    weight = node.get("weight") or {}
+    if weight:
+        numeric["weight_bits"] = weight["quant"]["bits"]
+        numeric["weight_size"] = _prod(weight["shape"])
+
+    output = node.get("output") or {}
+    if output:
+        numeric["output_bits"] = output["quant"]["bits"]
+        shape = list(output["shape"])
+        numeric["output_channels"] = shape[1] if len(shape) > 1 else 0
+        numeric["output_size"] = _prod(shape[2:])
+
+    offset = len(NODE_TYPES)
+    for num, key in enumerate(NUMERIC_FEATURES):
+        features[offset + num] = float(numeric.get(key, 0.0))
+
+    return features
+
+
+@dataclass
+class ArrayGraph:
+    """Compact array representation of a converted model
+
+    Attributes:
+        names: node names in the order of the feature matrix
+        edge_index: (2, number of edges) array of source and destination node indices
+        features: (number of nodes, len(FEATURE_NAMES)) node feature matrix
+    """
+
+    names: List[str]
+    edge_index: np.ndarray
+    features: np.ndarray
+
+    def to_dgl(self, self_loop: bool = True):
+        import dgl
+
+        src, dst = torch.from_numpy(self.edge_index)
+        graph = dgl.graph((src, dst), num_nodes=len(self.names))
+        graph.ndata["features"] = torch.from_numpy(self.features)
+        if self_loop:
+            graph = dgl.add_self_loop(graph)
+
+        return graph
+
+
+def _to_arrays(nodes: Dict[str, Dict[str, Any]], edges) -> ArrayGraph:
+    names = list(nodes.keys())
+    index = {name: num for num, name in enumerate(names)}
+    src = [index[src] for src, _ in edges]
+    dst = [index[dst] for _, dst in edges]
+    edge_index = np.asarray([src, dst], dtype=np.int64).reshape(2, -1)
+    features = np.stack([_node_features(nodes[name]) for name in names])
+
+    return ArrayGraph(names, edge_index, features)
+
+
+def model_to_arrays(model, input) -> ArrayGraph:
+    """Convert a model to an edge index and a node feature matrix
+
+    Same conversion as model_to_graph, but without building a networkx graph.
+    The result can be passed directly to the graph based performance predictors.
+    """
+    interpreter = _convert(model, input)
+
+    return _to_arrays(interpreter.nodes, interpreter.edges)
+
+
+def graph_to_arrays(graph) -> ArrayGraph:
+    """Convert a networkx graph as returned by model_to_graph to the array representation
 
-    interpreter = GraphConversionInterpreter(torch.fx.GraphModule(model, traced_graph))
-    interpreter.run(input)
+    This is used for the graphs stored during a search, so the performance
+    predictors are trained on the same node features as returned by model_to_arrays.
+    """
+    nodes = {name: graph.nodes[name] for name in graph.nodes}
 
-    return interpreter.nx_graph
+    return _to_arrays(nodes, list(graph.edges))
@@ -33,7 +33,7 @@ from omegaconf import DictConfig, OmegaConf
 from sklearn.preprocessing import MinMaxScaler
 
 import hannah.conf
-from hannah.nas.graph_conversion import model_to_graph
+from hannah.nas.graph_conversion import graph_to_arrays, model_to_graph
 
 
 class NASGraphDataset(DGLDataset):
@@ -50,18 +50,13 @@ class NASGraphDataset(DGLDataset):
         with result_path.open("r") as result_file:
             data = json.load(result_file)
 
-        data_dict = {}
-        ct = 0
         for i, d in enumerate(data):
             if i % 500 == 0:
                 print("Processing graph {}".format(i))
             graph = nx.json_graph.node_link_graph(d["graph"])
             self.nx_graphs.append(graph)
-            for j, n in enumerate(graph.nodes):
-                node = graph.nodes[n]
-                row_as_dict = dict({"graph": i, "node": j}, **flatten(node))
-                data_dict[ct] = row_as_dict
-                ct = ct + 1
+            # Same node features as used by the predictors during the search
+            self.graphs.append(graph_to_arrays(graph).to_dgl())
 
             metrics = d["metrics"]
             if metrics.get("val_error", None):
@@ -70,38 +65,6 @@ class NASGraphDataset(DGLDataset):
                 label = 1 / metrics["latency"]
             self.labels.append(label)
 
-        df = pd.DataFrame.from_dict(data_dict, orient="index")
-        df = df.dropna(axis=1, how="all")
-
-        columns_to_drop = [c for c in df.columns if "name" in c]
-        df = df.drop(columns=columns_to_drop)
-
-        cat_columns = [c for c in df.columns if "type" in c or "method" in c]
-        df = pd.get_dummies(df, columns=cat_columns).fillna(0)
-
-        array_columns = [
-            c
-            for c in df.columns
-            if "shape" in c
-            or "size" in c
-            or "dilation" in c
-            or "channels" in c
-            or "stride" in c
-            or "padding" in c
-        ]
-        df = unnest(df, array_columns, axis=0).fillna(0)
-        # for col in df.columns:
-        #     if col not in ['graph', 'node'] + cat_columns:
-        #         div = (df[col].max()-df[col].min())
-        #         if not div:
-        #             div = 1
-        #         df[col] = (df[col]-df[col].min())/ div
-        for i, g in enumerate(self.nx_graphs):
-            dgl_graph = to_dgl_graph(
-                g, df[df["graph"] == i].drop(columns="node").to_numpy()
-            )
-            self.graphs.append(dgl_graph)
-
         self.labels = torch.FloatTensor(self.labels)
 
     def normalize_labels(self):
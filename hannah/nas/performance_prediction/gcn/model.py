@@ -27,7 +27,7 @@ class GCN(nn.Module):
     def __init__(self, in_feats, h_feats, num_classes, readout="mean"):
         super(GCN, self).__init__()
         self.conv1 = GraphConv(in_feats, h_feats[0])
-        self.convs = []
+        self.convs = nn.ModuleList()
         for i in range(len(h_feats[0:]) - 1):
             self.convs.append(GraphConv(h_feats[i], h_feats[i + 1]))
         self.conv2 = GraphConv(h_feats[-1], num_classes)
@@ -50,7 +50,7 @@ class GCNEmbedding(nn.Module):
     def __init__(self, in_feats, h_feats, embedding_size, readout="mean"):
         super(GCNEmbedding, self).__init__()
         self.conv1 = GraphConv(in_feats, h_feats[0])
-        self.convs = []
+        self.convs = nn.ModuleList()
         for i in range(len(h_feats[0:]) - 1):
             self.convs.append(GraphConv(h_feats[i], h_feats[i + 1]))
         self.conv2 = GraphConv(h_feats[-1], embedding_size)
@@ -16,6 +16,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import copy
+
 import dgl
 import numpy as np
 import torch
@@ -37,17 +39,22 @@ from .model import GCN, GCNEmbedding
 
 
 class Predictor:
-    def __init__(self, fea_name="features") -> None:
+    def __init__(self, fea_name="features", device="cpu") -> None:
         """Parent method for different predictor classes.
 
         Parameters
         ----------
         fea_name : str, optional
             internal name for features in the graph, as in graph.ndata[fea_name], by default 'features'
+        device : str, torch.device, optional
+            device used for training and inference of the graph network, by default 'cpu'
         """
 
         self.fea_name = fea_name
+        self.device = torch.device(device)
         self.model = None
+        self._optimizer = None
+        self._trained = False
 
     def train(
         self,
@@ -56,6 +63,8 @@ class Predictor:
         num_epochs=200,
         validation_dataloader=None,
         verbose=1,
+        patience=None,
+        warm_start=False,
     ):
         """Train GCN model
 
@@ -71,11 +80,31 @@ class Predictor:
             if given, use this data to print validation loss, by default None
         verbose : int
             if validation_dataloader is given, print validation MSE every <verbose> epoch, by default 1
+        patience : int, optional
+            if given together with validation_dataloader, stop training after <patience> epochs
+            without improvement of the validation MSE and restore the best weights, by default None
+        warm_start : bool, optional
+            continue training with the optimizer state of the previous call, by default False
         """
         assert self.model, "You must specify a model (e.g. use GCNPredictor())"
-        optimizer = torch.optim.Adam(self.model.parameters(), lr=learning_rate)
+        self.model.to(self.device)
+        self.model.train()
+
+        if warm_start and self._optimizer is not None:
+            optimizer = self._optimizer
+            for group in optimizer.param_groups:
+                group["lr"] = learning_rate
+        else:
+            optimizer = torch.optim.Adam(self.model.parameters(), lr=learning_rate)
+        self._optimizer = optimizer
+
+        best_loss = float("inf")
+        best_state = None
+        bad_epochs = 0
         for epoch in range(num_epochs):
             for batched_graph, labels in dataloader:
+                batched_graph = batched_graph.to(self.device)
+                labels = labels.to(self.device)
                 pred = self.model(
                     batched_graph, batched_graph.ndata[self.fea_name].float()
                 ).squeeze()
@@ -86,23 +115,47 @@ class Predictor:
                 optimizer.step()
 
             if validation_dataloader:
-                total_loss = 0
-                num_tests = 0
-                for vbatched_graph, vlabels in validation_dataloader:
-                    vpred = self.model(
-                        vbatched_graph, vbatched_graph.ndata[self.fea_name].float()
-                    ).squeeze()
-                    vloss = F.mse_loss(vpred, vlabels, reduction="sum").item()
-                    # vloss = F.l1_loss(pred, labels, reduction="sum")
-                    total_loss += vloss
-                    num_tests += len(vlabels)
+                validation_loss = self._validation_loss(validation_dataloader)
                 if (verbose and epoch % verbose == 0) or epoch == num_epochs - 1:
                     print(
-                        "Epoch {} Validation MSE: {:.5f}".format(
-                            epoch, total_loss / num_tests
-                        )
+                        "Epoch {} Validation MSE: {:.5f}".format(epoch, validation_loss)
                     )
 
+                if patience is not None:
+                    if validation_loss < best_loss:
+                        best_loss = validation_loss
+                        best_state = copy.deepcopy(self.model.state_dict())
+                        bad_epochs = 0
+                    else:
+                        bad_epochs += 1
+                        if bad_epochs >= patience:
+                            if verbose:
+                                print("Early stopping in epoch {}".format(epoch))
+                            break
+
+        if best_state is not None:
+            self.model.load_state_dict(best_state)
+
+        self._trained = True
+
+    def _validation_loss(self, dataloader):
+        self.model.eval()
+        total_loss = 0
+        num_tests = 0
+        with torch.no_grad():
+            for batched_graph, labels in dataloader:
+                batched_graph = batched_graph.to(self.device)
+                labels = labels.to(self.device)
+                pred = self.model(
+                    batched_graph, batched_graph.ndata[self.fea_name].float()
+                ).squeeze()
+                total_loss += F.mse_loss(pred, labels, reduction="sum").item()
+                # total_loss += F.l1_loss(pred, labels, reduction="sum").item()
+                num_tests += len(labels)
+        self.model.train()
+
+        return total_loss / max(num_tests, 1)
+
     def predict(self, graph):
         """predict cost of graph
 
@@ -116,13 +169,80 @@ class Predictor:
             predicted cost of given graph. Retrieve float value with .item()
         """
         assert self.model, "You must specify a model (e.g. use GCNPredictor())"
+        self.model.to(self.device)
+        graph = graph.to(self.device)
         pred = self.model(graph, graph.ndata[self.fea_name].float())
         return pred
 
+    def get_embedding(self, graph):
+        raise NotImplementedError(
+            "{} does not use a graph embedding".format(type(self).__name__)
+        )
+
+    @staticmethod
+    def _graph_batches(X, batch_size):
+        if isinstance(X, dgl.DGLGraph):
+            yield X
+        elif isinstance(X, GraphDataLoader):
+            for batched_graphs, _ in X:
+                yield batched_graphs
+        else:
+            graphs = list(X)
+            for start in range(0, len(graphs), batch_size):
+                yield dgl.batch(graphs[start : start + batch_size])
+
+    def embed(self, X, batch_size=1024):
+        """Calculate the embeddings of graphs
+
+        The graphs are batched, so the embedding network is run once per
+        <batch_size> graphs instead of once per graph.
+
+        Parameters
+        ----------
+        X : dgl.DGLGraph, list[DGLGraph], dgl.dataloading.GraphDataLoader
+            Input graph(s), batched graphs are embedded per graph
+        batch_size : int, optional
+            number of graphs of a list embedded in one forward pass, by default 1024
+
+        Returns
+        -------
+        np.ndarray
+            embeddings of shape (number of graphs, embedding size)
+        """
+        if type(self).get_embedding is Predictor.get_embedding:
+            raise TypeError(
+                "{} does not use a graph embedding".format(type(self).__name__)
+            )
+        assert self.model, "You must specify a model (e.g. use GCNPredictor())"
+        self.model.to(self.device)
+        self.model.eval()
+        embeddings = []
+        with torch.no_grad():
+            for graph in self._graph_batches(X, batch_size):
+                graph = graph.to(self.device)
+                embeddings.append(self.get_embedding(graph).cpu())
+        self.model.train()
+
+        return torch.vstack(embeddings).numpy()
+
+    def _embed_dataloader(self, dataloader):
+        embeddings = []
+        labels = []
+        for batched_graph, batched_labels in dataloader:
+            embeddings.append(self.embed(batched_graph))
+            labels.append(batched_labels.detach().cpu().numpy())
+
+        return np.concatenate(embeddings), np.concatenate(labels)
+
 
 class GCNPredictor(Predictor):
     def __init__(
-        self, input_feature_size, hidden_units=128, readout="mean", fea_name="features"
+        self,
+        input_feature_size,
+        hidden_units=128,
+        readout="mean",
+        fea_name="features",
+        device="cpu",
     ) -> None:
         """G(raph)CN based network latency/cost predictor. End-to-end from graph to score.
 
@@ -136,8 +256,10 @@ class GCNPredictor(Predictor):
             readout function that is used to aggregate node features, by default 'mean'
         fea_name : str, optional
             internal name for features in the graph, as in graph.ndata[fea_name], by default 'features'
+        device : str, torch.device, optional
+            device used for training and inference, by default 'cpu'
         """
-        super().__init__(fea_name)
+        super().__init__(fea_name, device)
         self.model = GCN(
             input_feature_size, hidden_units, num_classes=1, readout=readout
         )
@@ -149,6 +271,8 @@ class GCNPredictor(Predictor):
         num_epochs=200,
         validation_dataloader=None,
         verbose=0,
+        patience=None,
+        warm_start=False,
     ):
         """Train GCN model
 
@@ -164,9 +288,19 @@ class GCNPredictor(Predictor):
             if given, use this data to print validation loss, by default None
         verbose : int
             if validation_dataloader is given, print validation MSE every <verbose> epoch, by default 1
+        patience : int, optional
+            early stopping patience in epochs, requires validation_dataloader, by default None
+        warm_start : bool, optional
+            continue training with the optimizer state of the previous call, by default False
         """
         super().train(
-            dataloader, learning_rate, num_epochs, validation_dataloader, verbose
+            dataloader,
+            learning_rate,
+            num_epochs,
+            validation_dataloader,
+            verbose,
+            patience=patience,
+            warm_start=warm_start,
         )
 
     def predict(self, graph):
@@ -194,6 +328,7 @@ class GaussianProcessPredictor(Predictor):
         fea_name="features",
         kernel="default",
         alpha=1e-10,
+        device="cpu",
     ) -> None:
         """Predictor that generates a graph embedding that is used as input for a gaussian process predictor.
 
@@ -213,8 +348,10 @@ class GaussianProcessPredictor(Predictor):
             The gaussian process kernel to use.
             input shoudl be either "default", or a sklearn Kernel() object
             by default RBF() + DotProduct() + WhiteKernel()
+        device : str, torch.device, optional
+            device used for training and inference of the embedding network, by default 'cpu'
         """
-        super().__init__(fea_name)
+        super().__init__(fea_name, device)
         if isinstance(hidden_units, int):
             hidden_units = [hidden_units]
         self.model = GCNEmbedding(
@@ -245,16 +382,7 @@ class GaussianProcessPredictor(Predictor):
         self.predictor.fit(embeddings, labels)
 
     def embedd_and_fit(self, dataloader, verbose=True):
-        embeddings = []
-        labels = []
-        for batched_graph, batched_labels in dataloader:
-            graphs = dgl.unbatch(batched_graph)
-            for g, l in zip(graphs, batched_labels):
-                embeddings.append(self.get_embedding(g))
-                labels.append(l)
-
-        embeddings = torch.vstack(embeddings).detach().numpy()
-        labels = torch.hstack(labels).detach().numpy()
+        embeddings, labels = self._embed_dataloader(dataloader)
 
         self.fit_predictor(embeddings, labels)
         score = self.predictor.score(embeddings, labels)
@@ -263,17 +391,7 @@ class GaussianProcessPredictor(Predictor):
         return score
 
     def embedd(self, dataloader):
-        embeddings = []
-        labels = []
-        for batched_graph, batched_labels in dataloader:
-            graphs = dgl.unbatch(batched_graph)
-            for g, l in zip(graphs, batched_labels):
-                embeddings.append(self.get_embedding(g))
-                labels.append(l)
-
-        embeddings = torch.vstack(embeddings).detach().numpy()
-        labels = torch.hstack(labels).detach().numpy()
-        return embeddings, labels
+        return self._embed_dataloader(dataloader)
 
     def train_and_fit(
         self,
@@ -282,6 +400,9 @@ class GaussianProcessPredictor(Predictor):
         num_epochs=200,
         validation_dataloader=None,
         verbose=1,
+        patience=None,
+        warm_start=False,
+        warm_start_epochs=10,
     ):
         """Train GCN model, generate embeddings for training data and fit the predictor with embeddings.
 
@@ -297,31 +418,40 @@ class GaussianProcessPredictor(Predictor):
             if given, use this data to print validation loss, by default None
         verbose : int
             if validation_dataloader is given, print validation MSE every <verbose> epoch,by default 1
+        patience : int, optional
+            early stopping patience in epochs, requires validation_dataloader, by default None
+        warm_start : bool, optional
+            if the embedding network has already been trained, only fine tune it for
+            <warm_start_epochs> epochs, the gaussian process is always fitted from scratch
+            as fine tuning changes the embeddings, by default False
+        warm_start_epochs : int, optional
+            training epochs of the embedding network in warm start mode, by default 10
 
         Returns
         -------
         float
             score of predictor on TRAINING data, see sklearn doc of chosen predictor for more info
         """
+        warm_start = warm_start and self._trained
+        if warm_start:
+            num_epochs = warm_start_epochs
+
         if verbose:
             print("Train embedding network ...")
         super().train(
-            dataloader, learning_rate, num_epochs, validation_dataloader, verbose
+            dataloader,
+            learning_rate,
+            num_epochs,
+            validation_dataloader,
+            verbose,
+            patience=patience,
+            warm_start=warm_start,
         )
 
         if verbose:
             print("Create training embeddings ...")
 
-        embeddings = []
-        labels = []
-        for batched_graph, batched_labels in dataloader:
-            graphs = dgl.unbatch(batched_graph)
-            for g, l in zip(graphs, batched_labels):
-                embeddings.append(self.get_embedding(g))
-                labels.append(l)
-
-        embeddings = torch.vstack(embeddings).detach().numpy()
-        labels = torch.hstack(labels).detach().numpy()
+        embeddings, labels = self._embed_dataloader(dataloader)
 
         if verbose:
             print("Fit predictor ...")
@@ -338,43 +468,27 @@ class GaussianProcessPredictor(Predictor):
     def score(self, X, y):
         pass
 
-    def predict(self, X, return_std=True):
+    def predict(self, X, return_std=True, batch_size=1024):
         """Predict cost/latency of graphs.
 
+        All graphs are embedded in batches and the gaussian process is
+        evaluated once on the stacked embeddings.
+
         Parameters
         ----------
         X : dgl.DGLGraph, list[DGLGraph], dgl.dataloading.GraphDataLoader
             Input graph(s)
         return_std : bool, optional
             if true, return standard dev. else just mean prediction, by default True
+        batch_size : int, optional
+            number of graphs embedded in one forward pass, by default 1024
 
         Returns
         -------
         array (,array)
             prediction(s) , (if return_std: standard deviation(s))
         """
-        if isinstance(X, dgl.DGLGraph):
-            if X.batch_size == 1:
-                embeddings = self.get_embedding(X).detach().numpy()
-            else:
-                embeddings = []
-                graphs = dgl.unbatch(X)
-                for g in graphs:
-                    embeddings.append(self.get_embedding(g))
-                embeddings = torch.vstack(embeddings).detach().numpy()
-        elif isinstance(X, list):
-            embeddings = []
-            for graph in X:
-                embeddings.append(self.get_embedding(graph))
-            embeddings = torch.vstack(embeddings).detach().numpy()
-        elif isinstance(X, GraphDataLoader):
-            embeddings = []
-            for batched_graphs, _ in X:
-                graphs = dgl.unbatch(batched_graphs)
-                for g in graphs:
-                    embeddings.append(self.get_embedding(g))
-
-            embeddings = torch.vstack(embeddings).detach().numpy()
+        embeddings = self.embed(X, batch_size=batch_size)
 
         preds = self.predictor.predict(embeddings, return_std=return_std)
         if return_std:
@@ -393,6 +507,7 @@ class XGBPredictor(Predictor):
         readout="mean",
         fea_name="features",
         xgb_param="default",
+        device="cpu",
     ) -> None:
         """Predictor that generates a graph embedding that is used as input for a xgb based predictor.
 
@@ -411,8 +526,10 @@ class XGBPredictor(Predictor):
         xgb_param : str, dict, optional
             The xgb_parameter to use.
             See https://xgboost.readthedocs.io/en/latest/parameter.html
+        device : str, torch.device, optional
+            device used for training and inference of the embedding network, by default 'cpu'
         """
-        super().__init__(fea_name)
+        super().__init__(fea_name, device)
         if isinstance(hidden_units, int):
             hidden_units = [hidden_units]
         self.model = GCNEmbedding(
@@ -447,9 +564,12 @@ class XGBPredictor(Predictor):
         dataloader,
         learning_rate=1e-3,
         num_epochs=200,
-        num_round=8000,
+        num_round=800,
         validation_dataloader=None,
         verbose=1,
+        patience=None,
+        warm_start=False,
+        warm_start_epochs=10,
     ):
         """Train GCN model, generate embeddings for training data and fit the predictor with embeddings.
 
@@ -467,31 +587,40 @@ class XGBPredictor(Predictor):
             if given, use this data to print validation loss, by default None
         verbose : int
             if validation_dataloader is given, print validation MSE every <verbose> epoch,by default 1
+        patience : int, optional
+            early stopping patience in epochs, requires validation_dataloader, by default None
+        warm_start : bool, optional
+            if the predictor has already been trained, only fine tune the embedding network for
+            <warm_start_epochs> epochs, the booster is always trained from scratch
+            as fine tuning changes the embeddings, by default False
+        warm_start_epochs : int, optional
+            training epochs of the embedding network in warm start mode, by default 10
         """
+        warm_start = warm_start and self._trained
+        if warm_start:
+            num_epochs = warm_start_epochs
+
         if verbose:
             print("Train embedding network ...")
         super().train(
-            dataloader, learning_rate, num_epochs, validation_dataloader, verbose
+            dataloader,
+            learning_rate,
+            num_epochs,
+            validation_dataloader,
+            verbose,
+            patience=patience,
+            warm_start=warm_start,
         )
 
         if verbose:
             print("Create training embeddings ...")
 
-        embeddings = []
-        labels = []
-        for batched_graph, batched_labels in dataloader:
-            graphs = dgl.unbatch(batched_graph)
-            for g, l in zip(graphs, batched_labels):
-                embeddings.append(self.get_embedding(g))
-                labels.append(l)
-
-        embeddings = torch.vstack(embeddings).detach().numpy()
-        labels = torch.hstack(labels).detach().numpy()
+        embeddings, labels = self._embed_dataloader(dataloader)
 
         if verbose:
             print("Fit predictor ...")
 
-        self.fit_predictor(embeddings, labels)
+        self.fit_predictor(embeddings, labels, num_round=num_round)
 
     def get_embedding(self, graph):
         return self.model.get_embedding(graph, graph.ndata[self.fea_name].float())
@@ -499,56 +628,31 @@ class XGBPredictor(Predictor):
     def score(self, X, y):
         pass
 
-    def predict(self, X):
+    def predict(self, X, batch_size=1024):
         """Predict cost/latency of graphs.
 
+        All graphs are embedded in batches and the booster is evaluated
+        once on the stacked embeddings.
+
         Parameters
         ----------
         X : dgl.DGLGraph, list[DGLGraph], dgl.dataloading.GraphDataLoader
             Input graph(s)
+        batch_size : int, optional
+            number of graphs embedded in one forward pass, by default 1024
         Returns
         -------
         array (,array)
             prediction(s) , (if return_std: standard deviation(s))
         """
-        if isinstance(X, dgl.DGLGraph):
-            if X.batch_size == 1:
-                embeddings = self.get_embedding(X).detach().numpy()
-            else:
-                embeddings = []
-                graphs = dgl.unbatch(X)
-                for g in graphs:
-                    embeddings.append(self.get_embedding(g))
-                embeddings = torch.vstack(embeddings).detach().numpy()
-        elif isinstance(X, list):
-            embeddings = []
-            for graph in X:
-                embeddings.append(self.get_embedding(graph))
-            embeddings = torch.vstack(embeddings).detach().numpy()
-        elif isinstance(X, GraphDataLoader):
-            embeddings = []
-            for batched_graphs, _ in X:
-                graphs = dgl.unbatch(batched_graphs)
-                for g in graphs:
-                    embeddings.append(self.get_embedding(g))
-
-            embeddings = torch.vstack(embeddings).detach().numpy()
+        embeddings = self.embed(X, batch_size=batch_size)
         dtest = xgb.DMatrix(embeddings)
 
         preds = self.predictor.predict(dtest)
         return preds
 
     def embedd_and_fit(self, dataloader, verbose=True):
-        embeddings = []
-        labels = []
-        for batched_graph, batched_labels in dataloader:
-            graphs = dgl.unbatch(batched_graph)
-            for g, l in zip(graphs, batched_labels):
-                embeddings.append(self.get_embedding(g))
-                labels.append(l)
-
-        embeddings = torch.vstack(embeddings).detach().numpy()
-        labels = torch.hstack(labels).detach().numpy()
+        embeddings, labels = self._embed_dataloader(dataloader)
 
         self.fit_predictor(embeddings, labels)
 
@@ -25,7 +25,11 @@ from hydra.utils import instantiate
 from tabulate import tabulate
 
 from hannah.callbacks.summaries import MacSummaryCallback
-from hannah.nas.graph_conversion import GraphConversionTracer, model_to_graph
+from hannah.nas.graph_conversion import (
+    GraphConversionTracer,
+    model_to_arrays,
+    model_to_graph,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -105,8 +109,7 @@ class GCNPredictor:
 
         model.setup("train")
 
-        nx_graph = model_to_graph(model)
-        dgl_graph = to_dgl_graph(nx_graph)
+        dgl_graph = model_to_arrays(model.model, model.example_feature_array).to_dgl()
 
         result, std_dev = self.predictor.predict(dgl_graph)
 
@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import hashlib
+import json
+import logging
+import math
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+from omegaconf import OmegaConf
+
+msglogger = logging.getLogger(__name__)
+
+
+def _canonical(value: Any) -> Any:
+    """Convert a value to a json serializable form independent of dict ordering"""
+    if isinstance(value, Mapping):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    elif isinstance(value, np.ndarray):
+        return _canonical(value.tolist())
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    return str(value)
+
+
+def _digest(value: Any) -> str:
+    data = json.dumps(_canonical(value), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def parameter_fingerprint(parameters) -> str:
+    """Fingerprint of a sampled parameter state
+
+    The fingerprint is calculated from the flattened state, so candidates
+    that were reached by different mutation paths but result in the same
+    configuration share a fingerprint.
+
+    Args:
+        parameters: a ParameterState as returned by SearchSpace.get_random / mutate
+                    or an already flattened configuration
+    """
+    if hasattr(parameters, "flatten"):
+        parameters = parameters.flatten()
+
+    return _digest(parameters)
+
+
+def graph_fingerprint(graph) -> str:
+    """Fingerprint of a networkx graph as returned by model_to_graph
+
+    Unlike the parameter fingerprint, this also identifies candidates whose
+    configurations differ only in parameters that do not change the network
+    e.g. the settings of blocks that are not instantiated.
+    """
+    nodes = [(str(name), graph.nodes[name]) for name in graph.nodes]
+    nodes.sort(key=lambda node: node[0])
+    edges = sorted((str(src), str(dst)) for src, dst in graph.edges)
+
+    return _digest({"nodes": nodes, "edges": edges})
+
+
+# Configuration groups that influence the training result of a candidate
+CONTEXT_KEYS = (
+    "module",
+    "model",
+    "dataset",
+    "features",
+    "augmentation",
+    "normalizer",
+    "optimizer",
+    "scheduler",
+    "trainer",
+    "seed",
+)
+
+
+def context_fingerprint(config) -> str:
+    """Fingerprint of the configuration the candidates of a search are trained with
+
+    Combined with the candidate fingerprint it forms the key of the result cache,
+    so searches on the same search space but e.g. with a different dataset,
+    training schedule or seed do not replay each others results.
+
+    Args:
+        config: the (unmerged) configuration of the search
+    """
+    if config is None:
+        config = {}
+    elif OmegaConf.is_config(config):
+        config = OmegaConf.to_container(config, resolve=False)
+
+    return _digest({key: config.get(key, None) for key in CONTEXT_KEYS})
+
+
+def cache_key(context: str, fingerprint: str) -> str:
+    "Result cache key of a candidate in a search with the given context fingerprint"
+    return _digest({"context": context, "candidate": fingerprint})
+
+
+class NASResultCache:
+    """Persistent mapping of candidate fingerprints to their training results
+
+    Results are appended to a json lines file, so the cache survives
+    restarts of the search and can be shared between searches. Keys should be
+    built with cache_key, so they include the fingerprint of the non searched
+    configuration (dataset, trainer, features, seed, ...). Results containing non finite metrics (failed trainings)
+    are not cached, so these candidates can be retried.
+
+    Args:
+        path (str): location of the cache file, if None the cache is only kept in memory
+    """
+
+    def __init__(self, path: Optional[Union[str, Path]] = None):
+        self.path = Path(path) if path is not None else None
+        self.results: Dict[str, Dict[str, float]] = {}
+
+        if self.path is not None and self.path.exists():
+            self.load()
+
+    def load(self) -> None:
+        with self.path.open("r") as cache_file:
+            for line in cache_file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partially written line of an interrupted search
+                    continue
+                self.results[entry["fingerprint"]] = entry["metrics"]
+
+        msglogger.info("Loaded %d cached results", len(self.results))
+
+    def __contains__(self, fingerprint: str) -> bool:
+        return fingerprint in self.results
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def get(self, fingerprint: str) -> Optional[Dict[str, float]]:
+        result = self.results.get(fingerprint)
+        if result is not None:
+            result = dict(result)
+        return result
+
+    def put(self, fingerprint: str, metrics: Dict[str, float]) -> bool:
+        """Add a result to the cache, returns False if the result is not cacheable"""
+        metrics = {str(k): float(v) for k, v in metrics.items()}
+        if not all(math.isfinite(v) for v in metrics.values()):
+            return False
+
+        self.results[fingerprint] = metrics
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as cache_file:
+                cache_file.write(
+                    json.dumps({"fingerprint": fingerprint, "metrics": metrics}) + "\n"
+                )
+
+        return True
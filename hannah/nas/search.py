@@ -19,12 +19,13 @@
 
 import copy
 import logging
+import math
 import os
 import shutil
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import numpy as np
 import omegaconf
@@ -34,7 +35,7 @@ import yaml
 from hydra.utils import instantiate
 from joblib import Parallel, delayed
 from omegaconf import OmegaConf
-from pytorch_lightning import LightningModule, Trainer
+from pytorch_lightning import Callback, LightningModule, Trainer
 from pytorch_lightning.loggers import CSVLogger, TensorBoardLogger
 from pytorch_lightning.utilities.seed import reset_seed, seed_everything
 
@@ -43,6 +44,14 @@ from ..callbacks.summaries import MacSummaryCallback
 from ..utils import clear_outputs, common_callbacks, fullname
 from .aging_evolution import AgingEvolution
 from .graph_conversion import model_to_graph
+from .result_cache import (
+    NASResultCache,
+    cache_key,
+    context_fingerprint,
+    graph_fingerprint,
+    parameter_fingerprint,
+)
+from .weight_inheritance import inherit_weights
 
 msglogger = logging.getLogger(__name__)
 
@@ -51,10 +60,49 @@ msglogger = logging.getLogger(__name__)
 class WorklistItem:
     parameters: Any
     results: Dict[str, float]
-
-
-def run_training(num, config):
-    if os.path.exists(str(num)):
+    fingerprint: str = ""
+    # history index of the parent of mutated candidates
+    parent: Optional[int] = None
+
+
+class StopAtEpoch(Callback):
+    """Stop training after a number of epochs without changing trainer.max_epochs
+
+    Learning rate schedules are still planned for trainer.max_epochs, so the
+    training can be resumed from the last checkpoint with a later stop epoch.
+    """
+
+    def __init__(self, epochs):
+        self.epochs = epochs
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        if trainer.current_epoch + 1 >= self.epochs:
+            trainer.should_stop = True
+
+
+def run_training(
+    num,
+    config,
+    max_epochs=None,
+    resume=False,
+    inherit_from=None,
+    save_checkpoint=None,
+    stop_epoch=None,
+):
+    """Train a candidate in the working directory <num>
+
+    Args:
+        num (int): number of the candidate, used as working directory and for gpu selection
+        config: the candidate configuration as a container
+        max_epochs (int): if given, overrides trainer.max_epochs
+        resume (bool): continue training from the last checkpoint of a previous
+                       run in the same working directory, the checkpoint must have been
+                       trained with the same max_epochs
+        inherit_from (str): checkpoint of a parent architecture used for initialization
+        save_checkpoint (str): if given, the best checkpoint is copied to this path
+        stop_epoch (int): if given, stop the training after this epoch
+    """
+    if not resume and os.path.exists(str(num)):
         shutil.rmtree(str(num))
 
     os.makedirs(str(num), exist_ok=True)
@@ -69,6 +117,13 @@ def run_training(num, config):
             seed = seed[0]
         seed_everything(seed, workers=True)
 
+        if max_epochs is not None:
+            config.trainer.max_epochs = max_epochs
+
+        resume_path = None
+        if resume and os.path.exists(os.path.join("checkpoints", "last.ckpt")):
+            resume_path = os.path.join("checkpoints", "last.ckpt")
+
         if config.trainer.gpus is not None:
             if isinstance(config.trainer.gpus, int):
                 num_gpus = config.trainer.gpus
@@ -89,7 +144,15 @@ def run_training(num, config):
 
             config.trainer.gpus = [gpu]
 
-        callbacks = common_callbacks(config)
+        callbacks = []
+        if stop_epoch is not None:
+            callbacks.append(StopAtEpoch(stop_epoch))
+        if config.get("backend", None):
+            # backend metrics, e.g. latencies, can be used as monitors
+            backend = instantiate(config.backend)
+            callbacks.append(backend)
+
+        callbacks.extend(common_callbacks(config))
         opt_monitor = config.get("monitor", ["val_error"])
         opt_callback = HydraOptCallback(monitor=opt_monitor)
         callbacks.append(opt_callback)
@@ -109,7 +172,12 @@ def run_training(num, config):
                 _recursive_=False,
             )
 
-            trainer.fit(model)
+            if inherit_from is not None and resume_path is None:
+                model.setup("fit")
+                parent_checkpoint = torch.load(inherit_from, map_location="cpu")
+                inherit_weights(model, parent_checkpoint["state_dict"])
+
+            trainer.fit(model, ckpt_path=resume_path)
             ckpt_path = "best"
             if trainer.fast_dev_run:
                 logging.warning(
@@ -119,6 +187,14 @@ def run_training(num, config):
 
             reset_seed()
             trainer.validate(ckpt_path=ckpt_path, verbose=False)
+
+            if save_checkpoint is not None:
+                best_path = checkpoint_callback.best_model_path
+                if not best_path:
+                    best_path = checkpoint_callback.last_model_path
+                if best_path:
+                    os.makedirs(os.path.dirname(save_checkpoint), exist_ok=True)
+                    shutil.copy(best_path, save_checkpoint)
         except Exception as e:
             msglogger.critical("Training failed with exception")
             msglogger.critical(str(e))
@@ -130,7 +206,6 @@ def run_training(num, config):
         from networkx.readwrite import json_graph
 
         json_data = json_graph.node_link_data(nx_model)
-        print(json_data)
         with open(f"model_{num}.json", "w") as res_file:
             import json
 
@@ -187,6 +262,11 @@ class AgingEvolutionNASTrainer(NASTrainerBase):
         n_jobs=10,
         predictor=None,
         seed=1234,
+        result_cache="results/result_cache.jsonl",
+        fingerprint="parameters",
+        duplicate_retries=10,
+        fidelity=None,
+        inheritance=None,
     ):
         super().__init__(
             budget=budget,
@@ -211,10 +291,33 @@ class AgingEvolutionNASTrainer(NASTrainerBase):
         self.worklist = []
         self.presample = presample
 
-    def _sample(self):
-        parameters = self.optimizer.next_parameters()
-        config = OmegaConf.merge(self.config, parameters.flatten())
+        if fingerprint not in ["parameters", "graph"]:
+            raise ValueError(f"Unknown fingerprint type: {fingerprint}")
+        self.fingerprint = fingerprint
+        self.duplicate_retries = duplicate_retries
+        self.result_cache = NASResultCache(result_cache)
+
+        fidelity = fidelity if fidelity is not None else {}
+        self.fidelity_enabled = fidelity.get("enabled", False)
+        self.fidelity_min_epochs = fidelity.get("min_epochs", 1)
+        self.fidelity_eta = fidelity.get("eta", 3)
+
+        inheritance = inheritance if inheritance is not None else {}
+        self.inheritance_enabled = inheritance.get("enabled", False)
+        self.inheritance_epochs = inheritance.get("epochs_fraction", 1.0)
+        checkpoint_dir = inheritance.get("checkpoint_dir", "results/checkpoints")
+        self.checkpoint_dir = Path(checkpoint_dir)
+
+    def _fingerprint(self, parameters, model=None):
+        if self.fingerprint == "graph":
+            graph = model_to_graph(model.model, model.example_feature_array)
+            fingerprint = graph_fingerprint(graph)
+        else:
+            fingerprint = parameter_fingerprint(parameters)
 
+        return cache_key(context_fingerprint(self.config), fingerprint)
+
+    def _instantiate(self, config):
         try:
             model = instantiate(
                 config.module,
@@ -227,85 +330,246 @@ class AgingEvolutionNASTrainer(NASTrainerBase):
                 _recursive_=False,
             )
             model.setup("train")
-
         except AssertionError as e:
             msglogger.critical(
                 "Instantiation failed. Probably #input/output channels are not divisible by #groups!"
             )
             msglogger.critical(str(e))
-        else:
-            estimated_metrics = {}
-            # estimated_metrics = self.predictor.estimate(model)
+            return None
+
+        return model
 
-            satisfied_bounds = []
-            for k, v in estimated_metrics.items():
-                if k in self.bounds:
-                    distance = v / self.bounds[k]
-                    msglogger.info(f"{k}: {float(v):.8f} ({float(distance):.2f})")
-                    satisfied_bounds.append(distance <= 1.2)
+    def _sample(self):
+        """Sample a new candidate and add it to the worklist
 
-            worklist_item = WorklistItem(parameters, estimated_metrics)
+        Candidates that have already been trained or are scheduled for training
+        are mutated again, if no new candidate is found the cached result is
+        replayed to the optimizer instead of training the candidate again.
 
-            if self.presample:
-                if all(satisfied_bounds):
-                    self.worklist.append(worklist_item)
-            else:
+        Returns False if only candidates that are already scheduled for training
+        have been found, so the worklist can not be filled any further.
+        """
+        pending = {item.fingerprint for item in self.worklist}
+        for _ in range(self.duplicate_retries + 1):
+            parameters = self.optimizer.next_parameters()
+            config = OmegaConf.merge(self.config, parameters.flatten())
+
+            # Parameter fingerprints do not need the instantiated model
+            model = None
+            if self.fingerprint == "graph":
+                model = self._instantiate(config)
+                if model is None:
+                    return True
+
+            fingerprint = self._fingerprint(parameters, model)
+            if fingerprint not in pending and fingerprint not in self.result_cache:
+                break
+            msglogger.info("Skipping duplicate candidate %s", fingerprint)
+        else:
+            cached_metrics = self.result_cache.get(fingerprint)
+            if cached_metrics is None:
+                return False
+            msglogger.info("Using cached result for candidate %s", fingerprint)
+            self.optimizer.tell_result(parameters, cached_metrics)
+            return True
+
+        if model is None:
+            model = self._instantiate(config)
+            if model is None:
+                return True
+
+        estimated_metrics = {}
+        # estimated_metrics = self.predictor.estimate(model)
+
+        satisfied_bounds = []
+        for k, v in estimated_metrics.items():
+            if k in self.bounds:
+                distance = v / self.bounds[k]
+                msglogger.info(f"{k}: {float(v):.8f} ({float(distance):.2f})")
+                satisfied_bounds.append(distance <= 1.2)
+
+        parent = self.optimizer.last_parent
+        worklist_item = WorklistItem(
+            parameters,
+            estimated_metrics,
+            fingerprint,
+            parent=parent.index if parent is not None else None,
+        )
+
+        if self.presample:
+            if all(satisfied_bounds):
                 self.worklist.append(worklist_item)
+        else:
+            self.worklist.append(worklist_item)
+
+        return True
 
     def run(self):
         with Parallel(n_jobs=self.n_jobs) as executor:
             while len(self.optimizer.history) < self.budget:
                 self.worklist = []
                 # Mutate current population
-                while len(self.worklist) < self.n_jobs:
-                    self._sample()
-
-                # validate population
-                configs = [
-                    OmegaConf.merge(self.config, item.parameters.flatten())
-                    for item in self.worklist
-                ]
-
-                results = executor(
-                    [
-                        delayed(run_training)(
-                            num, OmegaConf.to_container(config, resolve=True)
+                while (
+                    len(self.worklist) < self.n_jobs
+                    and len(self.optimizer.history) + len(self.worklist) < self.budget
+                ):
+                    if not self._sample():
+                        break
+
+                if not self.worklist:
+                    continue
+
+                candidates = list(enumerate(self.worklist))
+                if self.fidelity_enabled:
+                    self._successive_halving(executor, candidates)
+                else:
+                    self._evaluate(executor, candidates)
+
+    def _evaluate(self, executor, candidates, epochs=None, resume=False):
+        """Train a list of (number, worklist item) and record their results
+
+        If epochs is given, the candidates are only trained for this number of epochs
+        and can be resumed later, their learning rate schedule is planned for
+        trainer.max_epochs in any case.
+        """
+
+        # validate population
+        configs = [
+            OmegaConf.merge(self.config, item.parameters.flatten())
+            for _, item in candidates
+        ]
+
+        first_index = len(self.optimizer.history)
+        jobs = []
+        for pos, ((num, item), config) in enumerate(zip(candidates, configs)):
+            kwargs = {"stop_epoch": epochs, "resume": resume}
+            if self.inheritance_enabled:
+                kwargs["save_checkpoint"] = self._checkpoint_path(first_index + pos)
+                parent_checkpoint = None
+                if item.parent is not None:
+                    parent_checkpoint = self._checkpoint_path(item.parent)
+                if (
+                    not resume
+                    and parent_checkpoint is not None
+                    and os.path.exists(parent_checkpoint)
+                ):
+                    kwargs["inherit_from"] = parent_checkpoint
+                    if epochs is None:
+                        kwargs["max_epochs"] = max(
+                            1, math.ceil(self._max_epochs() * self.inheritance_epochs)
                         )
-                        for num, config in enumerate(configs)
-                    ]
+            jobs.append(
+                delayed(run_training)(
+                    num, OmegaConf.to_container(config, resolve=True), **kwargs
                 )
+            )
 
-                for num, (config, result) in enumerate(zip(configs, results)):
-                    nas_result_path = Path("results")
-                    if not nas_result_path.exists():
-                        nas_result_path.mkdir(parents=True, exist_ok=True)
-                    config_file_name = f"config_{len(self.optimizer.history)+num}.yaml"
-                    config_path = nas_result_path / config_file_name
-                    with config_path.open("w") as config_file:
-                        config_file.write(OmegaConf.to_yaml(config))
-
-                    result_path = nas_result_path / "results.yaml"
+        results = executor(jobs)
+
+        for num, (config, result) in enumerate(zip(configs, results)):
+            nas_result_path = Path("results")
+            if not nas_result_path.exists():
+                nas_result_path.mkdir(parents=True, exist_ok=True)
+            config_file_name = f"config_{len(self.optimizer.history)+num}.yaml"
+            config_path = nas_result_path / config_file_name
+            with config_path.open("w") as config_file:
+                config_file.write(OmegaConf.to_yaml(config))
+
+            result_path = nas_result_path / "results.yaml"
+            result_history = []
+            if result_path.exists():
+                with result_path.open("r") as result_file:
+                    result_history = yaml.safe_load(result_file)
+                if not isinstance(result_history, list):
                     result_history = []
-                    if result_path.exists():
-                        with result_path.open("r") as result_file:
-                            result_history = yaml.safe_load(result_file)
-                        if not isinstance(result_history, list):
-                            result_history = []
-
-                    result_history.append(
-                        {"config": str(config_file_name), "metrics": result}
-                    )
-
-                    with result_path.open("w") as result_file:
-                        yaml.safe_dump(result_history, result_file)
 
-                for result, item in zip(results, self.worklist):
-                    parameters = item.parameters
-                    metrics = {**item.results, **result}
-                    for k, v in metrics.items():
-                        metrics[k] = float(v)
+            entry = {"config": str(config_file_name), "metrics": result}
+            if epochs is not None:
+                entry["epochs"] = epochs
+            result_history.append(entry)
+
+            with result_path.open("w") as result_file:
+                yaml.safe_dump(result_history, result_file)
+
+        full_training = epochs is None or epochs >= self._max_epochs()
+        for result, (_, item) in zip(results, candidates):
+            parameters = item.parameters
+            metrics = {**item.results, **result}
+            for k, v in metrics.items():
+                metrics[k] = float(v)
+
+            # Only results of complete trainings are replayed for duplicates
+            if full_training:
+                self.result_cache.put(item.fingerprint, metrics)
+            self.optimizer.tell_result(parameters, metrics, fidelity=epochs)
+
+        if self.inheritance_enabled:
+            self._prune_checkpoints()
+
+        return results
+
+    def _checkpoint_path(self, index):
+        return str((self.checkpoint_dir / f"model_{index}.ckpt").absolute())
+
+    def _prune_checkpoints(self):
+        "Remove checkpoints of candidates that can no longer be selected as parents"
+        keep = {x.index for x in self.optimizer.population}
+        for path in self.checkpoint_dir.glob("model_*.ckpt"):
+            if int(path.stem.split("_")[-1]) not in keep:
+                path.unlink()
+
+    def _max_epochs(self):
+        return self.config.trainer.max_epochs
+
+    def _rungs(self):
+        "Epoch budgets of the successive halving rungs"
+        max_epochs = self._max_epochs()
+        rungs = []
+        epochs = self.fidelity_min_epochs
+        while epochs < max_epochs:
+            rungs.append(epochs)
+            epochs *= self.fidelity_eta
+        rungs.append(max_epochs)
+
+        return rungs
+
+    def _successive_halving(self, executor, candidates):
+        """Evaluate the candidates with successive halving
+
+        All candidates are trained for the smallest epoch budget, after each rung
+        only the best 1/eta of the candidates are resumed from their last checkpoint
+        and trained up to the next budget. Candidates are ranked with the same
+        random scalarization of the objectives that is used for parent selection.
+        Learning rate schedules are always planned for trainer.max_epochs, the
+        lower rungs only stop the training early, so promoted candidates resume
+        the same schedule.
+        """
+        rungs = self._rungs()
+        fitness_function = self.optimizer.get_fitness_function()
 
-                    self.optimizer.tell_result(parameters, metrics)
+        for rung, epochs in enumerate(rungs):
+            msglogger.info(
+                "Training %d candidates for %d epochs", len(candidates), epochs
+            )
+            results = self._evaluate(
+                executor, candidates, epochs=epochs, resume=rung > 0
+            )
+            if rung == len(rungs) - 1:
+                break
+
+            ranked = []
+            for result, candidate in zip(results, candidates):
+                values = [float(v) for v in result.values()]
+                if not values or not all(np.isfinite(values)):
+                    continue
+                costs = tuple(float(result[k]) for k in sorted(result.keys()))
+                ranked.append(((fitness_function(result), costs), candidate))
+            ranked.sort(key=lambda x: x[0])
+
+            promoted = max(1, math.ceil(len(candidates) / self.fidelity_eta))
+            candidates = [candidate for _, candidate in ranked[:promoted]]
+            if not candidates:
+                break
 
 
 class OFANasTrainer(NASTrainerBase):
@@ -0,0 +1,174 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+from collections import Counter
+from typing import Dict, Mapping
+
+import torch
+
+msglogger = logging.getLogger(__name__)
+
+
+def _resize_dim(
+    tensor: torch.Tensor, dim: int, size: int, rescale: bool
+) -> torch.Tensor:
+    """Narrow or widen a tensor along one dimension
+
+    Widening replicates the existing units cyclically, so the same mapping is
+    used for the output dimension of a layer and the input dimension of the
+    following layer. If rescale is set, replicated entries are divided by
+    their number of copies, which keeps the function of the widened network
+    unchanged (Net2WiderNet).
+    """
+    old_size = tensor.shape[dim]
+    if size <= old_size:
+        return tensor.narrow(dim, 0, size)
+
+    mapping = [i % old_size for i in range(size)]
+    result = tensor.index_select(dim, torch.tensor(mapping, device=tensor.device))
+    if rescale:
+        counts = Counter(mapping)
+        scale = torch.tensor(
+            [1.0 / counts[i] for i in mapping], dtype=result.dtype, device=result.device
+        )
+        shape = [1] * result.dim()
+        shape[dim] = size
+        result = result * scale.view(shape)
+
+    return result
+
+
+def _resize_kernel(tensor: torch.Tensor, dim: int, size: int) -> torch.Tensor:
+    """Center crop or zero pad a kernel dimension"""
+    old_size = tensor.shape[dim]
+    if size <= old_size:
+        return tensor.narrow(dim, (old_size - size) // 2, size)
+
+    shape = list(tensor.shape)
+    shape[dim] = size
+    result = torch.zeros(shape, dtype=tensor.dtype, device=tensor.device)
+    result.narrow(dim, (size - old_size) // 2, old_size).copy_(tensor)
+
+    return result
+
+
+def transfer_tensor(parent: torch.Tensor, shape: torch.Size) -> torch.Tensor:
+    """Transfer a parent tensor to a child tensor of the same rank but different shape
+
+    Dimension 0 is treated as output dimension, dimension 1 of weights with
+    more than one dimension as input dimension, and all further dimensions as
+    kernel dimensions.
+    """
+    result = parent
+    for dim, size in enumerate(shape):
+        if result.shape[dim] == size:
+            continue
+        if dim >= 2:
+            result = _resize_kernel(result, dim, size)
+        else:
+            result = _resize_dim(result, dim, size, rescale=dim == 1)
+
+    return result
+
+
+def _is_identity_candidate(key: str, tensor: torch.Tensor) -> bool:
+    return (
+        key.endswith("weight")
+        and tensor.dim() >= 2
+        and tensor.shape[0] == tensor.shape[1]
+        and all(size % 2 == 1 for size in tensor.shape[2:])
+    )
+
+
+def _identity(tensor: torch.Tensor) -> torch.Tensor:
+    result = torch.zeros_like(tensor)
+    center = tuple(size // 2 for size in tensor.shape[2:])
+    for channel in range(tensor.shape[0]):
+        result[(channel, channel) + center] = 1.0
+
+    return result
+
+
+def inherit_weights(
+    module: torch.nn.Module,
+    parent_state: Mapping[str, torch.Tensor],
+    deepen: bool = True,
+) -> Dict[str, str]:
+    """Initialize a module with the weights of a parent architecture
+
+    Tensors are matched by their state dict keys:
+
+      - tensors with unchanged shape are copied
+      - tensors with a changed shape are widened / narrowed (see transfer_tensor)
+      - new square conv / linear weights of layers that do not exist in the parent
+        are initialized to the identity, if deepen is set (Net2DeeperNet),
+        their biases are set to zero
+      - all other new tensors keep their random initialization
+
+    Args:
+        module: the child module, must already be set up
+        parent_state: state dict of the parent, e.g. checkpoint["state_dict"]
+        deepen (bool): initialize new layers to the identity
+
+    Returns:
+        the transfer method used for each key of the child state dict
+    """
+    state = module.state_dict()
+    methods = {}
+    identity_layers = set()
+
+    for key, tensor in state.items():
+        parent = parent_state.get(key)
+        if parent is not None and parent.shape == tensor.shape:
+            state[key] = parent.to(dtype=tensor.dtype, device=tensor.device)
+            methods[key] = "copied"
+        elif (
+            parent is not None
+            and parent.dim() == tensor.dim()
+            and tensor.is_floating_point()
+        ):
+            state[key] = transfer_tensor(
+                parent.to(dtype=tensor.dtype, device=tensor.device), tensor.shape
+            ).contiguous()
+            methods[key] = "resized"
+        elif deepen and parent is None and _is_identity_candidate(key, tensor):
+            state[key] = _identity(tensor)
+            identity_layers.add(key.rsplit(".", 1)[0])
+            methods[key] = "identity"
+        else:
+            methods[key] = "new"
+
+    for key, tensor in state.items():
+        layer, name = key.rsplit(".", 1) if "." in key else ("", key)
+        if name == "bias" and layer in identity_layers:
+            state[key] = torch.zeros_like(tensor)
+            methods[key] = "identity"
+
+    module.load_state_dict(state)
+
+    counts = Counter(methods.values())
+    msglogger.info(
+        "Inherited weights: %d copied, %d resized, %d identity, %d new",
+        counts["copied"],
+        counts["resized"],
+        counts["identity"],
+        counts["new"],
+    )
+
+    return methods
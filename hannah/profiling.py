@@ -0,0 +1,196 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Lightweight named timing regions for the training hot paths
+
+Regions are cheap enough to stay enabled, a region costs two calls of
+time.perf_counter and a dictionary update. Statistics are aggregated per region
+name and are collected and reset by :meth:`RegionProfiler.summary`.
+
+Usage:
+
+    from hannah.profiling import region
+
+    with region("features"):
+        x = self.features(x)
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+
+class RegionStats:
+    """Aggregated timings of a region in seconds"""
+
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+
+class RegionProfiler:
+    """Collects the timings of named regions
+
+    Args:
+        enabled (bool): record regions
+        cuda_events (bool): additionally time regions with cuda events, this
+                            measures the device time of asynchronously launched kernels
+    """
+
+    def __init__(self, enabled: bool = True, cuda_events: bool = False):
+        self.enabled = enabled
+        self.cuda_events = cuda_events
+
+        self._stats: Dict[str, RegionStats] = defaultdict(RegionStats)
+        self._cuda_stats: Dict[str, RegionStats] = defaultdict(RegionStats)
+        self._pending_events: List[Tuple[str, Any, Any]] = []
+        self._trace: Optional[List[Dict[str, Any]]] = None
+        self._trace_origin = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def region(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        events = None
+        if self.cuda_events and torch.cuda.is_available():
+            events = (
+                torch.cuda.Event(enable_timing=True),
+                torch.cuda.Event(enable_timing=True),
+            )
+            events[0].record()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if events is not None:
+                events[1].record()
+            self.record(name, start, end)
+            if events is not None:
+                with self._lock:
+                    self._pending_events.append((name, events[0], events[1]))
+
+    def record(self, name: str, start: float, end: float) -> None:
+        """Record a region measured with time.perf_counter"""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._stats[name].add(end - start)
+            if self._trace is not None:
+                self._trace.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self._trace_origin) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                    }
+                )
+
+    def _resolve_events(self) -> None:
+        with self._lock:
+            pending = self._pending_events
+            self._pending_events = []
+
+        for name, start, end in pending:
+            end.synchronize()
+            self._cuda_stats[name].add(start.elapsed_time(end) / 1000.0)
+
+    def summary(self, reset: bool = True) -> Dict[str, Dict[str, float]]:
+        """Statistics of all regions recorded since the last reset
+
+        Returns:
+            Dict[str, Dict[str, float]]: per region count, total_ms, mean_ms and max_ms,
+                                         and cuda_mean_ms if cuda events are enabled
+        """
+        self._resolve_events()
+
+        with self._lock:
+            result = {}
+            for name, stats in self._stats.items():
+                result[name] = {
+                    "count": stats.count,
+                    "total_ms": stats.total * 1000.0,
+                    "mean_ms": stats.total * 1000.0 / stats.count,
+                    "max_ms": stats.max * 1000.0,
+                }
+                cuda_stats = self._cuda_stats.get(name)
+                if cuda_stats is not None and cuda_stats.count > 0:
+                    result[name]["cuda_mean_ms"] = (
+                        cuda_stats.total * 1000.0 / cuda_stats.count
+                    )
+
+            if reset:
+                self._stats = defaultdict(RegionStats)
+                self._cuda_stats = defaultdict(RegionStats)
+
+        return result
+
+    @property
+    def tracing(self) -> bool:
+        return self._trace is not None
+
+    def start_trace(self) -> None:
+        """Start recording the regions as events of a chrome trace"""
+        with self._lock:
+            self._trace = []
+            self._trace_origin = time.perf_counter()
+
+    def stop_trace(self, path: str) -> None:
+        """Stop recording events and write them as chrome trace to path
+
+        The trace can be opened with chrome://tracing or https://ui.perfetto.dev
+        """
+        with self._lock:
+            events = self._trace or []
+            self._trace = None
+
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+
+_profiler = RegionProfiler()
+
+
+def get_profiler() -> RegionProfiler:
+    return _profiler
+
+
+def region(name: str):
+    """Time the enclosed block as region name of the global profiler"""
+    return _profiler.region(name)
@@ -16,53 +16,173 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import logging
-import sys
+import multiprocessing
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
 import hydra
 import numpy as np
-import yaml
 from hydra.utils import instantiate
 from omegaconf import DictConfig, OmegaConf
 
 import hannah.conf  # noqa
 from hannah.nas.graph_conversion import model_to_graph
 from hannah.nas.parametrization import SearchSpace
-from hannah.nas.performance_prediction.simple import to_dgl_graph
 
+msglogger = logging.getLogger(__name__)
 
-@hydra.main(config_name="characterize", config_path="../conf", version_base="1.2")
-def main(config: DictConfig):
-    """
+
+class CharacterizationStore:
+    """Indexed store of characterization results
+
+    Results are kept in a single sqlite database with one row per sample
+    index and board. Samples that could not be characterized are stored with
+    their error message, so they are not retried when the characterization is
+    resumed, unless they are explicitly excluded from the completed samples.
 
     Args:
-      config: DictConfig:
-      config: DictConfig:
-      config: DictConfig:
+        path (str): location of the database file
+    """
 
-    Returns:
+    def __init__(self, path: str):
+        self.path = Path(path)
+        if self.path.parent != Path("."):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                sample INTEGER NOT NULL,
+                board TEXT NOT NULL,
+                config TEXT,
+                graph TEXT,
+                metrics TEXT,
+                error TEXT,
+                PRIMARY KEY (sample, board)
+            )"""
+        )
+        self.connection.commit()
+
+    def completed(self, include_failed: bool = True) -> Set[int]:
+        """Indices of all samples that have already been characterized
+
+        Args:
+            include_failed (bool): also return samples that failed on all boards
+        """
+        query = "SELECT DISTINCT sample FROM results"
+        if not include_failed:
+            query += " WHERE metrics IS NOT NULL"
+        cursor = self.connection.execute(query)
+        return {row[0] for row in cursor}
+
+    def add(
+        self,
+        index: int,
+        config: str,
+        graph: Optional[str],
+        results: List[Dict[str, Any]],
+        error: Optional[str] = None,
+    ) -> None:
+        rows = []
+        for result in results:
+            result = dict(result)
+            board = str(result.pop("board", ""))
+            rows.append((index, board, config, graph, json.dumps(result), None))
+        if error is not None or not rows:
+            rows.append((index, "", config, graph, None, error))
+
+        if error is None and rows:
+            # Remove the error of a previous attempt
+            self.connection.execute(
+                "DELETE FROM results WHERE sample = ? AND metrics IS NULL", (index,)
+            )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        self.connection.commit()
+
+    def results(self, board: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        "Iterate over successful characterizations ordered by sample index"
+        query = "SELECT sample, board, config, graph, metrics FROM results"
+        query += " WHERE metrics IS NOT NULL"
+        args: Tuple[Any, ...] = ()
+        if board is not None:
+            query += " AND board = ?"
+            args = (board,)
+        query += " ORDER BY sample, board"
+
+        for sample, board, config, graph, metrics in self.connection.execute(
+            query, args
+        ):
+            yield {
+                "sample": sample,
+                "board": board,
+                "config": config,
+                "graph": json.loads(graph) if graph is not None else None,
+                "metrics": json.loads(metrics),
+            }
+
+    def __len__(self) -> int:
+        cursor = self.connection.execute("SELECT COUNT(DISTINCT sample) FROM results")
+        return cursor.fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def sample_config(config: DictConfig, index: int, seed: int = 1234) -> DictConfig:
+    """Deterministically sample the search space configuration with the given index
 
+    Each index uses its own random state, so samples do not depend on the
+    order in which they are generated.
     """
-    random_state = np.random.RandomState(seed=1234)
+    random_state = np.random.RandomState([seed, index])
     search_space = SearchSpace(config.nas.parametrization, random_state)
+    parameters = search_space.get_random()
 
-    backend = instantiate(config.backend)
+    return OmegaConf.merge(config, parameters.flatten())
 
-    for i in range(0, 20000):
-        parameters = search_space.get_random()
-        config = OmegaConf.merge(config, parameters.flatten())
 
-        skip = False
-        for board in config.backend.board:
-            result_path = Path(board) / f"config_{i}.yaml"
-            if result_path.exists():
-                skip = True
-        if skip:
-            logging.info("Skipping config_%d", i)
-            continue
+def characterize_model(backend, model) -> List[Dict[str, Any]]:
+    """Characterize a model on a backend
 
-        logging.info(OmegaConf.to_yaml(config.model))
+    Backends without a characterize method are supported through their
+    estimate method, the results are attributed to a board named after the
+    backend class.
+    """
+    if hasattr(backend, "characterize"):
+        return backend.characterize(model)
+
+    metrics = backend.estimate(model)
+    result = {k: float(v) for k, v in metrics.items()}
+    result["board"] = type(backend).__name__
+
+    return [result]
+
+
+_worker_config = None
+_worker_backend = None
+
+
+def _init_worker(config: Dict[str, Any]) -> None:
+    global _worker_config, _worker_backend
+    _worker_config = OmegaConf.create(config)
+    _worker_backend = instantiate(_worker_config.backend)
+
+
+def characterize_sample(index: int, seed: int = 1234):
+    """Characterize one sample in a worker process initialized by _init_worker
+
+    Returns:
+        (index, sample configuration as yaml, graph as json, backend results, error message)
+    """
+    config = sample_config(_worker_config, index, seed)
+    config_yaml = OmegaConf.to_yaml(config)
+
+    try:
         model = instantiate(
             config.module,
             dataset=config.dataset,
@@ -76,32 +196,71 @@ def main(config: DictConfig):
         model.setup("test")
         model.eval()
 
+        from networkx.readwrite import json_graph
+
         network_graph = model_to_graph(model.model, model.example_feature_array)
-        results = backend.characterize(model)
+        graph = json.dumps(json_graph.node_link_data(network_graph), default=str)
 
-        for result in results:
-            board = result["board"]
-            directory = Path(board)
+        results = characterize_model(_worker_backend, model)
+    except Exception as e:
+        msglogger.error("Characterization of sample %d failed: %s", index, str(e))
+        return index, config_yaml, None, [], str(e)
 
-            directory.mkdir(exist_ok=True)
+    return index, config_yaml, graph, results, None
 
-            config_file_name = f"config_{i}.yaml"
-            config_path = directory / config_file_name
-            with config_path.open("w") as config_file:
-                config_file.write(OmegaConf.to_yaml(config))
 
-            result_path = directory / "results.yaml"
-            result_history = []
-            if result_path.exists():
-                with result_path.open("r") as result_file:
-                    result_history = yaml.safe_load(result_file)
-                if not isinstance(result_history, list):
-                    result_history = []
+@hydra.main(config_name="characterize", config_path="../conf", version_base="1.2")
+def main(config: DictConfig):
+    """Characterize random samples of the search space on the configured backend
+
+    Samples are generated deterministically by index and distributed over
+    characterize.workers processes, each with its own backend instance.
+    Results are written to the indexed store characterize.store, samples that
+    are already contained in the store are skipped, so interrupted
+    characterizations can be resumed by restarting them. Failed samples are
+    only characterized again if characterize.retry_failed is set.
+
+    Args:
+      config: DictConfig:
+    """
+    settings = config.get("characterize", {})
+    num_samples = settings.get("num_samples", 20000)
+    workers = settings.get("workers", 1)
+    seed = settings.get("seed", 1234)
+    retry_failed = settings.get("retry_failed", False)
 
-            result_history.append({"config": str(config_file_name), "metrics": result})
+    store = CharacterizationStore(settings.get("store", "characterization.sqlite"))
+    completed = store.completed(include_failed=not retry_failed)
+    pending = [index for index in range(num_samples) if index not in completed]
+    msglogger.info(
+        "Characterizing %d samples, %d samples already characterized",
+        len(pending),
+        len(completed),
+    )
 
-            with result_path.open("w") as result_file:
-                yaml.safe_dump(result_history, result_file)
+    container = OmegaConf.to_container(config, resolve=True)
+    try:
+        if workers <= 1:
+            _init_worker(container)
+            for index in pending:
+                store.add(*characterize_sample(index, seed))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(container,),
+            ) as executor:
+                futures = [
+                    executor.submit(characterize_sample, index, seed)
+                    for index in pending
+                ]
+                for num, future in enumerate(as_completed(futures)):
+                    store.add(*future.result())
+                    if num % 100 == 0:
+                        msglogger.info("Characterized %d/%d", num + 1, len(pending))
+    finally:
+        store.close()
 
 
 if __name__ == "__main__":
@@ -17,11 +17,13 @@
 # limitations under the License.
 #
 import logging
+import multiprocessing
 import os
 import shutil
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Any, Dict, List, Type, Union
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
 import hydra
 import numpy as np
@@ -63,160 +65,261 @@ def handleDataset(config=DictConfig):
     lit_module.prepare_data()
 
 
-def train(
-    config: DictConfig,
-) -> Union[float, Dict[Any, float], List[Union[float, Dict[Any, float]]]]:
-    test_output = []
-    results = []
-    if isinstance(config.seed, int):
-        config.seed = [config.seed]
-    validate_output = False
-    if hasattr(config, "validate_output") and isinstance(config.validate_output, bool):
-        validate_output = config.validate_output
+def train_seed(
+    config: DictConfig, seed: int, validate_output: bool = False
+) -> Tuple[Optional[Dict[str, float]], Union[float, Dict[Any, float], None]]:
+    """Trains and tests the configured module with a single seed
+
+    Returns:
+        (test metrics, optimization result), both are None for fast dev runs
+    """
+    seed_everything(seed, workers=True)
+    if not torch.cuda.is_available():
+        config.trainer.gpus = None
+
+    if isinstance(config.trainer.gpus, int):
+        config.trainer.gpus = auto_select_gpus(config.trainer.gpus)
+
+    if not config.trainer.fast_dev_run and not config.get("resume", False):
+        clear_outputs()
+
+    logging.info("Configuration: ")
+    logging.info(OmegaConf.to_yaml(config))
+    logging.info("Current working directory %s", os.getcwd())
+    lit_module = instantiate(
+        config.module,
+        dataset=config.dataset,
+        model=config.model,
+        optimizer=config.optimizer,
+        features=config.get("features", None),
+        scheduler=config.get("scheduler", None),
+        normalizer=config.get("normalizer", None),
+        gpus=config.trainer.get("gpus", None),
+        _recursive_=False,
+    )
+
+    profiler = None
+    if config.get("profiler", None):
+        profiler = instantiate(config.profiler)
 
-    for seed in config.seed:
-        seed_everything(seed, workers=True)
-        if not torch.cuda.is_available():
-            config.trainer.gpus = None
-
-        if isinstance(config.trainer.gpus, int):
-            config.trainer.gpus = auto_select_gpus(config.trainer.gpus)
-
-        if not config.trainer.fast_dev_run and not config.get("resume", False):
-            clear_outputs()
-
-        logging.info("Configuration: ")
-        logging.info(OmegaConf.to_yaml(config))
-        logging.info("Current working directory %s", os.getcwd())
-        lit_module = instantiate(
-            config.module,
-            dataset=config.dataset,
-            model=config.model,
-            optimizer=config.optimizer,
-            features=config.get("features", None),
-            scheduler=config.get("scheduler", None),
-            normalizer=config.get("normalizer", None),
-            gpus=config.trainer.get("gpus", None),
-            _recursive_=False,
+    logger = [
+        TensorBoardLogger(
+            ".", version=None, name="", default_hp_metric=False, log_graph=True
         )
+    ]
+    if config.trainer.get("stochastic_weight_avg", False):
+        logging.critical(
+            "CSVLogger is not compatible with logging with SWA, disabling csv logger"
+        )
+    else:
+        logger.append(CSVLogger(".", version=None, name=""))
 
-        profiler = None
-        if config.get("profiler", None):
-            profiler = instantiate(config.profiler)
+    callbacks = []
+    if config.get("backend", None):
+        backend = instantiate(config.backend)
+        callbacks.append(backend)
 
-        logger = [
-            TensorBoardLogger(
-                ".", version=None, name="", default_hp_metric=False, log_graph=True
-            )
-        ]
-        if config.trainer.get("stochastic_weight_avg", False):
-            logging.critical(
-                "CSVLogger is not compatible with logging with SWA, disabling csv logger"
+    callbacks.extend(list(common_callbacks(config)))
+
+    opt_monitor = config.get("monitor", ["val_error"])
+    opt_callback = HydraOptCallback(monitor=opt_monitor)
+    callbacks.append(opt_callback)
+
+    checkpoint_callback = instantiate(config.checkpoint)
+    callbacks.append(checkpoint_callback)
+
+    # INIT PYTORCH-LIGHTNING
+    lit_trainer = instantiate(
+        config.trainer,
+        profiler=profiler,
+        callbacks=callbacks,
+        logger=logger,
+        _convert_="partial",
+    )
+
+    if config["auto_lr"]:
+        # run lr finder (counts as one epoch)
+        lr_finder = lit_trainer.lr_find(lit_module)
+
+        # inspect results
+        fig = lr_finder.plot()
+        fig.savefig("./learning_rate.png")
+
+        # recreate module with updated config
+        suggested_lr = lr_finder.suggestion()
+        config["lr"] = suggested_lr
+
+    lit_trainer.tune(lit_module)
+
+    logging.info("Starting training")
+    # PL TRAIN
+    ckpt_path = None
+    if config.get("resume", False):
+        expected_ckpt_path = Path(".") / "checkpoints" / "last.ckpt"
+        # breakpoint()
+        if expected_ckpt_path.exists():
+            logging.info(
+                "Resuming training from checkpoint: %s", str(expected_ckpt_path)
             )
+            ckpt_path = str(expected_ckpt_path)
         else:
-            logger.append(CSVLogger(".", version=None, name=""))
+            logging.info(
+                "Checkpoint '%s' not found restarting training from scratch",
+                str(expected_ckpt_path),
+            )
+    lit_trainer.fit(lit_module, ckpt_path=ckpt_path)
+
+    if config.get("compression", None) and (
+        config.get("compression").get("clustering", None)
+        or config.get("compression").get("decomposition", None)
+    ):
+        # FIXME: this is a bad workaround
+        lit_trainer.save_checkpoint("last")
+        ckpt_path = "last"
+    else:
+        ckpt_path = "best"
+
+    if not lit_trainer.fast_dev_run:
+        reset_seed()
+        lit_trainer.validate(ckpt_path=ckpt_path, verbose=validate_output)
+
+        # PL TEST
+        reset_seed()
+        lit_trainer.test(ckpt_path=ckpt_path, verbose=validate_output)
+
+        lit_module.save()
+        if checkpoint_callback and checkpoint_callback.best_model_path:
+            shutil.copy(checkpoint_callback.best_model_path, "best.ckpt")
+
+        return opt_callback.test_result(), opt_callback.result()
+
+    return None, None
+
+
+def _train_seed_worker(
+    config: Dict[str, Any],
+    seed: int,
+    device: Optional[int],
+    work_dir: str,
+    validate_output: bool,
+):
+    """Runs a single seed of a parallel multi seed training in its own folder"""
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    logging.basicConfig(
+        level=logging.INFO,
+        filename="train.log",
+        format="[%(asctime)s][%(name)s][%(levelname)s] - %(message)s",
+    )
 
-        callbacks = []
-        if config.get("backend", None):
-            backend = instantiate(config.backend)
-            callbacks.append(backend)
+    config = OmegaConf.create(config)
+    config.trainer.gpus = [device] if device is not None else None
+
+    return train_seed(config, seed, validate_output)
+
+
+def _seed_devices(config: DictConfig, num_processes: int) -> List[Optional[int]]:
+    gpus = config.trainer.get("gpus", None)
+    if not torch.cuda.is_available() or gpus is None:
+        return [None]
+    if isinstance(gpus, int):
+        return auto_select_gpus(min(num_processes, torch.cuda.device_count()))
+    return list(gpus)
+
+
+def train_parallel(
+    config: DictConfig, validate_output: bool = False
+) -> Tuple[List[Dict[str, float]], List[Union[float, Dict[Any, float]]]]:
+    """Trains the seeds of the configuration concurrently
+
+    Each seed runs in its own process and output folder `seed_<seed>`, the
+    processes are assigned round robin to the available gpus. The dataset is
+    prepared once before the processes are started. The averaged metrics are
+    updated whenever a seed is finished.
+    """
+    seeds = list(config.seed)
+    num_processes = min(config.get("parallel_seeds", 1), len(seeds))
+    devices = _seed_devices(config, num_processes)
+
+    handleDataset(config)
+
+    # interpolations of the hydra config can not be resolved in the workers
+    config_container = OmegaConf.to_container(config, resolve=True)
+
+    outputs = {}
+    with ProcessPoolExecutor(
+        max_workers=num_processes, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {}
+        for num, seed in enumerate(seeds):
+            device = devices[num % len(devices)]
+            future = executor.submit(
+                _train_seed_worker,
+                config_container,
+                seed,
+                device,
+                os.path.abspath(f"seed_{seed}"),
+                validate_output,
+            )
+            futures[future] = seed
 
-        callbacks.extend(list(common_callbacks(config)))
+        for future in as_completed(futures):
+            seed = futures[future]
+            test_result, result = future.result()
+            msglogger.info("Finished training with seed %d", seed)
+            if result is None:
+                continue
+            outputs[seed] = (test_result, result)
+            summarize_test([test for test, _ in outputs.values()])
 
-        opt_monitor = config.get("monitor", ["val_error"])
-        opt_callback = HydraOptCallback(monitor=opt_monitor)
-        callbacks.append(opt_callback)
+    test_output = [outputs[seed][0] for seed in seeds if seed in outputs]
+    results = [outputs[seed][1] for seed in seeds if seed in outputs]
 
-        checkpoint_callback = instantiate(config.checkpoint)
-        callbacks.append(checkpoint_callback)
+    return test_output, results
 
-        # INIT PYTORCH-LIGHTNING
-        lit_trainer = instantiate(
-            config.trainer,
-            profiler=profiler,
-            callbacks=callbacks,
-            logger=logger,
-            _convert_="partial",
-        )
 
-        if config["auto_lr"]:
-            # run lr finder (counts as one epoch)
-            lr_finder = lit_trainer.lr_find(lit_module)
-
-            # inspect results
-            fig = lr_finder.plot()
-            fig.savefig("./learning_rate.png")
-
-            # recreate module with updated config
-            suggested_lr = lr_finder.suggestion()
-            config["lr"] = suggested_lr
-
-        lit_trainer.tune(lit_module)
-
-        logging.info("Starting training")
-        # PL TRAIN
-        ckpt_path = None
-        if config.get("resume", False):
-            expected_ckpt_path = Path(".") / "checkpoints" / "last.ckpt"
-            # breakpoint()
-            if expected_ckpt_path.exists():
-                logging.info(
-                    "Resuming training from checkpoint: %s", str(expected_ckpt_path)
-                )
-                ckpt_path = str(expected_ckpt_path)
-            else:
-                logging.info(
-                    "Checkpoint '%s' not found restarting training from scratch",
-                    str(expected_ckpt_path),
-                )
-        lit_trainer.fit(lit_module, ckpt_path=ckpt_path)
-
-        if config.get("compression", None) and (
-            config.get("compression").get("clustering", None)
-            or config.get("compression").get("decomposition", None)
-        ):
-            # FIXME: this is a bad workaround
-            lit_trainer.save_checkpoint("last")
-            ckpt_path = "last"
-        else:
-            ckpt_path = "best"
-
-        if not lit_trainer.fast_dev_run:
-            reset_seed()
-            lit_trainer.validate(ckpt_path=ckpt_path, verbose=validate_output)
-
-            # PL TEST
-            reset_seed()
-            lit_trainer.test(ckpt_path=ckpt_path, verbose=validate_output)
-
-            lit_module.save()
-            if checkpoint_callback and checkpoint_callback.best_model_path:
-                shutil.copy(checkpoint_callback.best_model_path, "best.ckpt")
-
-            test_output.append(opt_callback.test_result())
-            results.append(opt_callback.result())
-
-    @rank_zero_only
-    def summarize_test(test_output) -> None:
-        if not test_output:
-            return
-        result_frame = pd.DataFrame.from_dict(test_output)
-        if result_frame.empty:
-            return
-        result_frame.to_json("test_results.json")
-        result_frame.to_pickle("test_results.pkl")
-
-        description = result_frame.describe()
-        description = description.fillna(0.0)
-
-        res = description.loc[["mean", "std", "count"]]
-
-        desc_table = tabulate.tabulate(
-            res.transpose(),
-            headers=["Metric", "Mean", "Std", "Count"],
-            tablefmt="github",
-        )
-        msglogger.info("Averaged Result Metrics:\n%s", desc_table)
+@rank_zero_only
+def summarize_test(test_output) -> None:
+    if not test_output:
+        return
+    result_frame = pd.DataFrame.from_dict(test_output)
+    if result_frame.empty:
+        return
+    result_frame.to_json("test_results.json")
+    result_frame.to_pickle("test_results.pkl")
+
+    description = result_frame.describe()
+    description = description.fillna(0.0)
+
+    res = description.loc[["mean", "std", "count"]]
+
+    desc_table = tabulate.tabulate(
+        res.transpose(),
+        headers=["Metric", "Mean", "Std", "Count"],
+        tablefmt="github",
+    )
+    msglogger.info("Averaged Result Metrics:\n%s", desc_table)
+
+
+def train(
+    config: DictConfig,
+) -> Union[float, Dict[Any, float], List[Union[float, Dict[Any, float]]]]:
+    test_output = []
+    results = []
+    if isinstance(config.seed, int):
+        config.seed = [config.seed]
+    validate_output = False
+    if hasattr(config, "validate_output") and isinstance(config.validate_output, bool):
+        validate_output = config.validate_output
+
+    if config.get("parallel_seeds", 1) > 1 and len(config.seed) > 1:
+        test_output, results = train_parallel(config, validate_output)
+    else:
+        for seed in config.seed:
+            test_result, result = train_seed(config, seed, validate_output)
+            if result is not None:
+                test_output.append(test_result)
+                results.append(result)
 
     summarize_test(test_output)
 
@@ -17,10 +17,13 @@
 # limitations under the License.
 #
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Sequence, Union
 
 import tabulate
+import torch
 from pytorch_lightning import LightningDataModule, LightningModule
 from pytorch_lightning.callbacks import ModelCheckpoint, ProgressBar
 from pytorch_lightning.callbacks.progress import tqdm
@@ -69,12 +72,66 @@ class FoldProgressBar(ProgressBar):
         return bar
 
 
+def _fit_fold(
+    fold: int,
+    model: LightningModule,
+    sets_by_criteria: Sequence[Any],
+    fold_splits: Sequence[Any],
+    device: Optional[int],
+    trainer_args: Sequence[Any],
+    trainer_kwargs: Dict[str, Any],
+):
+    """Trains and tests a single fold in a worker process
+
+    Runs the same tune and fit sequence as the serial cross validation.
+
+    Returns:
+        (metric table, confusion matrix) of the test set of the fold
+    """
+    trainer_kwargs = dict(trainer_kwargs)
+    trainer_kwargs["gpus"] = [device] if device is not None else None
+    trainer_kwargs["auto_select_gpus"] = False
+    trainer_kwargs["parallel_folds"] = 1
+    cv_trainer = CrossValidationTrainer(*trainer_args, **trainer_kwargs)
+
+    working_model = deepcopy(model)
+    working_model.sets_by_criteria = sets_by_criteria
+    working_model.fold_splits = fold_splits
+    working_model.setup(None)
+
+    cv_trainer.fit_folds(model, working_model, folds=[fold])
+
+    return cv_trainer.overall_test_results_array[0]
+
+
 class CrossValidationTrainer:
+    """Trains and tests a CrossValidationStreamClassifierModule on each fold
+
+    Args:
+        parallel_folds (int): number of folds trained concurrently, each in its own process
+        fold_devices (list): gpus used by the fold processes, fold i runs on
+            fold_devices[i % len(fold_devices)], defaults to all visible gpus
+        *args, **kwargs: arguments of the lightning Trainer of each fold
+    """
+
     # Copied or Adapted from:
     # https://github.com/PyTorchLightning/pytorch-lightning/issues/839
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        parallel_folds: int = 1,
+        fold_devices: Optional[List[int]] = None,
+        **kwargs,
+    ):
         self.current_fold = None
+        self.parallel_folds = parallel_folds
+        self.fold_devices = fold_devices
+
+        # Keep the arguments to create the trainers of the fold processes
+        self.trainer_args = args
+        self.trainer_kwargs = dict(kwargs, callbacks=list(kwargs["callbacks"]))
+
         kwargs["callbacks"] += [
             FoldProgressBar(fold_idx_callback=self.get_current_fold)
         ]
@@ -200,11 +257,101 @@ class CrossValidationTrainer:
         confusion_plot.savefig("test_confusion.png")
         confusion_plot.savefig("test_confusion.pdf")
 
+    def fit_fold(
+        self,
+        model: LightningModule,
+        trainer: Trainer,
+        fold: int,
+        train_loader: DataLoader,
+        val_loader: DataLoader,
+        test_loader: DataLoader,
+    ) -> None:
+        self.current_fold = fold
+        model.register_test_end_callback_function(self.test_end_callback)
+        model.register_trainer_fold_callback(callback=self.get_current_fold)
+        self.update_logger(trainer, fold)
+        for callback in trainer.callbacks:
+            if isinstance(callback, ModelCheckpoint):
+                self.update_modelcheckpoint(callback, fold)
+        trainer.fit(model, train_dataloader=train_loader, val_dataloaders=val_loader)
+        trainer.validate(model, val_dataloaders=val_loader)
+        trainer.test(model, test_dataloaders=test_loader)
+
+    def _fold_device(self, fold: int) -> Optional[int]:
+        devices = self.fold_devices
+        if devices is None:
+            devices = list(range(torch.cuda.device_count()))
+        if not devices or self.trainer_kwargs.get("gpus", None) is None:
+            return None
+        return devices[(fold - 1) % len(devices)]
+
+    def fit_parallel(self, model: LightningModule, working_model: LightningModule):
+        """Runs the folds concurrently, one process per fold
+
+        The index of the sets by criteria and the fold splits are only built
+        once and sent to the fold processes, the samples themselves are not
+        copied for datasets backed by memory mapped stores.
+        """
+        num_folds = len(working_model.train_set)
+        with ProcessPoolExecutor(
+            max_workers=min(self.parallel_folds, num_folds),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            futures = []
+            for fold in range(1, num_folds + 1):
+                device = self._fold_device(fold)
+                logging.info("Starting fold %d on device %s", fold, device)
+                futures.append(
+                    executor.submit(
+                        _fit_fold,
+                        fold,
+                        deepcopy(model),
+                        working_model.sets_by_criteria,
+                        working_model.fold_splits,
+                        device,
+                        self.trainer_args,
+                        self.trainer_kwargs,
+                    )
+                )
+
+            # keep the fold order in the overall results
+            for fold, future in enumerate(futures, start=1):
+                metric_table, confusion_matrix = future.result()
+                logging.info(
+                    f"\nFold: {fold} "
+                    f"Test Metrics:\n{tabulate.tabulate(metric_table)}"
+                )
+                self.overall_test_results_array += [(metric_table, confusion_matrix)]
+
+        if self.class_names is None:
+            self.class_names = working_model.get_class_names()
+
     # Do all in fit
     def fit(self, model: LightningModule) -> None:
         working_model = deepcopy(model)
         working_model.prepare_data()
         working_model.setup(None)
+
+        if self.parallel_folds > 1:
+            self.fit_parallel(model, working_model)
+        else:
+            self.fit_folds(model, working_model)
+
+        self.overall_test_results()
+
+    def fit_folds(
+        self,
+        model: LightningModule,
+        working_model: LightningModule,
+        folds: Optional[Sequence[int]] = None,
+    ) -> None:
+        """Tunes the trainer on the working model and trains and tests copies of model on the folds
+
+        Args:
+            model: the module that is copied for each fold
+            working_model: a copy of model that has already been set up
+            folds: numbers of the folds to run, starting from 1, defaults to all folds
+        """
         working_trainer = deepcopy(self.trainer)
         working_trainer.tune(working_model)
         loader_model = deepcopy(working_model)
@@ -216,22 +363,20 @@ class CrossValidationTrainer:
             )
         ):
             fold += 1  # We want natural enumeration
-            self.current_fold = fold
+            if folds is not None and fold not in folds:
+                continue
             model_copy = deepcopy(model)
-            model_copy.register_test_end_callback_function(self.test_end_callback)
-            model_copy.register_trainer_fold_callback(callback=self.get_current_fold)
-            trainer_copy = deepcopy(working_trainer)
-            self.update_logger(trainer_copy, fold)
-            for callback in trainer_copy.callbacks:
-                if isinstance(callback, ModelCheckpoint):
-                    self.update_modelcheckpoint(callback, fold)
-            trainer_copy.fit(
-                model_copy, train_dataloader=train_loader, val_dataloaders=val_loader
+            # reuse the index of the working model instead of loading it per fold
+            model_copy.sets_by_criteria = working_model.sets_by_criteria
+            model_copy.fold_splits = working_model.fold_splits
+            self.fit_fold(
+                model_copy,
+                deepcopy(working_trainer),
+                fold,
+                train_loader,
+                val_loader,
+                test_loader,
             )
-            trainer_copy.validate(model_copy, val_dataloaders=val_loader)
-            trainer_copy.test(model_copy, test_dataloaders=test_loader)
-
-        self.overall_test_results()
 
     def validate(
         self,
@@ -55,6 +55,7 @@ from torchvision.datasets.utils import (
 from .callbacks.clustering import kMeans
 from .callbacks.dump_layers import TestDumperCallback
 from .callbacks.optimization import HydraOptCallback
+from .callbacks.profiling import RegionProfilerCallback
 from .callbacks.pruning import PruningAmountScheduler
 from .callbacks.summaries import MacSummaryCallback
 from .callbacks.svd_compress import SVD
@@ -237,6 +238,12 @@ def common_callbacks(config: DictConfig) -> list:
     mac_summary_callback = MacSummaryCallback()
     callbacks.append(mac_summary_callback)
 
+    profiling = dict(config.get("profiling", None) or {})
+    region_profiler = RegionProfilerCallback(
+        trace=config.get("profile", False), **profiling
+    )
+    callbacks.append(region_profiler)
+
     if config.get("early_stopping", None):
         stop_callback = hydra.utils.instantiate(config.early_stopping)
         callbacks.append(stop_callback)
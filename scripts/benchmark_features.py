@@ -0,0 +1,103 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import argparse
+import time
+
+import torch
+import torchaudio
+
+from hannah.features import LogSpectrogram, SincConvFFT
+
+
+def get_features(sample_rate):
+    # parameters as in hannah/conf/features
+    return {
+        "sinc_fft": SincConvFFT(sample_rate=sample_rate),
+        "logspec": LogSpectrogram(n_fft=400),
+        "mfcc": torchaudio.transforms.MFCC(
+            sample_rate=sample_rate,
+            n_mfcc=40,
+            dct_type=2,
+            norm="ortho",
+            melkwargs={
+                "hop_length": 160,
+                "n_fft": 480,
+                "f_min": 20.0,
+                "f_max": 4000.0,
+                "pad": 0,
+                "n_mels": 40,
+                "power": 2.0,
+                "normalized": False,
+            },
+        ),
+    }
+
+
+def benchmark(feature, x, warmup, repeats, device):
+    def sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    with torch.no_grad():
+        for _ in range(warmup):
+            feature(x)
+        sync()
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            feature(x)
+        sync()
+        end = time.perf_counter()
+
+    return (end - start) / repeats
+
+
+def main(args):
+    device = torch.device(args.device)
+    x = torch.rand(args.batch_size, 1, args.input_length, device=device)
+
+    print(f"{'feature':<10} {'shape':<20} {'ms/batch':>10}")
+    for name, feature in get_features(args.sample_rate).items():
+        if args.features and name not in args.features:
+            continue
+        feature = feature.to(device)
+        shape = tuple(feature(x).shape)
+        elapsed = benchmark(feature, x, args.warmup, args.repeats, device)
+        print(f"{name:<10} {str(shape):<20} {elapsed * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Micro benchmark of the feature extractors")
+    parser.add_argument("-b", "--batch-size", type=int, default=128)
+    parser.add_argument("-l", "--input-length", type=int, default=16000)
+    parser.add_argument("-s", "--sample-rate", type=int, default=16000)
+    parser.add_argument("-w", "--warmup", type=int, default=5)
+    parser.add_argument("-r", "--repeats", type=int, default=50)
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    parser.add_argument(
+        "-f",
+        "--features",
+        nargs="+",
+        default=[],
+        help="features to benchmark, by default benchmarks sinc_fft, logspec and mfcc",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
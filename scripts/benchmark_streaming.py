@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import argparse
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from hannah.models.streaming import StreamingConvNet
+from hannah.models.tc.models import TCResNetModel
+
+
+def timed(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+
+    config = OmegaConf.to_container(OmegaConf.load(args.config))
+    model = TCResNetModel(config)
+    model.eval()
+
+    width = config["width"]
+    height = config["height"]
+    stream = torch.randn(1, height, width + args.hop * (args.repeats + args.warmup))
+
+    with torch.no_grad():
+        streaming = StreamingConvNet(model)
+        streaming(stream[..., :width])
+
+        position = width
+
+        def streaming_step():
+            nonlocal position
+            streaming(stream[..., position : position + args.hop])
+            position += args.hop
+
+        def full_step():
+            model(stream[..., :width])
+
+        for _ in range(args.warmup):
+            streaming_step()
+            full_step()
+
+        streaming_time = timed(streaming_step, args.repeats)
+        full_time = timed(full_step, args.repeats)
+
+    print(f"model: {config.get('name', args.config)} window: {width} hop: {args.hop}")
+    print(f"full recompute: {full_time * 1000:.3f} ms/hop")
+    print(f"streaming:      {streaming_time * 1000:.3f} ms/hop")
+    print(f"speedup:        {full_time / streaming_time:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Per hop latency of streaming vs. full window TC-ResNet inference"
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=str,
+        default="hannah/conf/model/tc-res8.yaml",
+        help="TC-ResNet model configuration",
+    )
+    parser.add_argument("--hop", type=int, default=8, help="Hop in feature frames")
+    parser.add_argument("-w", "--warmup", type=int, default=10)
+    parser.add_argument("-r", "--repeats", type=int, default=200)
+    parser.add_argument("-t", "--threads", type=int, default=1)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,89 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import argparse
+import logging
+
+import torch
+import torchaudio
+from hydra.utils import instantiate
+
+import hannah.modules.classifier  # noqa: F401
+
+
+def load_module(checkpoint_path, target):
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+
+    hparams = checkpoint["hyper_parameters"]
+    if "_target_" not in hparams:
+        logging.warning("Target class not given in checkpoint assuming: %s", target)
+        hparams["_target_"] = target
+
+    module = instantiate(hparams, _recursive_=False)
+    module.setup("test")
+    module.load_state_dict(checkpoint["state_dict"])
+
+    return module
+
+
+def main(args):
+    module = load_module(args.checkpoint, args.target)
+    module.to(args.device)
+    samplingrate = module.hparams.dataset.get("samplingrate", 16000)
+
+    total_duration = 0.0
+    total_time = 0.0
+    for audio_file in args.audio:
+        waveform, sr = torchaudio.load(audio_file)
+        if sr != samplingrate:
+            waveform = torchaudio.transforms.Resample(sr, samplingrate)(waveform)
+        waveform = waveform[:1]
+
+        outputs, rtf = module.streaming_inference(waveform, hop_ms=args.hop_ms)
+        duration = waveform.shape[-1] / samplingrate
+        total_duration += duration
+        total_time += rtf * duration
+
+        print(
+            f"{audio_file}: {outputs.shape[0]} windows, {duration:.1f} s, RTF {rtf:.4f}"
+        )
+
+    if total_duration > 0:
+        print(f"Total: {total_duration:.1f} s, RTF {total_time / total_duration:.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Measure the real time factor of sliding window inference on recordings"
+    )
+    parser.add_argument("checkpoint", type=str, help="Model checkpoint")
+    parser.add_argument("audio", nargs="+", type=str, help="Audio files")
+    parser.add_argument(
+        "--hop-ms", type=float, default=None, help="Hop between two windows in ms"
+    )
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    parser.add_argument(
+        "--target",
+        type=str,
+        default="hannah.modules.classifier.StreamClassifierModule",
+        help="Module class used if the checkpoint does not contain it",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,169 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from pytorch_lightning import LightningModule, Trainer
+from pytorch_lightning.callbacks import ModelCheckpoint
+from torch.utils.data import DataLoader, TensorDataset
+
+import hannah.nas.search
+from hannah.nas.aging_evolution import AgingEvolution
+from hannah.nas.search import AgingEvolutionNASTrainer, StopAtEpoch, WorklistItem
+
+parametrization = {"model": {"width": [8, 16, 32, 64]}}
+
+
+def test_multi_fidelity_population(tmp_path):
+    optimizer = AgingEvolution(
+        parametrization,
+        bounds={"val_error": 0.1},
+        population_size=4,
+        random_state=np.random.RandomState(1234),
+        output_folder=tmp_path,
+    )
+
+    first = optimizer.next_parameters()
+    second = optimizer.next_parameters()
+
+    optimizer.tell_result(first, {"val_error": 0.5}, fidelity=1)
+    optimizer.tell_result(second, {"val_error": 0.6}, fidelity=1)
+    optimizer.tell_result(first, {"val_error": 0.2}, fidelity=3)
+
+    assert len(optimizer.history) == 3
+    assert [x.fidelity for x in optimizer.history] == [1, 1, 3]
+
+    population = {x.index: x for x in optimizer.population}
+    if first != second:
+        assert sorted(population.keys()) == [1, 2]
+        assert population[2].result == {"val_error": 0.2}
+
+
+def test_successive_halving_rungs(tmp_path):
+    config = OmegaConf.create({"trainer": {"max_epochs": 30}})
+    trainer = AgingEvolutionNASTrainer(
+        parametrization=parametrization,
+        bounds={"val_error": 0.1},
+        parent_config=config,
+        result_cache=str(tmp_path / "result_cache.jsonl"),
+        fidelity={"enabled": True, "min_epochs": 2, "eta": 3},
+    )
+
+    assert trainer._rungs() == [2, 6, 18, 30]
+
+    config.trainer.max_epochs = 2
+    assert trainer._rungs() == [2]
+
+
+def test_sample_pending_duplicates(tmp_path):
+    config = OmegaConf.create({"trainer": {"max_epochs": 30}})
+    trainer = AgingEvolutionNASTrainer(
+        parametrization={"model": {"width": [8]}},
+        bounds={"val_error": 0.1},
+        parent_config=config,
+        result_cache=str(tmp_path / "result_cache.jsonl"),
+        duplicate_retries=3,
+    )
+
+    parameters = trainer.optimizer.next_parameters()
+    fingerprint = trainer._fingerprint(parameters)
+    trainer.worklist = [WorklistItem(parameters, {}, fingerprint)]
+
+    # The only candidate of the search space is scheduled but not yet trained
+    assert not trainer._sample()
+    assert len(trainer.worklist) == 1
+
+    trainer.result_cache.put(fingerprint, {"val_error": 0.5})
+    trainer.worklist = []
+    assert trainer._sample()
+    assert len(trainer.optimizer.history) == 1
+    assert not trainer.worklist
+
+
+class OneCycleModule(LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.layer = torch.nn.Linear(1, 1)
+
+    def training_step(self, batch, batch_idx):
+        x, y = batch
+        return torch.nn.functional.mse_loss(self.layer(x), y)
+
+    def train_dataloader(self):
+        return DataLoader(
+            TensorDataset(torch.rand(4, 1), torch.rand(4, 1)), batch_size=2
+        )
+
+    def configure_optimizers(self):
+        optimizer = torch.optim.SGD(self.parameters(), lr=0.1)
+        scheduler = torch.optim.lr_scheduler.OneCycleLR(
+            optimizer, max_lr=0.1, total_steps=self.trainer.estimated_stepping_batches
+        )
+        return [optimizer], [dict(scheduler=scheduler, interval="step")]
+
+
+def test_successive_halving_resume(tmp_path, monkeypatch):
+    "Promoted candidates are resumed with the learning rate schedule of the full training"
+    monkeypatch.chdir(tmp_path)
+    trainings = []
+
+    def run_training(num, config, resume=False, stop_epoch=None, **kwargs):
+        checkpoint = os.path.join(str(num), "checkpoints", "last.ckpt")
+        trainer = Trainer(
+            max_epochs=config["trainer"]["max_epochs"],
+            callbacks=[
+                StopAtEpoch(stop_epoch),
+                ModelCheckpoint(
+                    dirpath=os.path.join(str(num), "checkpoints"), save_last=True
+                ),
+            ],
+            logger=False,
+            enable_progress_bar=False,
+        )
+        trainer.fit(OneCycleModule(), ckpt_path=checkpoint if resume else None)
+        scheduler = trainer.lr_scheduler_configs[0].scheduler
+        trainings.append((num, resume, trainer.current_epoch, scheduler.last_epoch))
+        return {"val_error": 0.1 * (num + 1)}
+
+    monkeypatch.setattr(hannah.nas.search, "run_training", run_training)
+
+    config = OmegaConf.create({"trainer": {"max_epochs": 3}})
+    nas_trainer = AgingEvolutionNASTrainer(
+        parametrization=parametrization,
+        bounds={"val_error": 0.1},
+        parent_config=config,
+        result_cache=str(tmp_path / "result_cache.jsonl"),
+        fidelity={"enabled": True, "min_epochs": 1, "eta": 3},
+    )
+    candidates = [
+        (num, WorklistItem(nas_trainer.optimizer.next_parameters(), {}))
+        for num in range(3)
+    ]
+
+    def executor(jobs):
+        return [function(*args, **kwargs) for function, args, kwargs in jobs]
+
+    nas_trainer._successive_halving(executor, candidates)
+
+    # 2 training steps per epoch, the schedule is planned for all 3 epochs
+    assert trainings[:3] == [(num, False, 1, 2) for num in range(3)]
+    assert trainings[3:] == [(0, True, 3, 6)]
+    assert [x.fidelity for x in nas_trainer.optimizer.history] == [1, 1, 1, 3]
@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import pytest
+import torch
+
+from hannah.callbacks.backends import (
+    InferenceBackendBase,
+    OnnxruntimeBackend,
+    benchmark_latency,
+    model_hash,
+)
+
+
+class CountingBackend(InferenceBackendBase):
+    def __init__(self, benchmark=None):
+        super().__init__(session_cache_size=2, benchmark=benchmark)
+        self.created = 0
+
+    def create_session(self, module):
+        self.created += 1
+        return torch.jit.trace(module, torch.rand(1, 4))
+
+    def run_batch(self, inputs=None):
+        return self.session(inputs)
+
+
+def test_model_hash():
+    model = torch.nn.Linear(4, 2)
+    key = model_hash(model)
+
+    assert model_hash(model) == key
+    with torch.no_grad():
+        model.weight[0, 0] += 1.0
+    assert model_hash(model) != key
+
+
+def test_session_cache():
+    backend = CountingBackend()
+    first = torch.nn.Linear(4, 2)
+    second = torch.nn.Linear(4, 2)
+
+    backend.prepare(first)
+    backend.prepare(first)
+    assert backend.created == 1
+
+    backend.prepare(second)
+    backend.prepare(first)
+    assert backend.created == 2
+
+    inputs = torch.rand(3, 4)
+    mse = backend._compare(first, inputs)
+    assert mse.item() < 1e-10
+    backend.teardown(None, None)
+
+
+class LoggingModule(torch.nn.Linear):
+    def __init__(self):
+        super().__init__(4, 2)
+        self.example_input_array = torch.rand(1, 4)
+        self.logged = {}
+
+    @property
+    def device(self):
+        return self.weight.device
+
+    def log(self, name, value):
+        self.logged[name] = value
+
+
+def test_benchmark_latency():
+    stats = benchmark_latency(
+        lambda x: x * 2, torch.rand(8, 4), warmup=2, iterations=20
+    )
+
+    assert (
+        0.0
+        <= stats["latency_median_ms"]
+        <= stats["latency_p95_ms"]
+        <= stats["latency_p99_ms"]
+    )
+    assert stats["throughput"] > 0.0
+    assert "cuda_peak_memory_mb" not in stats
+
+
+def test_benchmark_memory():
+    buffers = []
+
+    def allocate(x):
+        if not buffers:
+            buffers.append(torch.ones(2**22))
+        return x
+
+    before = benchmark_latency(lambda x: x, torch.rand(8, 4), warmup=1, iterations=5)
+    stats = benchmark_latency(allocate, torch.rand(8, 4), warmup=1, iterations=5)
+
+    # Memory of earlier allocations is not attributed to the benchmark
+    if "resident_memory_mb" in stats:
+        assert before["resident_memory_mb"] < 8.0
+        assert stats["resident_memory_mb"] >= 8.0
+
+
+def test_benchmark_metrics():
+    backend = CountingBackend(
+        benchmark={"iterations": 5, "warmup": 1, "batch_sizes": [1, 4]}
+    )
+    module = LoggingModule()
+    backend.prepare(module)
+
+    results = backend.benchmark(module, "val")
+
+    assert "val_backend_latency_p95_ms" in results
+    assert "val_backend_latency_p95_ms_b4_t0" in results
+    assert module.logged == results
+    assert backend.session is not None
+
+
+def test_benchmark_session_cache():
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+
+    class CountingOnnxruntimeBackend(OnnxruntimeBackend):
+        created = 0
+
+        def create_session(self, model, session_options=None):
+            self.created += 1
+            return super().create_session(model, session_options)
+
+    backend = CountingOnnxruntimeBackend(
+        benchmark={"iterations": 2, "warmup": 0, "num_threads": [0, 1, 2]}
+    )
+    module = LoggingModule()
+
+    for _ in range(2):
+        backend.prepare(module)
+        results = backend.benchmark(module, "val")
+    assert "val_backend_latency_p95_ms_b1_t2" in results
+    assert backend.created == 3
+
+    with torch.no_grad():
+        module.weight[0, 0] += 1.0
+    backend.prepare(module)
+    backend.benchmark(module, "val")
+    assert backend.created == 6
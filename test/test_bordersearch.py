@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("libsvm")
+pytest.importorskip("pycocotools")
+
+from PIL import Image  # noqa: E402
+
+from hannah.datasets.base import DatasetType  # noqa: E402
+from hannah.datasets.Kitti import Kitti  # noqa: E402
+from hannah.modules.augmentation.bordersearch import (  # noqa: E402
+    ConcurrentBordersearch,
+    Opts,
+    Parameter,
+    ParameterRange,
+    isolated_workdir,
+    random_sample,
+)
+from hannah.modules.augmentation.engine import AugmentationEngine  # noqa: E402
+
+
+def create_kitti(root):
+    image_dir = os.path.join(root, "kitti", "training", "image_2")
+    label_dir = os.path.join(root, "kitti", "training", "label_2")
+    os.makedirs(image_dir)
+    os.makedirs(label_dir)
+
+    Image.fromarray(np.zeros((8, 16, 3), dtype=np.uint8)).save(
+        os.path.join(image_dir, "000000.png")
+    )
+    with open(os.path.join(label_dir, "000000.txt"), "w") as label_file:
+        label_file.write(
+            "Car 0.00 0 0.00 1.00 1.00 4.00 4.00 1.0 1.0 1.0 1.0 1.0 1.0 0.0\n"
+        )
+
+    config = {
+        "labels": {"DontCare": 0, "Car": 1},
+        "labels_ignore": [0],
+        "img_size": "8,16",
+        "kitti_folder": os.path.join(root, "kitti"),
+    }
+
+    return Kitti({"000000.png": "000000.txt"}, DatasetType.DEV, config)
+
+
+@isolated_workdir
+def augmenting_dut_fun(opts, point):
+    "Publishes an augmented image and checks that it is not replaced by other candidates"
+    kitti = create_kitti(os.getcwd())
+    engine = AugmentationEngine(num_workers=1)
+    cache_dir = engine.cache_dir(kitti)
+    os.makedirs(cache_dir)
+    cached = os.path.join(cache_dir, "augmented.png")
+    Image.fromarray(np.full((8, 16, 3), 255, dtype=np.uint8)).save(cached)
+    engine._announce(kitti, "000000", cached)
+
+    # Both candidates have published their images before either one reads
+    opts.barrier.wait(timeout=60)
+    augmented = kitti.augmented_file("000000")
+    own = augmented is not None and os.path.samefile(augmented, cached)
+    opts.barrier.wait(timeout=60)
+
+    engine.cancel(kitti)
+    engine.shutdown()
+
+    return 1.0 if own else 0.0
+
+
+def test_concurrent_candidates_isolated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = [
+        Parameter(ParameterRange(0.0, 1.0), "p0", "c", 0),
+        Parameter(ParameterRange(0.0, 1.0), "p1", "c", 1),
+    ]
+    opts = Opts(parameters, 2, {}, "")
+    opts.dut_fun = augmenting_dut_fun
+    opts.sample_fun = random_sample
+
+    with multiprocessing.get_context("spawn").Manager() as manager:
+        opts.barrier = manager.Barrier(2)
+        conf = ConcurrentBordersearch(num_workers=2).find_waterlevel(opts, 0.5)
+
+    assert [z for _, z in conf] == [1.0, 1.0]
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,131 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.data as data
+from omegaconf import OmegaConf
+
+from hannah.datasets.base import BucketBatchSampler, ctc_collate_fn
+from hannah.modules.classifier import BaseStreamClassifierModule
+
+
+def test_bucket_sampler():
+    lengths = np.random.randint(1, 1000, size=1003)
+    for drop_last in [True, False]:
+        sampler = BucketBatchSampler(lengths, 8, drop_last=drop_last, bucket_size=10)
+        batches = list(sampler)
+
+        assert len(batches) == len(sampler)
+        assert all(len(batch) == 8 for batch in batches[:-1] if drop_last)
+
+        indices = [index for batch in batches for index in batch]
+        assert len(indices) == len(set(indices))
+        if not drop_last:
+            assert sorted(indices) == list(range(len(lengths)))
+
+        # batches are drawn from sorted pools
+        spread = np.mean([np.ptp(lengths[batch]) for batch in batches])
+        assert spread < np.ptp(lengths) / 4
+
+
+def test_ctc_collate():
+    items = []
+    for length in [10, 3, 7]:
+        label = torch.tensor([length])
+        items.append((torch.rand(2, length), length, label, label.shape[0]))
+
+    x, x_length, y, y_length = ctc_collate_fn(items)
+
+    assert x.shape == (3, 2, 10)
+    assert x_length.tolist() == [10, 3, 7]
+    for num, (data, length, _, _) in enumerate(items):
+        expected = F.pad(data, (0, 10 - length))
+        assert torch.equal(x[num], expected)
+    assert y.view(-1).tolist() == [10, 3, 7]
+
+
+class LengthDataset(data.Dataset):
+    def __init__(self, lengths, offset=0):
+        self.lengths = np.asarray(lengths)
+        self.offset = offset
+
+    def __getitem__(self, index):
+        length = int(self.lengths[index])
+        label = torch.tensor([self.offset + index])
+        return torch.ones(2, length), length, label, label.shape[0]
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+class VariableLengthDataset(LengthDataset):
+    def sequence_lengths(self):
+        return self.lengths
+
+
+def train_loader(dataset, sampler):
+    module = SimpleNamespace(
+        hparams=OmegaConf.create(
+            {
+                "batch_size": 4,
+                "num_workers": 0,
+                "dataset": {"sampler": sampler, "bucket_size": 4},
+            }
+        ),
+        _get_sequence_lengths=BaseStreamClassifierModule._get_sequence_lengths,
+    )
+    return BaseStreamClassifierModule.get_train_dataloader_by_set(module, dataset)
+
+
+def padding(loader):
+    padded = 0
+    for x, x_length, _, _ in loader:
+        padded += int((x.shape[-1] - x_length).sum())
+    return padded
+
+
+def test_bucket_sampler_dataset():
+    np.random.seed(1234)
+    torch.manual_seed(1234)
+    lengths = np.random.randint(1, 200, size=64)
+    dataset = data.ConcatDataset(
+        [
+            VariableLengthDataset(lengths[:32]),
+            VariableLengthDataset(lengths[32:], offset=32),
+        ]
+    )
+
+    bucket_loader = train_loader(dataset, "bucket")
+    assert isinstance(bucket_loader.batch_sampler, BucketBatchSampler)
+    random_loader = train_loader(dataset, "random")
+    assert not isinstance(random_loader.batch_sampler, BucketBatchSampler)
+
+    seen = []
+    for _, _, y, _ in bucket_loader:
+        seen.extend(y.view(-1).tolist())
+    assert sorted(seen) == list(range(64))
+
+    assert padding(bucket_loader) < padding(random_loader) / 2
+
+    # Datasets without sequence lengths fall back to the random sampler
+    fixed_loader = train_loader(LengthDataset(np.full(16, 50)), "bucket")
+    assert isinstance(fixed_loader.sampler, data.RandomSampler)
@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from omegaconf import OmegaConf
+
+from hannah.tools.characterize import CharacterizationStore, sample_config
+
+config = OmegaConf.create(
+    {
+        "model": {"width": 8},
+        "nas": {
+            "parametrization": {
+                "model": {"width": [8, 16, 32, 64], "depth": [1, 2, 3, 4, 5]}
+            }
+        },
+    }
+)
+
+
+def test_sample_config_deterministic():
+    samples = [sample_config(config, index) for index in range(10)]
+    again = [sample_config(config, index) for index in reversed(range(10))]
+
+    for sample, other in zip(samples, reversed(again)):
+        assert sample.model == other.model
+
+    assert len({(s.model.width, s.model.depth) for s in samples}) > 1
+
+
+def test_characterization_store(tmp_path):
+    path = tmp_path / "characterization.sqlite"
+    store = CharacterizationStore(path)
+
+    store.add(0, "config_0", None, [{"board": "a", "latency": 1.0}])
+    store.add(1, "config_1", "{}", [{"board": "a", "latency": 2.0}])
+    store.add(1, "config_1", "{}", [{"board": "b", "latency": 3.0}])
+    store.add(2, "config_2", None, [], error="failed")
+    store.close()
+
+    store = CharacterizationStore(path)
+    assert store.completed() == {0, 1, 2}
+    assert len(store) == 3
+
+    results = list(store.results())
+    keys = [(r["sample"], r["board"]) for r in results]
+    assert keys == [(0, "a"), (1, "a"), (1, "b")]
+    assert results[1]["graph"] == {}
+    assert [r["metrics"]["latency"] for r in store.results(board="b")] == [3.0]
+    store.close()
+
+
+def test_characterization_store_retry_failed(tmp_path):
+    store = CharacterizationStore(tmp_path / "characterization.sqlite")
+
+    store.add(0, "config_0", None, [{"board": "a", "latency": 1.0}])
+    store.add(1, "config_1", None, [], error="failed")
+    assert store.completed() == {0, 1}
+    assert store.completed(include_failed=False) == {0}
+
+    store.add(1, "config_1", "{}", [{"board": "a", "latency": 2.0}])
+    assert store.completed(include_failed=False) == {0, 1}
+    rows = store.connection.execute("SELECT COUNT(*) FROM results WHERE sample = 1")
+    assert rows.fetchone()[0] == 1
+    store.close()
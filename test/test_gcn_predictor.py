@@ -0,0 +1,111 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+dgl = pytest.importorskip("dgl")
+pytest.importorskip("xgboost")
+pytest.importorskip("sklearn")
+
+from dgl.dataloading import GraphDataLoader  # noqa: E402
+
+from hannah.nas.performance_prediction.gcn.predictor import (  # noqa: E402
+    GaussianProcessPredictor,
+    GCNPredictor,
+    XGBPredictor,
+)
+
+FEATURES = 6
+
+
+def random_graphs(num, seed=1234):
+    generator = torch.Generator().manual_seed(seed)
+    graphs = []
+    for _ in range(num):
+        nodes = int(torch.randint(3, 8, (1,), generator=generator))
+        src = torch.arange(nodes - 1)
+        graph = dgl.graph((src, src + 1), num_nodes=nodes)
+        graph.ndata["features"] = torch.rand((nodes, FEATURES), generator=generator)
+        graphs.append(dgl.add_self_loop(graph))
+    return graphs
+
+
+def dataloader(graphs):
+    labels = torch.tensor([float(g.num_nodes()) for g in graphs])
+    return GraphDataLoader(list(zip(graphs, labels)), batch_size=4)
+
+
+@pytest.mark.parametrize("predictor_cls", [GaussianProcessPredictor, XGBPredictor])
+def test_batched_predict(predictor_cls):
+    graphs = random_graphs(10)
+    predictor = predictor_cls(FEATURES, hidden_units=[8], embedding_size=4)
+    predictor.train_and_fit(dataloader(graphs), num_epochs=2, verbose=0)
+
+    with torch.no_grad():
+        single = np.concatenate(
+            [predictor.get_embedding(g).numpy() for g in graphs], axis=0
+        )
+    assert np.allclose(predictor.embed(graphs, batch_size=3), single, atol=1e-5)
+
+    batched = predictor.predict(graphs, batch_size=3)
+    if predictor_cls is GaussianProcessPredictor:
+        batched = batched[0]
+    for graph, prediction in zip(graphs, batched):
+        expected = predictor.predict(graph)
+        if predictor_cls is GaussianProcessPredictor:
+            expected = expected[0]
+        assert np.allclose(expected, prediction, atol=1e-4)
+
+
+def test_patience_restores_best_weights():
+    graphs = random_graphs(8)
+    predictor = GaussianProcessPredictor(FEATURES, hidden_units=[8], embedding_size=4)
+
+    losses = iter([3.0, 1.0, 2.0, 4.0, 5.0])
+    states = []
+
+    def validation_loss(dataloader):
+        states.append(copy.deepcopy(predictor.model.state_dict()))
+        return next(losses)
+
+    predictor._validation_loss = validation_loss
+    predictor.train(
+        dataloader(graphs),
+        learning_rate=0.1,
+        num_epochs=5,
+        validation_dataloader=dataloader(graphs),
+        verbose=0,
+        patience=2,
+    )
+
+    # Stopped after two epochs without improvement of the second epoch
+    assert len(states) == 4
+    for key, value in predictor.model.state_dict().items():
+        assert torch.equal(value, states[1][key])
+    assert not torch.equal(states[1]["conv1.weight"], states[3]["conv1.weight"])
+
+
+def test_embed_without_embedding():
+    predictor = GCNPredictor(FEATURES, hidden_units=[8])
+
+    with pytest.raises(TypeError):
+        predictor.embed(random_graphs(2))
@@ -16,7 +16,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
+
 import networkx as nx
+import numpy as np
 import torch
 from omegaconf import OmegaConf
 from torch.nn import Module
@@ -24,7 +27,13 @@ from torch.nn import Module
 from hannah.models.factory.pooling import ApproximateGlobalAveragePooling1D
 from hannah.models.factory.qat import ConvBn1d, ConvBnReLU1d, Linear
 from hannah.models.factory.qconfig import get_trax_qat_qconfig
-from hannah.nas.graph_conversion import model_to_graph
+from hannah.nas.graph_conversion import (
+    FEATURE_NAMES,
+    _trace_cache,
+    graph_to_arrays,
+    model_to_arrays,
+    model_to_graph,
+)
 
 
 class Model(Module):
@@ -66,5 +75,54 @@ def test_graph_conversion():
     pprint(data, indent=2)
 
 
+def test_graph_conversion_keeps_model_state():
+    model = Model()
+    model.train()
+    weight = model.conv.weight.detach().clone()
+
+    model_to_graph(model, torch.rand((1, 16, 50), dtype=torch.float32))
+
+    assert all(module.training for module in model.modules())
+    assert torch.equal(model.conv.weight, weight)
+
+
+def test_array_conversion():
+    model = Model()
+    input = torch.rand((1, 16, 50), dtype=torch.float32)
+
+    graph = model_to_graph(model, input)
+    arrays = model_to_arrays(model, input)
+
+    assert arrays.names == list(graph.nodes)
+    assert arrays.features.shape == (graph.number_of_nodes(), len(FEATURE_NAMES))
+    assert arrays.edge_index.shape == (2, graph.number_of_edges())
+
+    edges = {(arrays.names[src], arrays.names[dst]) for src, dst in arrays.edge_index.T}
+    assert edges == set(graph.edges)
+
+    # Converting a second instance of the same architecture reuses the trace
+    cache_size = len(_trace_cache)
+    model_to_arrays(Model(), input)
+    assert len(_trace_cache) == cache_size
+
+
+def test_stored_graph_features():
+    "Graphs stored by a search are encoded like the graphs of model_to_arrays"
+    model = Model()
+    input = torch.rand((1, 16, 50), dtype=torch.float32)
+
+    data = json.loads(
+        json.dumps(nx.json_graph.node_link_data(model_to_graph(model, input)))
+    )
+    stored = graph_to_arrays(nx.json_graph.node_link_graph(data))
+    arrays = model_to_arrays(model, input)
+
+    assert stored.names == arrays.names
+    assert np.array_equal(stored.features, arrays.features)
+    assert sorted(map(tuple, stored.edge_index.T.tolist())) == sorted(
+        map(tuple, arrays.edge_index.T.tolist())
+    )
+
+
 if __name__ == "__main__":
     test_graph_conversion()
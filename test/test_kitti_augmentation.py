@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+
+import numpy as np
+import pytest
+import torch.utils.data as data
+
+pytest.importorskip("pycocotools")
+
+from PIL import Image  # noqa: E402
+
+from hannah.datasets.base import DatasetType  # noqa: E402
+from hannah.datasets.Kitti import Kitti, object_collate_fn  # noqa: E402
+from hannah.modules.augmentation.engine import AugmentationEngine  # noqa: E402
+
+
+def create_kitti(root, num_images):
+    image_dir = root / "kitti" / "training" / "image_2"
+    label_dir = root / "kitti" / "training" / "label_2"
+    image_dir.mkdir(parents=True)
+    label_dir.mkdir(parents=True)
+
+    files = {}
+    for num in range(num_images):
+        Image.fromarray(np.zeros((8, 16, 3), dtype=np.uint8)).save(
+            image_dir / f"{num:06d}.png"
+        )
+        (label_dir / f"{num:06d}.txt").write_text(
+            "Car 0.00 0 0.00 1.00 1.00 4.00 4.00 1.0 1.0 1.0 1.0 1.0 1.0 0.0\n"
+        )
+        files[f"{num:06d}.png"] = f"{num:06d}.txt"
+
+    config = {
+        "labels": {"DontCare": 0, "Car": 1},
+        "labels_ignore": [0],
+        "img_size": "8,16",
+        "kitti_folder": str(root / "kitti"),
+    }
+
+    return Kitti(files, DatasetType.TRAIN, config)
+
+
+def test_augmented_images_visible_in_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    kitti = create_kitti(tmp_path, 4)
+    loader = data.DataLoader(
+        kitti,
+        batch_size=2,
+        num_workers=2,
+        persistent_workers=True,
+        collate_fn=object_collate_fn,
+        multiprocessing_context="fork",
+    )
+
+    # Start the workers before anything is augmented
+    for _, targets, _ in loader:
+        assert all(not t["img_file"].startswith(kitti.aug_path) for t in targets)
+
+    engine = AugmentationEngine(num_workers=1)
+    cache_dir = engine.cache_dir(kitti)
+    os.makedirs(cache_dir)
+    cached = os.path.join(cache_dir, "augmented.png")
+    Image.fromarray(np.full((8, 16, 3), 255, dtype=np.uint8)).save(cached)
+    engine._announce(kitti, "000001", cached)
+
+    augmented = {}
+    for _, targets, _ in loader:
+        for target in targets:
+            augmented[target["filename"]] = target["img_file"]
+    assert augmented["000001.png"] == kitti.augmented_file("000001")
+    assert augmented["000002.png"].endswith("image_2/000002.png")
+
+    engine.cancel(kitti)
+    assert kitti.augmented_file("000001") is None
+    engine.shutdown()
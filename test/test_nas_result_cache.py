@@ -0,0 +1,87 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import numpy as np
+from omegaconf import OmegaConf
+
+from hannah.nas.parametrization import SearchSpace
+from hannah.nas.result_cache import (
+    NASResultCache,
+    cache_key,
+    context_fingerprint,
+    parameter_fingerprint,
+)
+
+search_space = {
+    "model": {
+        "conv": [{"kernel_size": 3}, {"kernel_size": 5}, {"kernel_size": 7}],
+        "blocks": {"min": 1, "max": 4, "choices": [8, 16, 32]},
+    }
+}
+
+
+def test_parameter_fingerprint():
+    space = SearchSpace(search_space, np.random.RandomState(1234))
+    state = space.get_random()
+
+    assert parameter_fingerprint(state) == parameter_fingerprint(state.flatten())
+
+    flat = state.flatten()
+    reordered = {"model": dict(reversed(list(flat["model"].items())))}
+    assert parameter_fingerprint(reordered) == parameter_fingerprint(flat)
+
+    changed = dict(flat["model"], conv={"kernel_size": 9})
+    assert parameter_fingerprint({"model": changed}) != parameter_fingerprint(flat)
+
+    numpy_values = {"model": dict(flat["model"], extra=np.int64(3))}
+    python_values = {"model": dict(flat["model"], extra=3)}
+    assert parameter_fingerprint(numpy_values) == parameter_fingerprint(python_values)
+
+
+def test_result_cache(tmp_path):
+    path = tmp_path / "results" / "result_cache.jsonl"
+    cache = NASResultCache(path)
+
+    assert cache.put("a", {"val_error": np.float32(0.25), "acc_macs": 1000})
+    assert not cache.put("b", {"val_error": float("inf")})
+    assert "a" in cache
+    assert "b" not in cache
+
+    reloaded = NASResultCache(path)
+    assert len(reloaded) == 1
+    assert reloaded.get("a") == {"val_error": 0.25, "acc_macs": 1000.0}
+    assert reloaded.get("b") is None
+
+
+def test_context_fingerprint():
+    config = OmegaConf.create(
+        {"dataset": {"cls": "kws"}, "trainer": {"max_epochs": 30}, "seed": [1234]}
+    )
+    context = context_fingerprint(config)
+
+    assert context == context_fingerprint(OmegaConf.to_container(config))
+    assert context == context_fingerprint(OmegaConf.merge(config, {"nas": {"n": 2}}))
+
+    for changed in [
+        {"dataset": {"cls": "snips"}},
+        {"trainer": {"max_epochs": 10}},
+        {"seed": [4321]},
+    ]:
+        other = context_fingerprint(OmegaConf.merge(config, changed))
+        assert other != context
+        assert cache_key(other, "a") != cache_key(context, "a")
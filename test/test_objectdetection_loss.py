@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import torch
+
+from hannah.models.objectdetection.loss import ComputeLoss
+
+
+def reference_build_targets(self, p, targets):
+    """Layer by layer target assignment as implemented in ultralytics/yolov5"""
+    na, nt = self.na, targets.shape[0]
+    tcls, tbox, indices, anch = [], [], [], []
+    gain = torch.ones(7, device=targets.device)
+    ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)
+    targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)
+
+    g = 0.5
+    off = (
+        torch.tensor(
+            [[0, 0], [1, 0], [0, 1], [-1, 0], [0, -1]], device=targets.device
+        ).float()
+        * g
+    )
+
+    for i in range(self.nl):
+        anchors = self.anchors[i]
+        gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]
+
+        t = targets * gain
+        if nt:
+            r = t[:, :, 4:6] / anchors[:, None]
+            j = torch.max(r, 1.0 / r).max(2)[0] < self.hyp["anchor_t"]
+            t = t[j]
+
+            gxy = t[:, 2:4]
+            gxi = gain[[2, 3]] - gxy
+            j, k = ((gxy % 1.0 < g) & (gxy > 1.0)).T
+            l, m = ((gxi % 1.0 < g) & (gxi > 1.0)).T
+            j = torch.stack((torch.ones_like(j), j, k, l, m))
+            t = t.repeat((5, 1, 1))[j]
+            offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
+        else:
+            t = targets[0]
+            offsets = 0
+
+        b, c = t[:, :2].long().T
+        gxy = t[:, 2:4]
+        gwh = t[:, 4:6]
+        gij = (gxy - offsets).long()
+        gi, gj = gij.T
+
+        a = t[:, 6].long()
+        indices.append((b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))
+        tbox.append(torch.cat((gxy - gij, gwh), 1))
+        anch.append(anchors[a])
+        tcls.append(c)
+
+    return tcls, tbox, indices, anch
+
+
+def make_loss():
+    loss = ComputeLoss.__new__(ComputeLoss)
+    loss.na = 3
+    loss.nl = 3
+    loss.nc = 9
+    loss.hyp = {"anchor_t": 4.0}
+    loss.anchors = torch.tensor(
+        [
+            [[1.25, 1.625], [2.0, 3.75], [4.125, 2.875]],
+            [[1.875, 3.8125], [3.875, 2.8125], [3.6875, 7.4375]],
+            [[3.625, 2.8125], [4.875, 6.1875], [11.65625, 10.1875]],
+        ]
+    )
+    return loss
+
+
+def test_build_targets():
+    torch.manual_seed(1234)
+    loss = make_loss()
+    p = [
+        torch.zeros(4, 3, 48, 156, 14),
+        torch.zeros(4, 3, 24, 78, 14),
+        torch.zeros(4, 3, 12, 39, 14),
+    ]
+
+    nt = 50
+    targets = torch.cat(
+        (
+            torch.randint(0, 4, (nt, 1)).float(),
+            torch.randint(0, 9, (nt, 1)).float(),
+            torch.rand(nt, 2),
+            torch.rand(nt, 2) * 0.3,
+        ),
+        1,
+    )
+
+    expected = reference_build_targets(loss, p, targets)
+    result = loss.build_targets(p, targets)
+
+    for expected_list, result_list in zip(expected, result):
+        assert len(expected_list) == len(result_list)
+        for e, r in zip(expected_list, result_list):
+            if isinstance(e, tuple):
+                for e_elem, r_elem in zip(e, r):
+                    assert torch.equal(e_elem.long(), r_elem.long())
+            else:
+                assert torch.allclose(e.float(), r.float())
+
+
+def test_build_targets_empty():
+    loss = make_loss()
+    p = [torch.zeros(1, 3, 8, 8, 14)] * 3
+    tcls, tbox, indices, anch = loss.build_targets(p, torch.zeros(0, 6))
+
+    assert len(tcls) == 3
+    for c, box in zip(tcls, tbox):
+        assert c.numel() == 0
+        assert box.shape == (0, 4)
+
+
+if __name__ == "__main__":
+    test_build_targets()
@@ -0,0 +1,47 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import numpy as np
+import pytest
+
+pytest.importorskip("wfdb")
+
+from hannah.datasets.physio import PhysioStore, PhysioStoreWriter  # noqa: E402
+
+
+def test_writer_fits_length(tmp_path):
+    writer = PhysioStoreWriter(str(tmp_path), input_length=4)
+    writer.append("a/short", 0, np.ones((2, 3)))
+    writer.append("a/long", 0, np.ones((2, 6)))
+    writer.append("b/empty", 1, np.ones((2, 0)))
+    writer.close()
+
+    store = PhysioStore(str(tmp_path))
+    assert store.shape == (3, 2, 4)
+    data = PhysioStore.open_data(str(tmp_path), store.shape)
+    assert np.array_equal(data[0], [[1, 1, 1, 0], [1, 1, 1, 0]])
+    assert np.array_equal(data[1], np.ones((2, 4)))
+    assert not data[2].any()
+
+
+def test_writer_rejects_mismatching_shape(tmp_path):
+    writer = PhysioStoreWriter(str(tmp_path), input_length=4)
+    writer.append("a/first", 0, np.ones((2, 4)))
+
+    with pytest.raises(ValueError, match="a/second"):
+        writer.append("a/second", 0, np.ones((3, 4)))
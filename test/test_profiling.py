@@ -0,0 +1,66 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+
+from hannah.profiling import RegionProfiler
+
+
+def test_region_summary():
+    profiler = RegionProfiler()
+
+    for _ in range(3):
+        with profiler.region("outer"):
+            with profiler.region("inner"):
+                pass
+
+    summary = profiler.summary()
+    assert summary["outer"]["count"] == 3
+    assert summary["inner"]["count"] == 3
+    assert summary["inner"]["max_ms"] <= summary["outer"]["total_ms"]
+
+    assert profiler.summary() == {}
+
+
+def test_disabled_profiler():
+    profiler = RegionProfiler(enabled=False)
+
+    with profiler.region("region"):
+        pass
+
+    assert profiler.summary() == {}
+
+
+def test_chrome_trace(tmp_path):
+    profiler = RegionProfiler()
+    trace_file = tmp_path / "trace.json"
+
+    with profiler.region("before"):
+        pass
+    profiler.start_trace()
+    with profiler.region("traced"):
+        pass
+    profiler.stop_trace(str(trace_file))
+    with profiler.region("after"):
+        pass
+
+    with trace_file.open() as f:
+        events = json.load(f)["traceEvents"]
+    assert [event["name"] for event in events] == ["traced"]
+    assert events[0]["ph"] == "X"
+    assert not profiler.tracing
@@ -22,7 +22,7 @@ import torch
 import torch.nn.functional as F
 import torch.optim as optim
 
-from hannah.features import SincConv
+from hannah.features import SincConv, SincConvFFT
 
 
 def test_sinc():
@@ -48,5 +48,40 @@ def test_sinc():
         assert not torch.equal(parameter, orig_parameters[name])
 
 
+def _sinc_fft_reference(model, x):
+    spectrogram = torch.stft(x.squeeze(1), n_fft=160, hop_length=160)
+    spectrogram = spectrogram[:, :, :, 0]
+
+    f_low = torch.abs(model.low_freq_) + model.min_low_hz
+    f_high = torch.clamp(
+        f_low + model.min_band_hz + torch.abs(model.band_freq_),
+        model.min_low_hz,
+        model.sample_rate / 2,
+    )
+    band_width = model.sample_rate / (2 * spectrogram.shape[1])
+    f_low_idx = f_low.div(band_width).floor()
+    f_high_idx = f_high.div(band_width).ceil()
+    channels = [
+        spectrogram[:, f_low_idx.int()[i] : f_high_idx.int()[i], :].sum(dim=1)
+        for i in range(model.out_channels)
+    ]
+    features = torch.stack(channels, dim=1)
+    return features.div(features.max())
+
+
+def test_sinc_fft():
+    model = SincConvFFT()
+    x = torch.rand(4, 1, 16000)
+
+    assert torch.allclose(model(x), _sinc_fft_reference(model, x), atol=1e-5)
+
+    # changed band edges must be picked up by the cached band mask
+    with torch.no_grad():
+        model.low_freq_.mul_(1.5)
+        model.band_freq_.mul_(0.5)
+    assert torch.allclose(model(x), _sinc_fft_reference(model, x), atol=1e-5)
+
+
 if __name__ == "__main__":
     test_sinc()
+    test_sinc_fft()
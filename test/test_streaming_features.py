@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import pytest
+import torch
+import torchaudio
+
+from hannah.features import LogSpectrogram, SincConvBlock, StreamingFeatures
+
+
+@pytest.mark.parametrize(
+    "features",
+    [
+        LogSpectrogram(n_fft=400, hop_length=160),
+        torchaudio.transforms.MFCC(
+            sample_rate=16000, n_mfcc=40, melkwargs={"n_fft": 480, "hop_length": 160}
+        ),
+        SincConvBlock(kernel_size=101, pool_len=2),
+    ],
+)
+@pytest.mark.parametrize("chunk_size", [160, 1000, 4000])
+def test_streaming_features(features, chunk_size):
+    features.eval()
+    audio = torch.rand(1, 1, 16000) * 2 - 1
+
+    with torch.no_grad():
+        expected = features(audio)
+
+        streaming = StreamingFeatures(features)
+        frames = []
+        for start in range(0, audio.shape[-1], chunk_size):
+            new_frames = streaming(audio[..., start : start + chunk_size])
+            if new_frames is not None:
+                frames.append(new_frames)
+        result = torch.cat(frames, dim=-1)
+
+    # frames at the borders of the offline features depend on the padding
+    first = streaming.context_frames
+    assert result.shape[-1] > 0
+    assert torch.allclose(
+        result, expected[..., first : first + result.shape[-1]], atol=1e-4
+    )
+
+
+def stream(features, audio, chunk_size):
+    streaming = StreamingFeatures(features)
+    frames = []
+    for start in range(0, audio.shape[-1], chunk_size):
+        new_frames = streaming(audio[..., start : start + chunk_size])
+        if new_frames is not None:
+            frames.append(new_frames)
+    return torch.cat(frames, dim=-1), streaming.context_frames
+
+
+def test_streaming_mfcc_silence_then_burst():
+    mfcc = torchaudio.transforms.MFCC(
+        sample_rate=16000, n_mfcc=40, melkwargs={"n_fft": 480, "hop_length": 160}
+    )
+    mfcc.eval()
+    silence = torch.rand(1, 1, 8000) * 1e-7
+    burst = torch.rand(1, 1, 8000) * 2 - 1
+    audio = torch.cat((silence, burst), dim=-1)
+
+    with torch.no_grad():
+        result, first = stream(mfcc, audio, 1000)
+        offline = mfcc(audio)[..., first : first + result.shape[-1]]
+
+        # decibel values without clamp
+        to_db = mfcc.amplitude_to_DB
+        mel_db = torchaudio.functional.amplitude_to_DB(
+            mfcc.MelSpectrogram(audio),
+            to_db.multiplier,
+            to_db.amin,
+            to_db.db_multiplier,
+            None,
+        )
+        unclamped = torch.matmul(mel_db.transpose(-1, -2), mfcc.dct_mat)
+        unclamped = unclamped.transpose(-1, -2)[..., first : first + result.shape[-1]]
+
+    # offline extraction clamps the silence against the maximum of the burst,
+    # streaming only against the maximum seen so far
+    silence_frames = slice(0, 30)
+    assert not torch.allclose(
+        offline[..., silence_frames], unclamped[..., silence_frames], atol=1e-3
+    )
+    assert torch.allclose(
+        result[..., silence_frames], unclamped[..., silence_frames], atol=1e-3
+    )
+
+    # frames of the burst do not depend on the silence
+    burst_frames = slice(60, None)
+    assert torch.allclose(
+        result[..., burst_frames], offline[..., burst_frames], atol=1e-3
+    )
@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import pytest
+import torch
+from hydra.utils import instantiate
+from omegaconf import OmegaConf
+
+from hannah.models.streaming import StreamingConvNet
+from hannah.models.tc.models import TCResNetModel
+
+
+def tc_res8_config(**kwargs):
+    config = {
+        "separable": [0, 0],
+        "bottleneck": [0, 0],
+        "channel_division": [2, 4],
+        "block1_conv_size": 9,
+        "block1_output_channels": 24,
+        "block1_stride": 2,
+        "block2_conv_size": 9,
+        "block2_output_channels": 32,
+        "block2_stride": 2,
+        "block3_conv_size": 9,
+        "block3_output_channels": 48,
+        "block3_stride": 2,
+        "conv1_output_channels": 16,
+        "conv1_size": 3,
+        "conv1_stride": 1,
+        "dropout_prob": 0.5,
+        "fully_convolutional": False,
+        "inputlayer": True,
+        "width_multiplier": 1.0,
+        "dilation": 1,
+        "clipping_value": 100000.0,
+        "small": False,
+        "width": 101,
+        "height": 40,
+        "n_labels": 12,
+    }
+    config.update(kwargs)
+    return config
+
+
+def check_streaming(model, hop):
+    stream = torch.randn(2, 40, 101 + 10 * hop)
+
+    with torch.no_grad():
+        streaming = StreamingConvNet(model)
+        outputs = [streaming(stream[..., :101])]
+        expected = [model(stream[..., :101])]
+        for start in range(101, stream.shape[-1], hop):
+            outputs.append(streaming(stream[..., start : start + hop]))
+            end = start + hop
+            expected.append(model(stream[..., end - 101 : end]))
+
+    for output, reference in zip(outputs, expected):
+        assert torch.allclose(output, reference, atol=1e-5)
+
+
+@pytest.mark.parametrize("hop", [1, 3, 8, 16, 200])
+@pytest.mark.parametrize("dilation", [1, 2])
+def test_streaming_tcresnet(hop, dilation):
+    model = TCResNetModel(tc_res8_config(dilation=dilation))
+    model.eval()
+
+    check_streaming(model, hop)
+
+
+@pytest.mark.parametrize("hop", [1, 4, 16])
+@pytest.mark.parametrize("quantized", [False, True])
+def test_streaming_conv_net_trax(hop, quantized):
+    config = OmegaConf.load("hannah/conf/model/conv-net-trax.yaml")
+    if not quantized:
+        config.qconfig = None
+    model = instantiate(config, input_shape=(1, 40, 101), labels=12, _recursive_=False)
+    model.eval()
+
+    check_streaming(model, hop)
@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import pytest
+import torch
+from hydra.utils import instantiate
+from omegaconf import OmegaConf
+
+from hannah.callbacks.summaries import (
+    FUSED_MODULES,
+    AnalyticSummary,
+    architecture_fingerprint,
+    summarize_model,
+    walk_model,
+)
+from hannah.models.tc.models import TCResNetModel
+
+COMPARED_COLUMNS = ["Name", "IFM", "OFM", "Weights volume", "MACs"]
+
+
+def tc_res8():
+    config = OmegaConf.load("hannah/conf/model/tc-res8.yaml")
+    config.width = 101
+    config.height = 40
+    config.n_labels = 12
+    return TCResNetModel(config), torch.zeros(1, 40, 101)
+
+
+def conv_net_trax(quantized):
+    config = OmegaConf.load("hannah/conf/model/conv-net-trax.yaml")
+    if not quantized:
+        config.qconfig = None
+    model = instantiate(config, input_shape=(1, 40, 101), labels=12, _recursive_=False)
+    return model, torch.zeros(1, 40, 101)
+
+
+@pytest.mark.parametrize(
+    "create_model",
+    [tc_res8, lambda: conv_net_trax(False)],
+)
+def test_analytic_summary(create_model):
+    model, dummy_input = create_model()
+    model.eval()
+
+    expected = walk_model(model, dummy_input)
+    result = AnalyticSummary(model)(dummy_input.shape)
+
+    assert expected[COMPARED_COLUMNS].equals(result[COMPARED_COLUMNS])
+
+
+def test_analytic_summary_qat():
+    model, dummy_input = conv_net_trax(True)
+    model.eval()
+
+    expected = walk_model(model, dummy_input)
+    result = AnalyticSummary(model)(dummy_input.shape)
+
+    # fused modules get a single row, so only the totals are compared
+    assert expected["MACs"].sum() == result["MACs"].sum()
+    assert expected["Weights volume"].sum() == result["Weights volume"].sum()
+
+
+def test_summary_cache():
+    model, dummy_input = tc_res8()
+
+    summary = summarize_model(model, dummy_input)
+    assert summarize_model(model, dummy_input) is summary
+
+    other, _ = conv_net_trax(False)
+    assert architecture_fingerprint(other, dummy_input.shape) != (
+        architecture_fingerprint(model, dummy_input.shape)
+    )
+
+
+def test_walk_model_collapse_fused():
+    model, dummy_input = conv_net_trax(True)
+    model.eval()
+
+    full = walk_model(model, dummy_input)
+    collapsed = walk_model(model, dummy_input, collapse_fused=True)
+
+    fused = {
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, FUSED_MODULES) and len(list(module.children())) > 0
+    }
+    assert fused
+    assert any(name.rsplit(".", 1)[0] in fused for name in full["Name"])
+    assert not any(name.rsplit(".", 1)[0] in fused for name in collapsed["Name"])
+    assert collapsed["MACs"].sum() == full["MACs"].sum()
@@ -0,0 +1,115 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import random
+
+import torch
+import torch.utils.data as data
+
+from hannah.modules.teacher_cache import (
+    AugmentationViewDataset,
+    TeacherCache,
+    TeacherCacheWriter,
+    indexed_collate_fn,
+)
+
+
+class NoisyDataset(data.Dataset):
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, index):
+        x = torch.full((1, 16), float(index)) + torch.randn(1, 16)
+        x = torch.roll(x, random.randint(-4, 4), dims=-1)
+        label = torch.tensor([index % 3])
+        return x, x.shape[-1], label, label.shape[0]
+
+
+def test_augmentation_views():
+    dataset = AugmentationViewDataset(NoisyDataset(), num_views=2, seed=1)
+
+    for index in range(len(dataset)):
+        x, _, _, _, item_index, view = dataset[index]
+        assert item_index == index
+        fixed = AugmentationViewDataset(NoisyDataset(), num_views=2, seed=1, view=view)
+        assert torch.equal(fixed[index][0], x)
+
+    view0 = AugmentationViewDataset(NoisyDataset(), num_views=2, seed=1, view=0)
+    view1 = AugmentationViewDataset(NoisyDataset(), num_views=2, seed=1, view=1)
+    assert not torch.equal(view0[0][0], view1[0][0])
+
+
+def test_augmentation_views_keep_random_state():
+    dataset = AugmentationViewDataset(NoisyDataset(), num_views=2, seed=1)
+
+    torch.manual_seed(0)
+    expected = torch.rand(3)
+    torch.manual_seed(0)
+    dataset[0]
+    assert torch.equal(torch.rand(3), expected)
+
+    if torch.cuda.is_available():
+        cuda_states = torch.cuda.get_rng_state_all()
+        dataset[1]
+        for state, other in zip(cuda_states, torch.cuda.get_rng_state_all()):
+            assert torch.equal(state, other)
+
+
+def test_teacher_cache(tmp_path):
+    num_views = 2
+    dataset = NoisyDataset()
+    teachers = [torch.nn.Linear(16, 3), torch.nn.Linear(16, 3)]
+
+    writer = TeacherCacheWriter(
+        str(tmp_path),
+        "key",
+        num_views=num_views,
+        num_samples=len(dataset),
+        num_teachers=len(teachers),
+        store_features=True,
+    )
+    assert TeacherCache.open(str(tmp_path), "key") is None
+
+    for view in range(num_views):
+        loader = data.DataLoader(
+            AugmentationViewDataset(dataset, num_views, view=view),
+            batch_size=4,
+            collate_fn=indexed_collate_fn,
+        )
+        with torch.no_grad():
+            for x, _, _, _, indices, _ in loader:
+                logits = [teacher(x[:, 0]) for teacher in teachers]
+                writer.write(indices, view, logits, [x[:, 0] for _ in teachers])
+    writer.close()
+
+    assert TeacherCache.open(str(tmp_path), "other") is None
+    cache = TeacherCache.open(str(tmp_path), "key")
+    assert cache.has_features
+
+    loader = data.DataLoader(
+        AugmentationViewDataset(dataset, num_views),
+        batch_size=4,
+        shuffle=True,
+        collate_fn=indexed_collate_fn,
+    )
+    with torch.no_grad():
+        for x, _, _, _, indices, views in loader:
+            teacher_logits, teacher_feat = cache.lookup(indices, views)
+            for teacher, logits, feat in zip(teachers, teacher_logits, teacher_feat):
+                assert torch.allclose(logits, teacher(x[:, 0]), atol=1e-2, rtol=1e-2)
+                assert torch.allclose(feat, x[:, 0], atol=1e-2, rtol=1e-2)
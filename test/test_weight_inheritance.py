@@ -0,0 +1,84 @@
+#
+# Copyright (c) 2022 University of Tübingen.
+#
+# This file is part of hannah.
+# See https://atreus.informatik.uni-tuebingen.de/ties/ai/hannah/hannah for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import torch
+import torch.nn as nn
+
+from hannah.nas.weight_inheritance import inherit_weights, transfer_tensor
+
+
+class Model(nn.Module):
+    def __init__(self, width, depth):
+        super().__init__()
+        self.stem = nn.Conv1d(8, width, 3, padding=1)
+        self.blocks = nn.ModuleList(
+            [nn.Conv1d(width, width, 3, padding=1) for _ in range(depth)]
+        )
+        self.head = nn.Conv1d(width, 4, 1)
+
+    def forward(self, x):
+        x = torch.relu(self.stem(x))
+        for block in self.blocks:
+            x = torch.relu(block(x))
+        return self.head(x)
+
+
+def test_copy_unchanged():
+    parent = Model(16, 1)
+    child = Model(16, 1)
+
+    methods = inherit_weights(child, parent.state_dict())
+
+    assert set(methods.values()) == {"copied"}
+    for key, value in parent.state_dict().items():
+        assert torch.equal(child.state_dict()[key], value)
+
+
+def test_widen_preserves_function():
+    parent = Model(16, 0)
+    child = Model(24, 0)
+
+    methods = inherit_weights(child, parent.state_dict())
+    assert methods["stem.weight"] == "resized"
+    assert methods["head.weight"] == "resized"
+
+    x = torch.rand(2, 8, 20)
+    assert torch.allclose(parent(x), child(x), atol=1e-5)
+
+
+def test_deepen_preserves_function():
+    parent = Model(16, 1)
+    child = Model(16, 2)
+
+    methods = inherit_weights(child, parent.state_dict())
+    assert methods["blocks.0.weight"] == "copied"
+    assert methods["blocks.1.weight"] == "identity"
+    assert methods["blocks.1.bias"] == "identity"
+
+    x = torch.rand(2, 8, 20)
+    assert torch.allclose(parent(x), child(x), atol=1e-5)
+
+
+def test_kernel_resize():
+    parent = torch.rand(4, 4, 3)
+    grown = transfer_tensor(parent, torch.Size([4, 4, 5]))
+    assert torch.equal(grown[:, :, 1:4], parent)
+    assert torch.count_nonzero(grown[:, :, 0]) == 0
+
+    shrunk = transfer_tensor(grown, torch.Size([4, 4, 3]))
+    assert torch.equal(shrunk, parent)